@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Benchmark the scoring and workout-ingest hot path.
+
+Scoring cases run the request-path stages (loose_hr_arrays, clean_hr_arrays
+and the whole score_samples_job) plus get_zone, calculate_burn_points,
+calculate_calories and calculate_afterburn over synthetic 1 Hz sessions of
+10 min, 60 min and 3 h.
+The ingest case POSTs the same sessions to /api/workouts through the ASGI app
+against a local mongod, using a throwaway database that is dropped afterwards.
+It is skipped (and reported as such) when no mongod answers.
+
+Results are written as JSON and compared to the stored baseline; the exit
+status is 1 when any case is slower than the baseline by more than --threshold.
+Scoring cases are compared as a ratio to a calibration loop timed alongside
+each repeat in the same process, so a machine that is slower or busier than
+when the baseline was taken doesn't fail every case, and a case's allowance
+widens with the run-to-run noise measured for it. A baseline from a different
+environment (Python, numpy, machine) is only reported against, never failed on.
+
+Usage:
+    python benchmarks/hot_path.py [--output results.json] [--threshold 0.25]
+    python benchmarks/hot_path.py --save-baseline     # refresh benchmarks/baseline.json
+    python benchmarks/hot_path.py --skip-ingest       # scoring only, no mongod needed
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline.json")
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+SESSION_MINUTES = [10, 60, 180]
+MAX_HR = 187
+WEIGHT_KG = 72.0
+AGE = 33
+
+
+def make_session(minutes: int, seed: int) -> list:
+    """A 1 Hz session that warms up, holds a few intervals and cools down."""
+    rng = random.Random(seed)
+    start = datetime(2024, 5, 1, 6, 30, tzinfo=timezone.utc)
+    seconds = minutes * 60
+    samples = []
+    hr = 75
+    for i in range(seconds):
+        phase = i / seconds
+        target = 95 if phase < 0.1 or phase > 0.9 else (175 if (i // 240) % 2 else 145)
+        hr = max(55, min(205, hr + (target - hr) // 20 + rng.randint(-2, 2)))
+        samples.append({
+            "timestamp": (start + timedelta(seconds=i)).isoformat().replace("+00:00", "Z"),
+            "heart_rate": hr,
+        })
+    return samples
+
+
+def calibration_loop():
+    """A fixed mix of interpreter and numpy work, timed next to each case to gauge machine speed."""
+    values = list(range(20000, 0, -1))
+    values.sort()
+    total = 0
+    for v in values:
+        total += v % 7
+    arr = np.arange(200000, dtype=np.float64)
+    return total + float(np.diff(np.cumsum(arr)).sum())
+
+
+def timed(fn, min_time: float = 0.2, repeat: int = 9, reference=calibration_loop) -> dict:
+    """Per-call timings in ms, with calls batched so each repeat runs for at least min_time.
+
+    Each repeat is followed by a shorter batch of `reference`, and "relative"
+    is the median ratio of the two: noise from the rest of the machine tends
+    to hit both halves of a pair alike. Like timeit, the collector is paused
+    while timing so a stray GC pass doesn't land in one case.
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        return _timed(fn, min_time, repeat, reference)
+    finally:
+        gc.enable()
+
+
+def calls_for(fn, min_time: float) -> tuple:
+    """(calls per batch, per-call seconds of the last trial) so one batch runs for at least min_time."""
+    number = 1
+    while True:
+        elapsed = per_call(fn, number) * number
+        if elapsed >= min_time or number >= 1 << 20:
+            return number, elapsed / number
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+
+
+def per_call(fn, number: int) -> float:
+    started = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return (time.perf_counter() - started) / number
+
+
+def _timed(fn, min_time: float, repeat: int, reference) -> dict:
+    number, _ = calls_for(fn, min_time)
+    ref_number, _ = calls_for(reference, min_time / 4)
+    runs, ratios = [], []
+    for _ in range(repeat):
+        runs.append(per_call(fn, number))
+        ratios.append(runs[-1] / per_call(reference, ref_number))
+    return {
+        "median_ms": statistics.median(runs) * 1000,
+        "min_ms": min(runs) * 1000,
+        "relative": statistics.median(ratios),
+        "noise": run_noise(ratios),
+        "calls": number * repeat,
+    }
+
+
+def run_noise(runs: list) -> float:
+    """Median absolute deviation of the runs, relative to their median."""
+    median = statistics.median(runs)
+    return statistics.median(abs(run - median) for run in runs) / median
+
+
+def run_scoring(sessions: dict, repeat: int) -> dict:
+    from server import (
+        ZoneClassifier, calculate_afterburn, calculate_burn_points, calculate_calories, clean_hr_arrays,
+        get_zone, loose_hr_arrays, score_samples_job,
+    )
+
+    classifier = ZoneClassifier(MAX_HR)
+    results = {}
+    for minutes, samples in sessions.items():
+        rates = [s["heart_rate"] for s in samples]
+        total_points, zones, avg_hr, peak_hr = calculate_burn_points(samples, MAX_HR)
+        times_ms, hr = loose_hr_arrays(samples)
+
+        cases = {
+            "loose_hr_arrays": lambda: loose_hr_arrays(samples),
+            "clean_hr_arrays": lambda: clean_hr_arrays(times_ms, hr),
+            "score_samples_job": lambda: score_samples_job(samples, None, classifier),
+            "get_zone": lambda: [get_zone(hr, MAX_HR) for hr in rates],
+            "calculate_burn_points": lambda: calculate_burn_points(samples, MAX_HR),
+            "calculate_calories": lambda: calculate_calories(minutes * 60, avg_hr, WEIGHT_KG, AGE),
+            "calculate_afterburn": lambda: calculate_afterburn(zones, WEIGHT_KG),
+        }
+        for name, fn in cases.items():
+            key = f"{name}[{minutes}min]"
+            results[key] = timed(fn, repeat=repeat)
+            print(f"  {key:34}{results[key]['median_ms']:>12.3f} ms")
+    return results
+
+
+async def mongod_available(mongo_url: str) -> bool:
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    probe = AsyncIOMotorClient(mongo_url, serverSelectionTimeoutMS=2000)
+    try:
+        await probe.admin.command("ping")
+        return True
+    except Exception:
+        return False
+    finally:
+        probe.close()
+
+
+async def run_ingest(sessions: dict, requests_per_size: int) -> dict:
+    import httpx
+    import server
+
+    server.app.dependency_overrides[server.verify_firebase_token] = lambda: None
+    results = {}
+    try:
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            response = await client.post("/api/users", json={
+                "name": "Bench", "age": AGE, "weight_kg": WEIGHT_KG, "height_cm": 178, "max_hr": MAX_HR,
+            })
+            response.raise_for_status()
+            user_id = response.json()["id"]
+
+            for minutes, samples in sessions.items():
+                payload = {"user_id": user_id, "duration_seconds": minutes * 60, "hr_samples": samples}
+                body = json.dumps(payload)
+                headers = {"Content-Type": "application/json"}
+                # One warm-up request so index builds and connection setup aren't timed
+                (await client.post("/api/workouts", content=body, headers=headers)).raise_for_status()
+
+                runs = []
+                for _ in range(requests_per_size):
+                    started = time.perf_counter()
+                    response = await client.post("/api/workouts", content=body, headers=headers)
+                    runs.append(time.perf_counter() - started)
+                    response.raise_for_status()
+
+                key = f"create_workout[{minutes}min]"
+                results[key] = {
+                    "median_ms": statistics.median(runs) * 1000,
+                    "min_ms": min(runs) * 1000,
+                    "p95_ms": float(np.percentile(runs, 95)) * 1000,
+                    "noise": run_noise(runs),
+                    "calls": requests_per_size,
+                }
+                print(f"  {key:34}{results[key]['median_ms']:>12.3f} ms")
+    finally:
+        server.app.dependency_overrides.clear()
+        await server.client.drop_database(server.DB_NAME)
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float, min_delta_ms: float, noise_factor: float = 3.0) -> list:
+    """Print each case against the baseline; returns the keys that regressed.
+
+    Cases timed against the calibration loop are compared on that ratio,
+    the others (ingest) on their fastest run, which is far less sensitive to
+    a busy machine than the median. A case only regresses past the larger of
+    `threshold` and `noise_factor` times the noise either run measured for it,
+    and by more than min_delta_ms in the baseline's terms.
+    """
+    regressions = []
+    print(f"\n{'case (best, ms)':36}{'baseline':>12}{'now':>12}{'change':>10}{'allowed':>10}")
+    for key, now in results.items():
+        before = baseline.get(key)
+        if before is None:
+            print(f"{key:36}{'-':>12}{now['min_ms']:>12.3f}{'new':>10}")
+            continue
+        if "relative" in now and "relative" in before:
+            change = now["relative"] / before["relative"] - 1
+        else:
+            change = now["min_ms"] / before["min_ms"] - 1
+        allowed = max(threshold, noise_factor * max(now.get("noise", 0), before.get("noise", 0)))
+        flag = ""
+        if change > allowed and change * before["min_ms"] > min_delta_ms:
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print(f"{key:36}{before['min_ms']:>12.3f}{now['min_ms']:>12.3f}{change:>+9.0%}{allowed:>+9.0%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--output", help="Also write the JSON report to this path")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="Overwrite the baseline with this run")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed slowdown before failing (0.25 = 25%%)")
+    parser.add_argument("--min-delta-ms", type=float, default=0.05,
+                        help="Ignore slowdowns smaller than this, so sub-microsecond cases don't flap")
+    parser.add_argument("--noise-factor", type=float, default=3.0,
+                        help="Also allow this many times a case's measured run-to-run noise")
+    parser.add_argument("--repeat", type=int, default=9)
+    parser.add_argument("--skip-ingest", action="store_true")
+    parser.add_argument("--ingest-requests", type=int, default=20, help="Timed create_workout calls per session size")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--db-name", default="pulsefit_benchmark", help="Scratch database, dropped afterwards")
+    args = parser.parse_args()
+
+    # server.py reads these at import time, so they must be set before the first import
+    os.environ["MONGO_URL"] = args.mongo_url
+    os.environ["DB_NAME"] = args.db_name
+
+    sessions = {minutes: make_session(minutes, seed=minutes) for minutes in SESSION_MINUTES}
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+        },
+        "results": {},
+        "skipped": {},
+    }
+
+    print("Scoring")
+    report["results"].update(run_scoring(sessions, args.repeat))
+
+    if args.skip_ingest:
+        report["skipped"]["create_workout"] = "--skip-ingest"
+    elif not asyncio.run(mongod_available(args.mongo_url)):
+        report["skipped"]["create_workout"] = f"no mongod at {args.mongo_url}"
+        print(f"\nIngest skipped: no mongod at {args.mongo_url}")
+    else:
+        print("Ingest")
+        report["results"].update(asyncio.run(run_ingest(sessions, args.ingest_requests)))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline saved to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline at {args.baseline}; run with --save-baseline to create one")
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(report["results"], baseline["results"], args.threshold, args.min_delta_ms, args.noise_factor)
+    if baseline.get("environment") != report["environment"]:
+        print(f"\nBaseline environment differs, not failing: {baseline.get('environment')} vs {report['environment']}")
+        return
+    if regressions:
+        print(f"\n{len(regressions)} case(s) slower than baseline beyond their allowance")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
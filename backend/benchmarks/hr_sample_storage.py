@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Compare raw vs packed hr_samples storage for workout documents.
+
+Builds a realistic month of workouts (20-90 min sessions at 1 Hz, with the
+occasional Bluetooth hiccup) and reports BSON document size plus the time to
+encode/decode a document in each representation.
+
+Usage:
+    python benchmarks/hr_sample_storage.py [--workouts 60] [--seed 7]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import bson
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from server import inflate_hr_samples, pack_hr_samples  # noqa: E402
+
+
+def make_workout(rng: random.Random, start: datetime) -> dict:
+    minutes = rng.randint(20, 90)
+    hr = rng.randint(70, 90)
+    t = start
+    samples = []
+    for _ in range(minutes * 60):
+        hr = max(55, min(200, hr + rng.randint(-3, 3)))
+        samples.append({"timestamp": t.isoformat().replace("+00:00", "Z"), "heart_rate": hr})
+        t += timedelta(seconds=rng.choice([1] * 40 + [2, 3]))
+    return {
+        "user_id": "5f0c2a9e1c4ae5a0b8d3c111",
+        "start_time": start.isoformat(),
+        "end_time": t.isoformat(),
+        "duration_seconds": int((t - start).total_seconds()),
+        "total_burn_points": 30,
+        "zones": [{"zone": z, "name": "Zone", "duration_seconds": 600, "burn_points": 2, "color": "#000000"} for z in range(1, 6)],
+        "avg_hr": 140,
+        "max_hr": 180,
+        "calories_burned": 420,
+        "afterburn_estimate": 40,
+        "target_hit": True,
+        "xp_earned": 180,
+        "notes": None,
+        "template_id": None,
+        "template_name": None,
+        "hr_samples": samples,
+    }
+
+
+def to_packed(doc: dict) -> dict:
+    packed = {k: v for k, v in doc.items() if k != "hr_samples"}
+    blob = pack_hr_samples(doc["hr_samples"])
+    if blob is None:
+        packed["hr_samples"] = doc["hr_samples"]
+    else:
+        packed["hr_samples_packed"] = blob
+    return packed
+
+
+def timed(fn, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workouts", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    day = datetime(2024, 5, 1, 7, tzinfo=timezone.utc)
+    raw_docs = [make_workout(rng, day + timedelta(days=i // 2, hours=10 * (i % 2))) for i in range(args.workouts)]
+
+    packed_docs = [to_packed(doc) for doc in raw_docs]
+
+    raw_bson = [bson.encode(d) for d in raw_docs]
+    packed_bson = [bson.encode(d) for d in packed_docs]
+    samples = sum(len(d["hr_samples"]) for d in raw_docs)
+
+    def encode_packed():
+        for doc in raw_docs:
+            bson.encode(to_packed(doc))
+
+    def decode_packed():
+        for data in packed_bson:
+            inflate_hr_samples(bson.decode(data))
+
+    results = [
+        ("BSON bytes (total)", sum(map(len, raw_bson)), sum(map(len, packed_bson))),
+        ("BSON bytes / sample", sum(map(len, raw_bson)) / samples, sum(map(len, packed_bson)) / samples),
+        ("encode all (ms)", timed(lambda: [bson.encode(d) for d in raw_docs]) * 1000, timed(encode_packed) * 1000),
+        ("decode all, no samples (ms)", timed(lambda: [bson.decode(b) for b in raw_bson]) * 1000,
+         timed(lambda: [bson.decode(b) for b in packed_bson]) * 1000),
+        ("decode all + samples (ms)", timed(lambda: [bson.decode(b) for b in raw_bson]) * 1000, timed(decode_packed) * 1000),
+    ]
+
+    print(f"{args.workouts} workouts, {samples} samples")
+    print(f"{'':30}{'raw':>14}{'packed':>14}{'ratio':>8}")
+    for label, raw, packed in results:
+        print(f"{label:30}{raw:>14.1f}{packed:>14.1f}{raw / packed:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+"""
+PulseFit backend maintenance commands.
+
+Run against the same MONGO_URL / DB_NAME as the API. Every command works in
+batches and is safe to run while the API is serving traffic.
+
+Usage:
+    python maintenance.py migrate-hr-samples [--batch-size 500]
+    python maintenance.py rebuild-rollups [--user-id ID] [--batch-size 200]
+    python maintenance.py backfill-dates [--batch-size 1000]
+    python maintenance.py backfill-local-days [--batch-size 200]
+    python maintenance.py backfill-achievements [--batch-size 200] [--workers N] [--restart]
+    python maintenance.py dedupe-achievements [--batch-size 1000]
+    python maintenance.py rebuild-personal-bests [--user-id ID] [--batch-size 200]
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from pymongo import DeleteMany, ReplaceOne, UpdateOne
+
+from server import (
+    ROLLUP_COLLECTIONS, achievements_collection, coarser_rollups, credit_unlocks, ensure_indexes,
+    history_achievement_ids, insert_unlocks, maintenance_checkpoints_collection, pack_hr_samples, parse_utc,
+    personal_bests_collection, personal_bests_from_history, response_cache, rollup_increments,
+    users_collection, workout_outbox_collection, workouts_collection,
+)
+
+
+async def migrate_hr_samples(batch_size: int):
+    """Convert workouts still holding a raw hr_samples list to the packed binary format."""
+    query = {"hr_samples": {"$type": "array"}}
+    last_id = None
+    scanned = converted = 0
+    samples = 0
+    started = time.perf_counter()
+
+    while True:
+        batch_query = dict(query)
+        if last_id is not None:
+            batch_query["_id"] = {"$gt": last_id}
+        batch = await workouts_collection.find(
+            batch_query, {"hr_samples": 1}
+        ).sort("_id", 1).limit(batch_size).to_list(None)
+        if not batch:
+            break
+
+        ops = []
+        for w in batch:
+            packed = pack_hr_samples(w["hr_samples"])
+            if packed is None:
+                continue  # Left raw; still readable through the old field
+            samples += len(w["hr_samples"])
+            # Match on the array so a concurrent rewrite of the document is never clobbered
+            ops.append(UpdateOne(
+                {"_id": w["_id"], "hr_samples": {"$type": "array"}},
+                {"$set": {"hr_samples_packed": packed}, "$unset": {"hr_samples": ""}}
+            ))
+
+        if ops:
+            result = await workouts_collection.bulk_write(ops, ordered=False)
+            converted += result.modified_count
+
+        scanned += len(batch)
+        last_id = batch[-1]["_id"]
+        print(f"  scanned {scanned}, converted {converted}")
+
+    elapsed = time.perf_counter() - started
+    print(f"Done: converted {converted}/{scanned} workouts ({samples} samples) in {elapsed:.1f}s")
+
+
+ROLLUP_FIELDS = {"end_time": 1, "local_day": 1, "total_burn_points": 1, "calories_burned": 1, "zones": 1}
+
+
+def set_rollups_ops(user_id: str, buckets: dict, event_ids: list, extra=lambda totals: {}) -> list:
+    """Bulk ops making a user's rollups at one level hold exactly `buckets`.
+
+    Totals are $set rather than the documents replaced, so the outbox events
+    already in applied_events stay there, and `event_ids` are added to it.
+    """
+    ops = [
+        UpdateOne(
+            {"user_id": user_id, "day": day},
+            {"$set": dict(totals, **extra(totals)), "$addToSet": {"applied_events": {"$each": event_ids}}},
+            upsert=True
+        )
+        for day, totals in buckets.items()
+    ]
+    ops.append(DeleteMany({"user_id": user_id, "day": {"$nin": list(buckets)}}))
+    return ops
+
+
+async def rebuild_user_rollups(user: dict) -> int:
+    """Recompute one user's daily, weekly and monthly rollups from their workouts; returns the number of days.
+
+    Outbox events still pending for the user are reconciled so the rebuild
+    and the outbox don't both count a workout. An event is written no later
+    than its workouts, so every workout read here has its event among those
+    read after it. Events whose workouts were all read are marked applied on
+    the rebuilt documents. Workouts of events not committed yet are left out
+    for the outbox to add or withdraw.
+    """
+    user_id = str(user["_id"])
+    workouts = await workouts_collection.find({"user_id": user_id}, ROLLUP_FIELDS).to_list(None)
+    pending = await workout_outbox_collection.find(
+        {"user_id": user_id, "status": "pending", "steps_done": {"$ne": "rollups"}},
+        {"workout_ids": 1, "committed": 1}
+    ).to_list(None)
+
+    read_ids = {w["_id"] for w in workouts}
+    uncommitted = {wid for e in pending if e.get("committed") is False for wid in e["workout_ids"]}
+    applied = [e["_id"] for e in pending if e.get("committed") is not False and read_ids.issuperset(e["workout_ids"])]
+    days = rollup_increments([w for w in workouts if w["_id"] not in uncommitted])
+    target = user.get("daily_burn_target", 12)
+
+    await ROLLUP_COLLECTIONS["day"].bulk_write(
+        set_rollups_ops(user_id, days, applied, lambda totals: {"target_hit": totals["points"] >= target}),
+        ordered=False
+    )
+    for unit in ("week", "month"):
+        await ROLLUP_COLLECTIONS[unit].bulk_write(
+            set_rollups_ops(user_id, coarser_rollups(days, unit), applied), ordered=False
+        )
+    return len(days)
+
+
+async def rebuild_rollups(user_id: str, batch_size: int):
+    """Regenerate the daily, weekly and monthly rollups from workout history, one user at a time.
+
+    Each user's buckets are rewritten with one bulk write per level. A workout saved for that
+    user while their rollups are being rewritten can be missed; run the
+    command again for that user if so.
+    """
+    await ensure_indexes()
+    query = {"_id": ObjectId(user_id)} if user_id else {}
+    last_id = None
+    users = days = 0
+    started = time.perf_counter()
+
+    while True:
+        batch_query = dict(query)
+        if last_id is not None:
+            batch_query["_id"] = {"$gt": last_id}
+        batch = await users_collection.find(
+            batch_query, {"daily_burn_target": 1}
+        ).sort("_id", 1).limit(batch_size).to_list(None)
+        if not batch:
+            break
+
+        for user in batch:
+            days += await rebuild_user_rollups(user)
+        await response_cache.bump(*(str(u["_id"]) for u in batch))
+
+        users += len(batch)
+        last_id = batch[-1]["_id"]
+        print(f"  rebuilt {users} users, {days} days")
+        if user_id:
+            break
+
+    elapsed = time.perf_counter() - started
+    print(f"Done: rebuilt {days} daily rollups for {users} users in {elapsed:.1f}s")
+
+
+async def backfill_dates(batch_size: int):
+    """Convert workouts' ISO-string start_time / end_time to BSON dates."""
+    await ensure_indexes()
+    query = {"$or": [{"start_time": {"$type": "string"}}, {"end_time": {"$type": "string"}}]}
+    last_id = None
+    scanned = converted = unparseable = 0
+    started = time.perf_counter()
+
+    while True:
+        batch_query = dict(query)
+        if last_id is not None:
+            batch_query["_id"] = {"$gt": last_id}
+        batch = await workouts_collection.find(
+            batch_query, {"start_time": 1, "end_time": 1, "user_id": 1}
+        ).sort("_id", 1).limit(batch_size).to_list(None)
+        if not batch:
+            break
+
+        ops = []
+        for w in batch:
+            match = {"_id": w["_id"]}
+            fields = {}
+            for field in ("start_time", "end_time"):
+                if not isinstance(w.get(field), str):
+                    continue
+                try:
+                    fields[field] = parse_utc(w[field])
+                except ValueError:
+                    unparseable += 1
+                    continue
+                # Only replace the exact string read, so a concurrent write always wins
+                match[field] = w[field]
+            if fields:
+                ops.append(UpdateOne(match, {"$set": fields}))
+
+        if ops:
+            result = await workouts_collection.bulk_write(ops, ordered=False)
+            converted += result.modified_count
+            await response_cache.bump(*{w["user_id"] for w in batch if w.get("user_id")})
+
+        scanned += len(batch)
+        last_id = batch[-1]["_id"]
+        print(f"  scanned {scanned}, converted {converted}")
+
+    elapsed = time.perf_counter() - started
+    print(f"Done: converted {converted}/{scanned} workouts in {elapsed:.1f}s ({unparseable} unparseable timestamps left as-is)")
+
+
+async def backfill_local_days(batch_size: int):
+    """Stamp local_day on workouts saved before users had timezones.
+
+    Uses each user's current timezone. Needs BSON end_time dates, so run
+    backfill-dates first, and rebuild-rollups afterwards to move the rollups
+    onto local days.
+    """
+    last_id = None
+    users = stamped = 0
+    started = time.perf_counter()
+
+    while True:
+        batch_query = {} if last_id is None else {"_id": {"$gt": last_id}}
+        batch = await users_collection.find(
+            batch_query, {"timezone": 1}
+        ).sort("_id", 1).limit(batch_size).to_list(None)
+        if not batch:
+            break
+
+        for user in batch:
+            # An update pipeline lets the server do the timezone conversion in place
+            result = await workouts_collection.update_many(
+                {"user_id": str(user["_id"]), "local_day": {"$exists": False}, "end_time": {"$type": "date"}},
+                [{"$set": {"local_day": {"$dateToString": {
+                    "format": "%Y-%m-%d", "date": "$end_time", "timezone": user.get("timezone") or "UTC"
+                }}}}]
+            )
+            stamped += result.modified_count
+        await response_cache.bump(*(str(u["_id"]) for u in batch))
+
+        users += len(batch)
+        last_id = batch[-1]["_id"]
+        print(f"  {users} users, stamped {stamped} workouts")
+
+    elapsed = time.perf_counter() - started
+    print(f"Done: stamped local_day on {stamped} workouts for {users} users in {elapsed:.1f}s")
+
+
+ACHIEVEMENT_USER_FIELDS = {
+    "total_workouts": 1, "total_burn_points": 1, "streak_days": 1, "daily_burn_target": 1, "timezone": 1
+}
+ACHIEVEMENT_WORKOUT_FIELDS = dict(ROLLUP_FIELDS, duration_seconds=1, user_id=1, _id=0)
+
+
+def evaluate_user_chunk(chunk: list) -> list:
+    """[(user_id, new achievement ids)] for [(user, workouts, unlocked_ids)]; runs in a worker process."""
+    return [(str(user["_id"]), history_achievement_ids(user, workouts, unlocked)) for user, workouts, unlocked in chunk]
+
+
+async def load_achievement_inputs(users: list) -> list:
+    """(user, workouts, unlocked_ids) for a batch of users, streaming their workouts and unlocks."""
+    user_ids = [str(u["_id"]) for u in users]
+    workouts = {user_id: [] for user_id in user_ids}
+    unlocked = {user_id: set() for user_id in user_ids}
+    async for w in workouts_collection.find({"user_id": {"$in": user_ids}}, ACHIEVEMENT_WORKOUT_FIELDS):
+        workouts[w["user_id"]].append(w)
+    async for a in achievements_collection.find({"user_id": {"$in": user_ids}}, {"user_id": 1, "achievement_id": 1}):
+        unlocked[a["user_id"]].add(a["achievement_id"])
+    return [(u, workouts[str(u["_id"])], unlocked[str(u["_id"])]) for u in users]
+
+
+async def write_unlocks(earned: list) -> int:
+    """Insert a batch's unlocks in one write and credit the users' XP for them; returns the count."""
+    now = datetime.now(timezone.utc).isoformat()
+    docs = [
+        {"user_id": user_id, "achievement_id": achievement_id, "unlocked_at": now, "xp_credited": False}
+        for user_id, ids in earned for achievement_id in ids
+    ]
+    if not docs:
+        return 0
+    inserted = await insert_unlocks(docs)
+    await credit_unlocks([user_id for user_id, _ in earned])
+    return len(inserted)
+
+
+async def backfill_achievements(batch_size: int, workers: int, restart: bool):
+    """Evaluate every achievement against every user's full history and unlock what's missing.
+
+    Users are read in _id order through one cursor; each batch's workouts and
+    unlocks are streamed in, split across worker processes for evaluation,
+    and the new unlocks written in bulk. While a batch is evaluated the next
+    one is being read. The last finished user is checkpointed after every
+    batch, so a rerun resumes there; --restart starts from the beginning.
+    Unlocks are idempotent, so overlapping with live workouts is harmless.
+    """
+    await ensure_indexes()
+    checkpoint_id = "backfill-achievements"
+    checkpoint = None if restart else await maintenance_checkpoints_collection.find_one({"_id": checkpoint_id})
+    last_id = checkpoint["last_user_id"] if checkpoint else None
+    if last_id is not None:
+        print(f"Resuming after user {last_id}")
+
+    query = {} if last_id is None else {"_id": {"$gt": last_id}}
+    cursor = users_collection.find(query, ACHIEVEMENT_USER_FIELDS).sort("_id", 1).batch_size(batch_size)
+    users = unlocked = 0
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+
+    async def next_batch():
+        batch = []
+        async for user in cursor:
+            batch.append(user)
+            if len(batch) == batch_size:
+                break
+        return await load_achievement_inputs(batch) if batch else []
+
+    # spawn, not fork, as for the API's scoring pool
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        inputs = await next_batch()
+        while inputs:
+            chunks = [inputs[i::workers] for i in range(workers)]
+            evaluated = asyncio.gather(*(
+                loop.run_in_executor(executor, evaluate_user_chunk, chunk) for chunk in chunks if chunk
+            ))
+            upcoming = asyncio.ensure_future(next_batch())
+            earned = [entry for results in await evaluated for entry in results if entry[1]]
+            unlocked += await write_unlocks(earned)
+
+            users += len(inputs)
+            last_id = inputs[-1][0]["_id"]
+            await maintenance_checkpoints_collection.update_one(
+                {"_id": checkpoint_id},
+                {"$set": {"last_user_id": last_id, "updated_at": datetime.now(timezone.utc)}},
+                upsert=True
+            )
+            elapsed = time.perf_counter() - started
+            print(f"  {users} users, unlocked {unlocked} ({users / elapsed:.0f} users/s)")
+            inputs = await upcoming
+
+    await maintenance_checkpoints_collection.delete_one({"_id": checkpoint_id})
+    elapsed = time.perf_counter() - started
+    print(f"Done: unlocked {unlocked} achievements for {users} users in {elapsed:.1f}s ({users / max(elapsed, 1e-9):.0f} users/s)")
+
+
+async def dedupe_achievements(batch_size: int):
+    """Delete repeated unlocks of the same achievement, keeping the earliest, then build the indexes.
+
+    Duplicates can only exist from before the unique (user_id, achievement_id)
+    index, which fails to build while they remain. XP is left as credited.
+    """
+    pipeline = [
+        {"$sort": {"unlocked_at": 1, "_id": 1}},
+        {"$group": {"_id": {"user_id": "$user_id", "achievement_id": "$achievement_id"}, "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ]
+    removed = 0
+    extra = []
+    user_ids = set()
+    async for group in achievements_collection.aggregate(pipeline, allowDiskUse=True):
+        extra.extend(group["ids"][1:])
+        user_ids.add(group["_id"]["user_id"])
+        if len(extra) >= batch_size:
+            removed += (await achievements_collection.delete_many({"_id": {"$in": extra}})).deleted_count
+            await response_cache.bump(*user_ids)
+            print(f"  removed {removed} duplicate unlocks")
+            extra = []
+            user_ids = set()
+    if extra:
+        removed += (await achievements_collection.delete_many({"_id": {"$in": extra}})).deleted_count
+        await response_cache.bump(*user_ids)
+
+    failed = await ensure_indexes()
+    print(f"Done: removed {removed} duplicate unlocks; {failed} index(es) could not be built")
+
+
+PERSONAL_BEST_WORKOUT_FIELDS = dict(ROLLUP_FIELDS, duration_seconds=1, target_hit=1, user_id=1, _id=0)
+
+
+async def rebuild_personal_bests(user_id: str, batch_size: int):
+    """Recompute personal bests, including the longest streak, from workout history.
+
+    Replaces each user's document outright, so bests that drifted (or were
+    never recorded, like longest_streak before it was tracked) come out
+    exact, and dates still stored as ISO strings become BSON dates. A workout saved for a user while their batch is being rebuilt
+    can be missed; run the command again for that user if so.
+    """
+    query = {"_id": ObjectId(user_id)} if user_id else {}
+    last_id = None
+    users = 0
+    started = time.perf_counter()
+
+    while True:
+        batch_query = dict(query)
+        if last_id is not None:
+            batch_query["_id"] = {"$gt": last_id}
+        batch = await users_collection.find(
+            batch_query, {"streak_days": 1, "timezone": 1}
+        ).sort("_id", 1).limit(batch_size).to_list(None)
+        if not batch:
+            break
+
+        user_ids = [str(u["_id"]) for u in batch]
+        workouts = {uid: [] for uid in user_ids}
+        async for w in workouts_collection.find({"user_id": {"$in": user_ids}}, PERSONAL_BEST_WORKOUT_FIELDS):
+            workouts[w["user_id"]].append(w)
+
+        await personal_bests_collection.bulk_write([
+            ReplaceOne({"user_id": str(u["_id"])}, personal_bests_from_history(u, workouts[str(u["_id"])]), upsert=True)
+            for u in batch
+        ], ordered=False)
+        await response_cache.bump(*user_ids)
+
+        users += len(batch)
+        last_id = batch[-1]["_id"]
+        elapsed = time.perf_counter() - started
+        print(f"  rebuilt {users} users ({users / elapsed:.0f} users/s)")
+        if user_id:
+            break
+
+    elapsed = time.perf_counter() - started
+    print(f"Done: rebuilt personal bests for {users} users in {elapsed:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PulseFit backend maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    migrate = commands.add_parser("migrate-hr-samples", help="Pack raw hr_samples lists into binary")
+    migrate.add_argument("--batch-size", type=int, default=500)
+
+    rollups = commands.add_parser("rebuild-rollups", help="Regenerate daily/weekly/monthly rollups from workout history")
+    rollups.add_argument("--user-id", help="Only rebuild this user")
+    rollups.add_argument("--batch-size", type=int, default=200)
+
+    dates = commands.add_parser("backfill-dates", help="Store workout start/end times as BSON dates")
+    dates.add_argument("--batch-size", type=int, default=1000)
+
+    local_days = commands.add_parser("backfill-local-days", help="Stamp local_day on workouts from before timezones")
+    local_days.add_argument("--batch-size", type=int, default=200)
+
+    achievements = commands.add_parser("backfill-achievements", help="Unlock achievements earned by existing history")
+    achievements.add_argument("--batch-size", type=int, default=200)
+    achievements.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Evaluation processes")
+    achievements.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start from the first user")
+
+    dedupe = commands.add_parser("dedupe-achievements", help="Remove duplicate unlocks so the unique index can be built")
+    dedupe.add_argument("--batch-size", type=int, default=1000)
+
+    bests = commands.add_parser("rebuild-personal-bests", help="Recompute personal bests from workout history")
+    bests.add_argument("--user-id", help="Only rebuild this user")
+    bests.add_argument("--batch-size", type=int, default=200)
+
+    args = parser.parse_args()
+
+    if args.command == "migrate-hr-samples":
+        asyncio.run(migrate_hr_samples(args.batch_size))
+    elif args.command == "rebuild-rollups":
+        asyncio.run(rebuild_rollups(args.user_id, args.batch_size))
+    elif args.command == "backfill-dates":
+        asyncio.run(backfill_dates(args.batch_size))
+    elif args.command == "backfill-local-days":
+        asyncio.run(backfill_local_days(args.batch_size))
+    elif args.command == "backfill-achievements":
+        asyncio.run(backfill_achievements(args.batch_size, max(args.workers, 1), args.restart))
+    elif args.command == "dedupe-achievements":
+        asyncio.run(dedupe_achievements(args.batch_size))
+    elif args.command == "rebuild-personal-bests":
+        asyncio.run(rebuild_personal_bests(args.user_id, args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
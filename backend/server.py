@@ -2,17 +2,25 @@
 PulseFit Backend - Heart Rate Zone Training API
 Full Feature Implementation with ElevenLabs Voice
 """
-from fastapi import FastAPI, HTTPException, Response, Depends, Security
+from fastapi import FastAPI, HTTPException, Request, Response, Depends, Security, WebSocket, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.encoders import jsonable_encoder
 from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError, field_serializer
 from typing import Optional, List, Dict, Any
 from datetime import datetime, timezone, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from motor.motor_asyncio import AsyncIOMotorClient
-from bson import ObjectId
+from bson import ObjectId, Binary
+from bson.errors import InvalidId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from contextlib import asynccontextmanager
 from elevenlabs import ElevenLabs, VoiceSettings
 from dotenv import load_dotenv
+import numpy as np
+import asyncio
 import os
 import uuid
 import random
@@ -22,12 +30,31 @@ import csv
 import base64
 import hashlib
 import struct
+import time
+import bisect
+import math
+import multiprocessing
+from collections import OrderedDict
+from sortedcontainers import SortedList
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from urllib.parse import urlparse, parse_qs, urlencode
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI(title="PulseFit API", version="2.1.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await ensure_indexes()
+    leaderboard_task = asyncio.create_task(weekly_leaderboard.run())
+    workout_outbox.start()
+    yield
+    await workout_outbox.stop()
+    leaderboard_task.cancel()
+    scoring_pool.shutdown()
+
+
+app = FastAPI(title="PulseFit API", version="2.1.0", lifespan=lifespan)
 
 # ElevenLabs client
 ELEVENLABS_API_KEY = os.environ.get("ELEVENLABS_API_KEY")
@@ -80,7 +107,7 @@ def require_owner(caller_uid: Optional[str], user_id: str):
 # MongoDB connection
 MONGO_URL = os.environ.get("MONGO_URL")
 DB_NAME = os.environ.get("DB_NAME", "pulsefit")
-client = AsyncIOMotorClient(MONGO_URL)
+client = AsyncIOMotorClient(MONGO_URL, tz_aware=True)
 db = client[DB_NAME]
 
 # Collections
@@ -90,8 +117,15 @@ settings_collection = db["settings"]
 templates_collection = db["templates"]
 achievements_collection = db["achievements"]
 personal_bests_collection = db["personal_bests"]
+daily_rollups_collection = db["daily_rollups"]
+weekly_rollups_collection = db["weekly_rollups"]
+monthly_rollups_collection = db["monthly_rollups"]
 discount_codes_collection = db["discount_codes"]
 code_redemptions_collection = db["code_redemptions"]
+workout_sessions_collection = db["workout_sessions"]
+leaderboard_scores_collection = db["leaderboard_scores"]
+workout_outbox_collection = db["workout_outbox"]
+maintenance_checkpoints_collection = db["maintenance_checkpoints"]
 
 
 # ===================== Models =====================
@@ -105,6 +139,7 @@ class UserCreate(BaseModel):
     max_hr: Optional[int] = None
     daily_burn_target: int = 12
     nd_mode: str = "standard"
+    timezone: str = "UTC"  # IANA name, e.g. "America/Denver"
 
 
 class UserResponse(BaseModel):
@@ -117,6 +152,7 @@ class UserResponse(BaseModel):
     max_hr: int
     daily_burn_target: int
     nd_mode: str
+    timezone: str = "UTC"
     xp: int
     level: int
     streak_days: int
@@ -136,6 +172,7 @@ class UserUpdate(BaseModel):
     max_hr: Optional[int] = None
     daily_burn_target: Optional[int] = None
     nd_mode: Optional[str] = None
+    timezone: Optional[str] = None
 
 
 class SensorySettings(BaseModel):
@@ -193,9 +230,26 @@ class WorkoutTemplate(BaseModel):
     category: str  # hiit, endurance, recovery, interval
 
 
-class WorkoutCreate(BaseModel):
+class SampleGap(BaseModel):
+    index: int  # Sample after which the stream paused
+    duration_ms: int = Field(ge=0)  # Actual time until the next sample
+
+
+class WorkoutSamples(BaseModel):
+    """Heart-rate samples, either as {timestamp, heart_rate} dicts or fixed-rate.
+
+    The fixed-rate form sends start_time, interval_ms and a plain list of
+    heart rates (0-255), plus any gaps where the interval was longer.
+    """
+    hr_samples: List[dict] = []
+    start_time: Optional[str] = None
+    interval_ms: Optional[int] = Field(default=None, gt=0)
+    heart_rates: Optional[List[int]] = None
+    gaps: List[SampleGap] = []
+
+
+class WorkoutCreate(WorkoutSamples):
     user_id: str
-    hr_samples: List[dict]
     duration_seconds: int
     notes: Optional[str] = None
     template_id: Optional[str] = None
@@ -212,8 +266,8 @@ class ZoneSummary(BaseModel):
 class WorkoutResponse(BaseModel):
     id: str
     user_id: str
-    start_time: str
-    end_time: str
+    start_time: datetime
+    end_time: datetime
     duration_seconds: int
     total_burn_points: int
     zones: List[ZoneSummary]
@@ -226,6 +280,11 @@ class WorkoutResponse(BaseModel):
     notes: Optional[str]
     template_name: Optional[str] = None
 
+    @field_serializer("start_time", "end_time")
+    def iso_time(self, value: datetime) -> str:
+        # The isoformat() form ("+00:00", microseconds) clients got when times were stored as strings
+        return as_utc(value).isoformat()
+
 
 class Achievement(BaseModel):
     id: str
@@ -252,6 +311,33 @@ class CustomTemplateCreate(BaseModel):
     segments: List[WorkoutSegment]
 
 
+class BulkWorkoutItem(WorkoutSamples):
+    duration_seconds: int
+    notes: Optional[str] = None
+    template_id: Optional[str] = None
+    end_time: Optional[str] = None  # When it finished; defaults to the last sample's timestamp
+
+
+class BulkWorkoutCreate(BaseModel):
+    user_id: str
+    workouts: List[BulkWorkoutItem]
+
+
+class WorkoutSessionCreate(BaseModel):
+    user_id: str
+    notes: Optional[str] = None
+    template_id: Optional[str] = None
+
+
+class WorkoutSessionSamples(BaseModel):
+    hr_samples: List[dict]
+
+
+class WorkoutSessionFinalize(BaseModel):
+    duration_seconds: Optional[int] = None  # Defaults to first-to-last sample span
+    notes: Optional[str] = None
+
+
 # ===================== Zone Engine =====================
 
 ZONES = {
@@ -415,48 +501,256 @@ def get_zone(heart_rate: int, max_hr: int) -> int:
         return 5
 
 
-def calculate_burn_points(hr_samples: List[dict], max_hr: int) -> tuple:
-    zone_seconds = {i: 0 for i in range(6)}
-    total_hr = 0
-    peak_hr = 0
-    
+# Lower %max_hr bound of zones 1-5, used to classify whole arrays at once
+ZONE_THRESHOLDS_PCT = np.array([ZONES[z]["min_pct"] for z in range(1, 6)], dtype=np.float64)
+
+
+class ZoneClassifier:
+    """Heart rate -> zone lookup compiled from one user's zone settings.
+
+    Thresholds are percentages of max_hr, or of heart-rate reserve
+    (max_hr - resting_hr) when use_karvonen is set. Integer heart rates are
+    classified with a precomputed table; the defaults reproduce get_zone.
+    """
+
+    def __init__(self, max_hr: int, resting_hr: int = 0, thresholds_pct=ZONE_THRESHOLDS_PCT, use_karvonen: bool = False):
+        self.max_hr = max_hr
+        self.resting_hr = resting_hr
+        self.thresholds_pct = np.sort(np.asarray(thresholds_pct, dtype=np.float64))
+        # Karvonen needs a positive reserve; otherwise fall back to plain %max_hr
+        self.use_karvonen = bool(use_karvonen) and max_hr > resting_hr
+        # Heart rates are uint8 (cleaned to 30-230), so 256 entries cover every
+        # reading whatever max_hr says; zones() clips anything above the table
+        self.table = self.classify(np.arange(256))
+
+    @classmethod
+    def from_settings(cls, user: dict, zone_settings: Optional[dict]) -> "ZoneClassifier":
+        try:
+            zs = ZoneSettings(**(zone_settings or {}))
+        except (TypeError, ValidationError):
+            # Stored before settings were validated; score with the default zones
+            zs = ZoneSettings()
+        thresholds = [ZONES[1]["min_pct"], zs.zone_1_max, zs.zone_2_max, zs.zone_3_max, zs.zone_4_max]
+        return cls(user["max_hr"], user.get("resting_hr", 0), thresholds, zs.use_karvonen)
+
+    def profile(self) -> dict:
+        """Plain-data form of the inputs, for snapshotting into a document."""
+        return {
+            "max_hr": self.max_hr,
+            "resting_hr": self.resting_hr,
+            "thresholds_pct": self.thresholds_pct.tolist(),
+            "use_karvonen": self.use_karvonen
+        }
+
+    def percent(self, hr):
+        if self.use_karvonen:
+            return ((hr - self.resting_hr) / (self.max_hr - self.resting_hr)) * 100
+        return (hr / self.max_hr) * 100
+
+    def classify(self, hr: np.ndarray) -> np.ndarray:
+        """Zone 0-5 for each heart rate by threshold search (works for any dtype)."""
+        if self.max_hr <= 0:
+            return np.zeros(len(hr), dtype=np.int64)
+        return np.searchsorted(self.thresholds_pct, self.percent(hr), side="right")
+
+    def zones(self, hr: np.ndarray) -> np.ndarray:
+        """Zone 0-5 for each heart rate, by table lookup for integer arrays."""
+        if hr.dtype.kind not in "iu":
+            return self.classify(hr)
+        return self.table[np.clip(hr, 0, len(self.table) - 1)]
+
+    def zone(self, hr: int) -> int:
+        return int(self.zones(np.array([hr]))[0])
+
+    def bpm_range(self, zone: int) -> tuple:
+        """Lowest and highest heart rate (bpm) that classify as `zone`."""
+        hits = np.flatnonzero(self.table == zone)
+        if len(hits) == 0:
+            return self.max_hr, self.max_hr
+        return int(hits[0]), min(int(hits[-1]), self.max_hr)
+
+
+class LRUCache:
+    """Bounded mapping that evicts the least recently used entry."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+ZONE_CLASSIFIER_CACHE_SIZE = int(os.environ.get("ZONE_CLASSIFIER_CACHE_SIZE", "10000"))
+zone_classifier_cache = LRUCache(ZONE_CLASSIFIER_CACHE_SIZE)
+
+
+async def get_zone_classifier(user: dict) -> ZoneClassifier:
+    """Compiled classifier for a loaded user document.
+
+    Cached per user and dropped by update_user / update_settings; the cached
+    entry is also rebuilt if the user's max_hr or resting_hr no longer match.
+    """
+    user_id = str(user["_id"])
+    classifier = zone_classifier_cache.get(user_id)
+    if (
+        classifier is None
+        or classifier.max_hr != user["max_hr"]
+        or classifier.resting_hr != user.get("resting_hr", 0)
+    ):
+        settings = await settings_collection.find_one({"user_id": user_id}, {"zone_settings": 1})
+        classifier = ZoneClassifier.from_settings(user, (settings or {}).get("zone_settings"))
+        zone_classifier_cache.set(user_id, classifier)
+    return classifier
+
+
+_EPOCH_AWARE = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_EPOCH_NAIVE = datetime(1970, 1, 1)
+_ONE_MICROSECOND = timedelta(microseconds=1)
+
+
+def parse_sample_times(hr_samples: List[dict]) -> tuple:
+    """Parse every sample timestamp exactly once.
+
+    Returns (times_us, valid, aware): int64 microseconds since the epoch, a
+    mask of samples whose timestamp parsed, and whether each one carried a
+    UTC offset (naive and aware datetimes cannot be subtracted from each other).
+    """
+    n = len(hr_samples)
+    times_us = np.zeros(n, dtype=np.int64)
+    valid = np.zeros(n, dtype=bool)
+    aware = np.zeros(n, dtype=bool)
+
     for i, sample in enumerate(hr_samples):
-        hr = sample.get("heart_rate", 0)
-        total_hr += hr
-        peak_hr = max(peak_hr, hr)
-        zone = get_zone(hr, max_hr)
-        
-        duration = 1
-        if i < len(hr_samples) - 1:
-            try:
-                t1 = datetime.fromisoformat(sample["timestamp"].replace("Z", "+00:00"))
-                t2 = datetime.fromisoformat(hr_samples[i+1]["timestamp"].replace("Z", "+00:00"))
-                duration = max(1, int((t2 - t1).total_seconds()))
-            except:
-                duration = 1
-        zone_seconds[zone] += duration
-    
+        try:
+            t = datetime.fromisoformat(sample["timestamp"].replace("Z", "+00:00"))
+        except Exception:
+            continue
+        if t.tzinfo is not None:
+            times_us[i] = (t - _EPOCH_AWARE) // _ONE_MICROSECOND
+            aware[i] = True
+        else:
+            times_us[i] = (t - _EPOCH_NAIVE) // _ONE_MICROSECOND
+        valid[i] = True
+
+    return times_us, valid, aware
+
+
+def sample_durations(times_us: np.ndarray, valid: np.ndarray, aware: np.ndarray) -> np.ndarray:
+    """Whole seconds each sample lasts, i.e. until the next sample (minimum 1).
+
+    Pairs where either timestamp is unusable, and the final sample, count as 1 second.
+    """
+    durations = np.ones(len(times_us), dtype=np.int64)
+    if len(times_us) < 2:
+        return durations
+
+    gaps = np.diff(times_us) // 1_000_000
+    usable = valid[:-1] & valid[1:] & (aware[:-1] == aware[1:])
+    durations[:-1] = np.where(usable, np.maximum(gaps, 1), 1)
+    return durations
+
+
+def summarize_zones(zone_seconds) -> tuple:
+    """Turn per-zone seconds (indexable 0-5) into (total_points, zone_summaries)."""
     total_points = 0
     zone_summaries = []
-    
+
     for zone_id in range(1, 6):
         zone_info = ZONES[zone_id]
-        minutes = zone_seconds[zone_id] // 60
-        points = minutes * zone_info["points"]
+        seconds = int(zone_seconds[zone_id])
+        points = (seconds // 60) * zone_info["points"]
         total_points += points
-        
+
         zone_summaries.append({
             "zone": zone_id,
             "name": zone_info["name"],
-            "duration_seconds": zone_seconds[zone_id],
+            "duration_seconds": seconds,
             "burn_points": points,
             "color": zone_info["color"]
         })
-    
-    avg_hr = total_hr // len(hr_samples) if hr_samples else 0
+
+    return total_points, zone_summaries
+
+
+def score_hr_arrays(hr: np.ndarray, durations: np.ndarray, classifier: ZoneClassifier) -> tuple:
+    """Score a session held as parallel heart-rate / duration arrays.
+
+    Returns (zone_seconds, total_hr, peak_hr) with zone_seconds as a length-6 int array.
+    """
+    if len(hr) == 0:
+        return np.zeros(6, dtype=np.int64), 0, 0
+    zones = classifier.zones(hr)
+    zone_seconds = np.bincount(zones, weights=durations, minlength=6).astype(np.int64)
+    total_hr = hr.sum().item()
+    peak_hr = max(0, hr.max().item())
+    return zone_seconds, total_hr, peak_hr
+
+
+def calculate_burn_points(hr_samples: List[dict], max_hr: int, classifier: Optional[ZoneClassifier] = None) -> tuple:
+    """Score a workout; zones follow `classifier` when given, else the default %max_hr zones."""
+    classifier = classifier or ZoneClassifier(max_hr)
+    n = len(hr_samples)
+    hr = np.array([sample.get("heart_rate", 0) for sample in hr_samples])
+    durations = sample_durations(*parse_sample_times(hr_samples))
+
+    zone_seconds, total_hr, peak_hr = score_hr_arrays(hr, durations, classifier)
+    total_points, zone_summaries = summarize_zones(zone_seconds)
+
+    avg_hr = total_hr // n if n else 0
     return total_points, zone_summaries, avg_hr, peak_hr
 
 
+def score_session_batch(tail: Optional[dict], times_ms: np.ndarray, hr: np.ndarray, classifier: ZoneClassifier) -> tuple:
+    """Zone seconds contributed by a batch appended to a live session.
+
+    A sample's duration is only known once the next one arrives, so the last
+    sample of every batch is carried over as the session `tail` ({"t": ms, "hr"})
+    and scored together with the following batch. Returns (zone_seconds, new_tail).
+    """
+    if tail is not None:
+        times_ms = np.concatenate(([tail["t"]], times_ms))
+        hr = np.concatenate(([tail["hr"]], hr))
+    durations = np.maximum(np.diff(times_ms) // 1000, 1)
+    zone_seconds, _, _ = score_hr_arrays(hr[:-1], durations, classifier)
+    return zone_seconds, {"t": int(times_ms[-1]), "hr": int(hr[-1])}
+
+
+def session_classifier(session: dict) -> ZoneClassifier:
+    """Classifier snapshotted when the session was opened."""
+    if "zone_profile" in session:
+        return ZoneClassifier(**session["zone_profile"])
+    return ZoneClassifier(session["max_hr"])
+
+
+def session_totals(session: dict) -> tuple:
+    """Close out a session's running totals in the same shape as calculate_burn_points."""
+    zone_seconds = list(session["zone_seconds"])
+    tail = session.get("tail")
+    if tail is not None:
+        zone_seconds[session_classifier(session).zone(tail["hr"])] += 1
+
+    total_points, zone_summaries = summarize_zones(zone_seconds)
+    n = session["sample_count"]
+    avg_hr = session["hr_sum"] // n if n else 0
+    return total_points, zone_summaries, avg_hr, session["peak_hr"]
+
+
 def calculate_calories(duration_seconds: int, avg_hr: int, weight_kg: float, age: int) -> int:
     duration_min = duration_seconds / 60
     calories = ((age * 0.2017) + (weight_kg * 0.09036) + (avg_hr * 0.6309) - 55.0969) * duration_min / 4.184
@@ -480,228 +774,1634 @@ def calculate_level(xp: int) -> int:
     return (xp // 100) + 1
 
 
-async def check_achievements(user_id: str, workout: dict = None):
-    """Check and unlock achievements for a user"""
-    user = await users_collection.find_one({"_id": ObjectId(user_id)})
-    if not user:
-        return []
-    
-    unlocked = []
-    user_achievements = await achievements_collection.find({"user_id": user_id}).to_list(None)
-    unlocked_ids = {a["achievement_id"] for a in user_achievements}
-    
-    for achievement in ACHIEVEMENTS:
-        if achievement["id"] in unlocked_ids:
+def zone_seconds(workout: dict, zone: int) -> int:
+    return next((z["duration_seconds"] for z in workout.get("zones", []) if z["zone"] == zone), 0)
+
+
+def workout_local_hour(user: dict, workout: dict) -> int:
+    return as_utc(workout["end_time"]).astimezone(user_zone(user)).hour
+
+
+# Achievement rules by requirement type. User rules compare one counter on the
+# user document with the threshold; workout rules test a single workout.
+# target_streak (consecutive days whose total hit the daily target) isn't stored:
+# callers derive it from daily totals with longest_day_run before evaluating.
+USER_RULE_FIELDS = {
+    "workouts": "total_workouts",
+    "streak": "streak_days",
+    "total_points": "total_burn_points",
+    "target_streak": "target_streak"
+}
+WORKOUT_RULE_CHECKS = {
+    "peak_minutes": lambda threshold, user, w: zone_seconds(w, 5) >= threshold * 60,
+    "duration_minutes": lambda threshold, user, w: w.get("duration_seconds", 0) >= threshold * 60,
+    "all_zones": lambda threshold, user, w: sum(1 for z in w.get("zones", []) if z["duration_seconds"] > 0) >= 5,
+    "before_hour": lambda threshold, user, w: workout_local_hour(user, w) < threshold,
+    "after_hour": lambda threshold, user, w: workout_local_hour(user, w) >= threshold,
+}
+
+
+def compile_achievement_rules(achievements: List[dict]) -> Dict[str, List[tuple]]:
+    """Requirement type -> [(threshold, achievement)] sorted by threshold."""
+    rules = {}
+    for achievement in achievements:
+        (req_type, threshold), = achievement["requirement"].items()
+        rules.setdefault(req_type, []).append((threshold, achievement))
+    for entries in rules.values():
+        entries.sort(key=lambda entry: entry[0])
+    return rules
+
+
+ACHIEVEMENT_RULES = compile_achievement_rules(ACHIEVEMENTS)
+ACHIEVEMENT_ORDER = {a["id"]: i for i, a in enumerate(ACHIEVEMENTS)}
+ACHIEVEMENT_XP = {a["id"]: a["xp_reward"] for a in ACHIEVEMENTS}
+# What a newly saved workout can change; "streak" is added when the streak moved
+WORKOUT_CHANGED_RULES = {"workouts", "total_points", "target_streak", *WORKOUT_RULE_CHECKS}
+# Longest target_streak any rule asks for, i.e. how far around a day to look
+TARGET_STREAK_SPAN = max((threshold for threshold, _ in ACHIEVEMENT_RULES.get("target_streak", [])), default=1)
+
+
+def longest_day_run(days: List[str]) -> int:
+    """Longest run of consecutive calendar days among YYYY-MM-DD strings."""
+    longest = run = 0
+    previous = None
+    for day in sorted(set(days)):
+        run = run + 1 if previous and add_days(previous, 1) == day else 1
+        longest = max(longest, run)
+        previous = day
+    return longest
+
+
+def achievement_earned(requirement: dict, user: dict, workout: Optional[dict]) -> bool:
+    """Whether a single achievement requirement is met by the user's totals or one workout."""
+    (req_type, threshold), = requirement.items()
+    if req_type in USER_RULE_FIELDS:
+        return user.get(USER_RULE_FIELDS[req_type], 0) >= threshold
+    check = WORKOUT_RULE_CHECKS.get(req_type)
+    return bool(workout and check and check(threshold, user, workout))
+
+
+def evaluate_achievements(
+    user: dict, workouts: List[dict], unlocked_ids: set, changed: Optional[set] = None
+) -> List[dict]:
+    """Achievements newly earned by the user's current totals or any of the given workouts.
+
+    `changed` limits the check to the requirement types whose inputs changed;
+    None checks them all. Counter rules are sorted by threshold, so the met
+    ones are a prefix found by bisection.
+    """
+    earned = []
+    for req_type, rules in ACHIEVEMENT_RULES.items():
+        if changed is not None and req_type not in changed:
             continue
-            
-        req = achievement["requirement"]
-        earned = False
+        if req_type in USER_RULE_FIELDS:
+            value = user.get(USER_RULE_FIELDS[req_type], 0)
+            met = rules[:bisect.bisect_right(rules, value, key=lambda entry: entry[0])]
+        elif req_type in WORKOUT_RULE_CHECKS:
+            check = WORKOUT_RULE_CHECKS[req_type]
+            met = [rule for rule in rules if any(check(rule[0], user, w) for w in workouts)]
+        else:
+            continue
+        earned.extend(achievement for _, achievement in met if achievement["id"] not in unlocked_ids)
+    return sorted(earned, key=lambda a: ACHIEVEMENT_ORDER[a["id"]])
+
+
+def history_achievement_ids(user: dict, workouts: List[dict], unlocked_ids: set) -> List[str]:
+    """Ids of achievements the user's whole workout history earns that aren't unlocked yet.
+
+    Runs in batch jobs' worker processes, so it takes and returns plain data.
+    """
+    target = user.get("daily_burn_target", 12)
+    hit_days = [day for day, totals in rollup_increments(workouts).items() if totals["points"] >= target]
+    user = dict(user, target_streak=longest_day_run(hit_days))
+    return [a["id"] for a in evaluate_achievements(user, workouts, unlocked_ids)]
+
+
+def xp_credit(amount: int) -> List[dict]:
+    """Update pipeline adding XP, with the level following it (calculate_level) in the same write.
+
+    Also raises the user's cache_version, like every user write.
+    """
+    xp = {"$add": [{"$ifNull": ["$xp", 0]}, amount]}
+    return [{"$set": {
+        "xp": xp,
+        "level": {"$add": [{"$toInt": {"$floor": {"$divide": [xp, 100]}}}, 1]},
+        "cache_version": {"$add": [{"$ifNull": ["$cache_version", 0]}, 1]}
+    }}]
+
+
+async def insert_unlocks(docs: List[dict]) -> List[dict]:
+    """Insert unlock records in one unordered write; returns the ones that weren't there already.
+
+    The unique (user_id, achievement_id) index turns a concurrent or repeated
+    unlock into a skipped insert.
+    """
+    try:
+        await achievements_collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(err.get("code") != 11000 for err in errors):
+            raise
+        duplicates = {err["index"] for err in errors}
+        docs = [doc for i, doc in enumerate(docs) if i not in duplicates]
+    return docs
+
+
+async def credit_unlocks(user_ids: List[str]):
+    """Credit the XP of the users' unlocks still marked xp_credited: false, exactly once.
+
+    Each user's credit records the unlock ids in credited_unlocks in the same
+    write, and only matches if none of them is there yet; unlocks are then
+    flipped to credited if their id reached the user. The list is kept apart
+    from the workout events' applied_events so neither pushes the other out. An unlock credited
+    before a crash, but not flipped, is flipped on the next pass instead of
+    being credited again.
+    """
+    for _ in range(3):
+        pending = {}
+        async for unlock in achievements_collection.find(
+            {"user_id": {"$in": user_ids}, "xp_credited": False}, {"user_id": 1, "achievement_id": 1}
+        ):
+            pending.setdefault(unlock["user_id"], []).append(unlock)
+        if not pending:
+            return
         
-        # Check different requirement types
-        if "workouts" in req and user.get("total_workouts", 0) >= req["workouts"]:
-            earned = True
-        elif "streak" in req and user.get("streak_days", 0) >= req["streak"]:
-            earned = True
-        elif "total_points" in req and user.get("total_burn_points", 0) >= req["total_points"]:
-            earned = True
-        elif workout:
-            if "peak_minutes" in req:
-                peak_zone = next((z for z in workout.get("zones", []) if z["zone"] == 5), None)
-                if peak_zone and peak_zone["duration_seconds"] >= req["peak_minutes"] * 60:
-                    earned = True
-            elif "duration_minutes" in req and workout.get("duration_seconds", 0) >= req["duration_minutes"] * 60:
-                earned = True
-            elif "all_zones" in req:
-                zones_hit = [z for z in workout.get("zones", []) if z["duration_seconds"] > 0]
-                if len(zones_hit) >= 5:
-                    earned = True
-            elif "before_hour" in req:
-                workout_hour = datetime.fromisoformat(workout["end_time"].replace("Z", "+00:00")).hour
-                if workout_hour < req["before_hour"]:
-                    earned = True
-            elif "after_hour" in req:
-                workout_hour = datetime.fromisoformat(workout["end_time"].replace("Z", "+00:00")).hour
-                if workout_hour >= req["after_hour"]:
-                    earned = True
+        ops = []
+        for user_id, unlocks in pending.items():
+            ids = [u["_id"] for u in unlocks]
+            credited = {"$concatArrays": [{"$ifNull": ["$credited_unlocks", []]}, ids]}
+            ops.append(UpdateOne(
+                {"_id": ObjectId(user_id), "credited_unlocks": {"$nin": ids}},
+                xp_credit(sum(ACHIEVEMENT_XP[u["achievement_id"]] for u in unlocks))
+                + [{"$set": {"credited_unlocks": {"$slice": [credited, -APPLIED_EVENTS_KEPT]}}}]
+            ))
+        await users_collection.bulk_write(ops, ordered=False)
         
-        if earned:
-            await achievements_collection.insert_one({
-                "user_id": user_id,
-                "achievement_id": achievement["id"],
-                "unlocked_at": datetime.now(timezone.utc).isoformat()
-            })
-            # Add XP
-            await users_collection.update_one(
-                {"_id": ObjectId(user_id)},
-                {"$inc": {"xp": achievement["xp_reward"]}}
-            )
-            unlocked.append(achievement)
-    
-    return unlocked
+        credited = []
+        async for user in users_collection.find(
+            {"_id": {"$in": [ObjectId(user_id) for user_id in pending]}}, {"credited_unlocks": 1}
+        ):
+            applied = set(user.get("credited_unlocks", []))
+            credited += [u["_id"] for u in pending[str(user["_id"])] if u["_id"] in applied]
+        await achievements_collection.update_many({"_id": {"$in": credited}}, {"$set": {"xp_credited": True}})
 
 
-async def update_personal_bests(user_id: str, workout: dict):
-    """Update personal bests after a workout"""
-    pb = await personal_bests_collection.find_one({"user_id": user_id})
-    
-    updates = {}
-    workout_points = workout.get("total_burn_points", 0)
-    workout_duration = workout.get("duration_seconds", 0)
-    peak_seconds = next((z["duration_seconds"] for z in workout.get("zones", []) if z["zone"] == 5), 0)
-    
-    if not pb:
-        pb = {"user_id": user_id}
-    
-    if workout_points > pb.get("max_session_points", 0):
-        updates["max_session_points"] = workout_points
-        updates["max_session_points_date"] = workout["end_time"]
-    
-    if workout_duration > pb.get("longest_workout_seconds", 0):
-        updates["longest_workout_seconds"] = workout_duration
-        updates["longest_workout_date"] = workout["end_time"]
+async def unlock_achievements(user_id: str, achievements: List[dict]) -> List[dict]:
+    """Record unlocks with one insert, then credit their XP (credit_unlocks).
+
+    Only what was inserted earns XP. Returns the achievements actually unlocked.
+    """
+    if not achievements:
+        return []
+    now = datetime.now(timezone.utc).isoformat()
+    inserted = await insert_unlocks([
+        {"user_id": user_id, "achievement_id": a["id"], "unlocked_at": now, "xp_credited": False}
+        for a in achievements
+    ])
+    inserted_ids = {doc["achievement_id"] for doc in inserted}
     
-    if peak_seconds > pb.get("longest_peak_seconds", 0):
-        updates["longest_peak_seconds"] = peak_seconds
-        updates["longest_peak_date"] = workout["end_time"]
+    # Also picks up unlocks a crashed earlier attempt inserted but never credited
+    await credit_unlocks([user_id])
+    return [a for a in achievements if a["id"] in inserted_ids]
+
+
+async def pending_achievements(user: dict, workouts: List[dict], changed: Optional[set] = None) -> List[dict]:
+    """Achievements the user (as already updated) and the given workouts earn and don't have yet.
+
+    Rules are evaluated before touching the database; only the candidates'
+    unlock records are then looked up.
+    """
+    candidates = evaluate_achievements(user, workouts, set(), changed)
+    if not candidates:
+        return []
     
-    if updates:
-        await personal_bests_collection.update_one(
-            {"user_id": user_id},
-            {"$set": updates},
-            upsert=True
+    unlocked_ids = {
+        a["achievement_id"] async for a in achievements_collection.find(
+            {"user_id": str(user["_id"]), "achievement_id": {"$in": [c["id"] for c in candidates]}},
+            {"achievement_id": 1}
         )
-    
-    return updates
+    }
+    return [c for c in candidates if c["id"] not in unlocked_ids]
 
 
-# ===================== API Endpoints =====================
+# Personal bests are running maxima, each stored with the date it was set:
+# (value field, date field, a workout's value). Zone 5 is longest_peak_seconds.
+# longest_streak / longest_streak_date come from the user's streak instead.
+PERSONAL_BEST_FIELDS = [
+    ("max_session_points", "max_session_points_date", lambda w: w.get("total_burn_points", 0)),
+    ("longest_workout_seconds", "longest_workout_date", lambda w: w.get("duration_seconds", 0)),
+    ("longest_peak_seconds", "longest_peak_date", lambda w: zone_seconds(w, 5)),
+    *((f"longest_zone{z}_seconds", f"longest_zone{z}_date", lambda w, z=z: zone_seconds(w, z)) for z in range(1, 5)),
+]
+PERSONAL_BEST_DATES = {
+    **{field: date_field for field, date_field, _ in PERSONAL_BEST_FIELDS},
+    "longest_streak": "longest_streak_date"
+}
 
-@app.get("/api/health")
-async def health_check():
-    return {"status": "healthy", "app": "PulseFit", "version": "2.0.0"}
 
+def personal_best_candidates(workouts: List[dict]) -> Dict[str, tuple]:
+    """Value field -> (best value, end_time of the first workout reaching it) across the workouts."""
+    best = {}
+    for workout in workouts:
+        for field, _, value_of in PERSONAL_BEST_FIELDS:
+            value = value_of(workout)
+            if value > best.get(field, (0, None))[0]:
+                best[field] = (value, workout["end_time"])
+    return best
 
-# ----- User Endpoints -----
 
-@app.post("/api/users", response_model=UserResponse)
-async def create_user(user: UserCreate):
-    max_hr = user.max_hr or (220 - user.age)
-    
-    user_doc = {
-        "name": user.name,
-        "age": user.age,
-        "weight_kg": user.weight_kg,
-        "height_cm": user.height_cm,
-        "resting_hr": user.resting_hr,
-        "max_hr": max_hr,
-        "daily_burn_target": user.daily_burn_target,
-        "nd_mode": user.nd_mode,
-        "xp": 0,
-        "level": 1,
-        "streak_days": 0,
-        "streak_freezes_available": 1,
-        "last_workout_date": None,
-        "total_burn_points": 0,
-        "total_workouts": 0,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
+def personal_best_pipeline(candidates: Dict[str, tuple], streak: Optional[tuple] = None) -> List[dict]:
+    """Update pipeline raising personal bests to the candidates in one atomic write.
+
+    Each field becomes the $max of its stored and candidate value, and its
+    date changes only when the candidate is strictly higher. Both are worked
+    out from the document as it was before the write (one $set stage), so
+    concurrent updates can't lose a best or pair it with the wrong date.
+    """
+    if streak is not None:
+        candidates = dict(candidates, longest_streak=streak)
     
-    result = await users_collection.insert_one(user_doc)
-    user_doc["id"] = str(result.inserted_id)
-    return UserResponse(**user_doc)
+    stage = {}
+    for field, (value, date) in candidates.items():
+        stored = {"$ifNull": [f"${field}", 0]}
+        date_field = PERSONAL_BEST_DATES[field]
+        stage[field] = {"$max": [stored, value]}
+        stage[date_field] = {"$cond": [{"$gt": [value, stored]}, {"$literal": date}, f"${date_field}"]}
+    return [{"$set": stage}]
 
 
-@app.get("/api/users/{user_id}", response_model=UserResponse)
-async def get_user(user_id: str, caller_uid: Optional[str] = Depends(verify_firebase_token)):
-    try:
-        user = await users_collection.find_one({"_id": ObjectId(user_id)})
-    except:
-        raise HTTPException(status_code=400, detail="Invalid user ID format")
+def personal_bests_from_history(user: dict, workouts: List[dict]) -> dict:
+    """Personal-bests fields recomputed from a user's whole history.
+
+    The longest streak replays advance_streak over the workouts, so streak
+    freezes aren't seen; it never reports less than the current streak.
+    Dates come out as UTC datetimes even from workouts still holding ISO strings.
+    """
+    workouts = sorted(workouts, key=lambda w: as_utc(w["end_time"]))
+    doc = {"user_id": str(user["_id"])}
+    for field, date_field in PERSONAL_BEST_DATES.items():
+        doc[field], doc[date_field] = 0, None
+    for field, (value, date) in personal_best_candidates(workouts).items():
+        doc[field], doc[PERSONAL_BEST_DATES[field]] = value, date
     
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+    streak, last_date = 0, None
+    longest, longest_at = 0, None
+    for w in workouts:
+        day = workout_day(w)
+        streak = advance_streak(streak, last_date, day, w.get("target_hit", False))
+        if streak > longest:
+            longest, longest_at = streak, w["end_time"]
+        if not last_date or day > last_date:
+            last_date = day
+    if user.get("streak_days", 0) > longest:
+        longest, longest_at = user["streak_days"], workouts[-1]["end_time"] if workouts else None
+    doc["longest_streak"], doc["longest_streak_date"] = longest, longest_at
+    for date_field in PERSONAL_BEST_DATES.values():
+        if doc[date_field] is not None:
+            doc[date_field] = as_utc(doc[date_field])
+    return doc
 
-    require_owner(caller_uid, user_id)
-    user["id"] = str(user["_id"])
-    # Ensure all fields exist with defaults
-    user.setdefault("streak_freezes_available", 1)
-    user.setdefault("total_burn_points", 0)
-    user.setdefault("total_workouts", 0)
-    return UserResponse(**user)
 
+# ===================== HR Sample Storage =====================
 
-@app.patch("/api/users/{user_id}", response_model=UserResponse)
-async def update_user(user_id: str, update: UserUpdate, caller_uid: Optional[str] = Depends(verify_firebase_token)):
-    require_owner(caller_uid, user_id)
-    update_data = {k: v for k, v in update.dict().items() if v is not None}
-    
-    if not update_data:
-        raise HTTPException(status_code=400, detail="No fields to update")
-    
-    if "age" in update_data and "max_hr" not in update_data:
-        update_data["max_hr"] = 220 - update_data["age"]
-    
-    try:
-        result = await users_collection.update_one(
-            {"_id": ObjectId(user_id)},
-            {"$set": update_data}
-        )
-    except:
-        raise HTTPException(status_code=400, detail="Invalid user ID format")
-    
-    if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    return await get_user(user_id)
+# Workouts store their samples as one BSON Binary instead of a list of dicts:
+#   header   <BqI  format version, first sample time (epoch ms), sample count
+#   offsets  <i4   n-1 deltas in ms between consecutive samples
+#   rates    u1    n heart rates
+# Workouts recorded through a live session hold a list of such blobs, one per batch.
+HR_SAMPLES_FORMAT_VERSION = 1
+_HR_PACK_HEADER = struct.Struct("<BqI")
 
 
-@app.post("/api/users/{user_id}/use-streak-freeze")
-async def use_streak_freeze(user_id: str, caller_uid: Optional[str] = Depends(verify_firebase_token)):
-    require_owner(caller_uid, user_id)
-    """Use a streak freeze to preserve streak"""
-    user = await users_collection.find_one({"_id": ObjectId(user_id)})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    freezes = user.get("streak_freezes_available", 0)
-    if freezes <= 0:
-        raise HTTPException(status_code=400, detail="No streak freezes available")
-    
-    await users_collection.update_one(
-        {"_id": ObjectId(user_id)},
-        {
-            "$inc": {"streak_freezes_available": -1},
-            "$set": {"last_workout_date": datetime.now(timezone.utc).strftime("%Y-%m-%d")}
-        }
-    )
-    
-    return {"success": True, "freezes_remaining": freezes - 1}
+def pack_hr_arrays(times_ms: np.ndarray, hr: np.ndarray) -> Binary:
+    """Pack parallel epoch-millisecond / heart-rate arrays into the v1 binary format."""
+    n = len(times_ms)
+    start_ms = int(times_ms[0]) if n else 0
+    header = _HR_PACK_HEADER.pack(HR_SAMPLES_FORMAT_VERSION, start_ms, n)
+    offsets = np.diff(times_ms).astype("<i4")
+    return Binary(header + offsets.tobytes() + hr.astype(np.uint8).tobytes())
 
 
-# ----- Settings Endpoints -----
+def hr_sample_arrays(hr_samples: List[dict]) -> Optional[tuple]:
+    """(times_ms, hr) arrays for {timestamp, heart_rate} dicts, or None if they can't be packed.
 
-@app.get("/api/users/{user_id}/settings")
-async def get_settings(user_id: str):
-    settings = await settings_collection.find_one({"user_id": user_id})
-    
-    if not settings:
-        return {
-            "user_id": user_id,
-            "sensory": {
-                "animation_level": 100,
-                "sound_level": 100,
-                "haptic_level": 100,
-                "transition_warnings": True,
-                "literal_labels": False
-            },
-            "voice_coach": {
-                "enabled": True,
-                "voice_selection": "default",
-                "speech_rate": "normal",
-                "volume": 80,
-                "min_gap_seconds": 15,
-                "zone_callouts": True,
-                "point_updates": "every_3",
+    Samples need a parseable timestamp, an integer heart rate in 0-255 and gaps
+    that fit in an int32 of milliseconds. Naive timestamps are taken to be UTC
+    and precision is reduced to milliseconds.
+    """
+    times_us, valid, _ = parse_sample_times(hr_samples)
+    if not valid.all():
+        return None
+
+    hr = np.array([sample.get("heart_rate", 0) for sample in hr_samples])
+    if len(hr) and (hr.dtype.kind not in "iu" or hr.min() < 0 or hr.max() > 255):
+        return None
+    hr = hr.astype(np.int64)
+
+    times_ms = times_us // 1000
+    offsets = np.diff(times_ms)
+    if len(offsets) and (offsets.min() < -2**31 or offsets.max() >= 2**31):
+        return None
+
+    return times_ms, hr
+
+
+def parse_utc(value: str) -> datetime:
+    """Parse an ISO-8601 timestamp, treating naive values as UTC."""
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def as_utc(value) -> datetime:
+    """A workout timestamp as an aware UTC datetime, whether stored as a BSON date or (pre-backfill) an ISO string."""
+    if isinstance(value, str):
+        return parse_utc(value)
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def fixed_rate_arrays(start_time: str, interval_ms: int, heart_rates: List[int], gaps: List[SampleGap]) -> tuple:
+    """(times_ms, hr) arrays for a fixed-rate payload, built without per-sample objects.
+
+    Raises ValueError if the payload can't be represented in the packed format.
+    """
+    start_ms = (parse_utc(start_time) - _EPOCH_AWARE) // timedelta(milliseconds=1)
+    hr = np.asarray(heart_rates, dtype=np.int64)
+    if len(hr) and (hr.min() < 0 or hr.max() > 255):
+        raise ValueError("heart_rates must be between 0 and 255")
+
+    offsets = np.full(max(len(hr) - 1, 0), interval_ms, dtype=np.int64)
+    for gap in gaps:
+        if not 0 <= gap.index < len(offsets):
+            raise ValueError(f"Gap index {gap.index} is outside the heart_rates list")
+        offsets[gap.index] = gap.duration_ms
+    if len(offsets) and offsets.max() >= 2**31:
+        raise ValueError("Sample intervals must be shorter than 24 days")
+
+    times_ms = np.empty(len(hr), dtype=np.int64)
+    if len(hr):
+        times_ms[0] = start_ms
+        np.cumsum(offsets, out=times_ms[1:])
+        times_ms[1:] += start_ms
+    return times_ms, hr
+
+
+def pack_hr_samples(hr_samples: List[dict]) -> Optional[Binary]:
+    """Pack {timestamp, heart_rate} dicts, or None if they can't be stored compactly."""
+    arrays = hr_sample_arrays(hr_samples)
+    if arrays is None:
+        return None
+    return pack_hr_arrays(*arrays)
+
+
+def unpack_hr_arrays(blob: bytes) -> tuple:
+    """Inverse of pack_hr_arrays: returns (times_ms int64, hr uint8)."""
+    version, start_ms, n = _HR_PACK_HEADER.unpack_from(blob)
+    if version != HR_SAMPLES_FORMAT_VERSION:
+        raise ValueError(f"Unsupported hr_samples format version {version}")
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+
+    offset = _HR_PACK_HEADER.size
+    deltas = np.frombuffer(blob, dtype="<i4", count=n - 1, offset=offset)
+    hr = np.frombuffer(blob, dtype=np.uint8, count=n, offset=offset + 4 * (n - 1))
+
+    times_ms = np.empty(n, dtype=np.int64)
+    times_ms[0] = start_ms
+    np.cumsum(deltas, dtype=np.int64, out=times_ms[1:])
+    times_ms[1:] += start_ms
+    return times_ms, hr
+
+
+def unpack_hr_samples(blob: bytes) -> List[dict]:
+    """Decode a packed blob back into the {timestamp, heart_rate} dicts clients expect."""
+    times_ms, hr = unpack_hr_arrays(blob)
+    timestamps = np.datetime_as_string(times_ms.astype("datetime64[ms]"), unit="ms", timezone="UTC")
+    return [
+        {"timestamp": t, "heart_rate": h}
+        for t, h in zip(timestamps.tolist(), hr.tolist())
+    ]
+
+
+def inflate_hr_samples(workout: dict) -> dict:
+    """Replace stored packed blob(s) with the decoded sample list, in place."""
+    packed = workout.pop("hr_samples_packed", None)
+    if packed is not None:
+        chunks = packed if isinstance(packed, list) else [packed]
+        workout["hr_samples"] = [sample for chunk in chunks for sample in unpack_hr_samples(chunk)]
+    return workout
+
+
+# ===================== HR Signal Cleaning =====================
+
+# Uploaded samples are cleaned once, before scoring, into a 1 Hz series:
+# sorted, de-duplicated, with sensor dropouts (0), saturation (255) and
+# single-sample spikes removed. Gaps up to HR_FILL_GAP_CADENCES times the
+# stream's own sampling interval (and never less than HR_MAX_FILL_GAP_MS) are
+# interpolated; longer ones are real dropouts, left empty so they count for nothing.
+# The interval is capped at HR_MAX_CADENCE_MS so a handful of far-apart readings
+# can't stretch the fill limit (and the grid) without bound.
+HR_GRID_MS = 1000
+HR_VALID_MIN = 30
+HR_VALID_MAX = 230
+HR_SPIKE_BPM = 35
+HR_MAX_FILL_GAP_MS = int(os.environ.get("HR_MAX_FILL_GAP_SECONDS", "10")) * 1000
+HR_FILL_GAP_CADENCES = int(os.environ.get("HR_FILL_GAP_CADENCES", "3"))
+HR_MAX_CADENCE_MS = int(os.environ.get("HR_MAX_CADENCE_SECONDS", "60")) * 1000
+
+# Cleaning state carried between the batches of a live session:
+#   last_t      latest timestamp seen; later readings at or before it are dropped as duplicates
+#   left_hr     last in-range reading already judged, the left neighbour of the next one
+#   pending     last in-range reading, held back until its right neighbour arrives
+#   anchor      last accepted reading, the left end of the next interpolation
+#   next_t      next grid time of the current run
+#   cadence_ms  sampling interval of the stream
+HR_CLEAN_STATE = {"last_t": None, "left_hr": None, "pending": None, "anchor": None, "next_t": None, "cadence_ms": None}
+
+
+def loose_hr_arrays(hr_samples: List[dict]) -> tuple:
+    """(times_ms, hr) for {timestamp, heart_rate} dicts, skipping samples without a usable time or rate.
+
+    Naive timestamps are taken to be UTC.
+    """
+    times_us, valid, _ = parse_sample_times(hr_samples)
+    rates = np.array([
+        h if isinstance(h, (int, float)) and not isinstance(h, bool) else np.nan
+        for h in (sample.get("heart_rate") for sample in hr_samples)
+    ], dtype=np.float64)
+    keep = valid & np.isfinite(rates)
+    return times_us[keep] // 1000, np.rint(rates[keep]).astype(np.int64)
+
+
+def fill_gap_limit(cadence_ms: Optional[int]) -> int:
+    """Longest gap that is interpolated for a stream sampled every `cadence_ms`."""
+    return max(HR_MAX_FILL_GAP_MS, HR_FILL_GAP_CADENCES * min(cadence_ms or 0, HR_MAX_CADENCE_MS))
+
+
+def clean_hr_batch(
+    state: Optional[dict],
+    times_ms: np.ndarray,
+    hr: np.ndarray,
+    flush: bool = False,
+    cadence_ms: Optional[int] = None,
+    max_fill_gap_ms: Optional[int] = None,
+) -> tuple:
+    """Clean one batch of a stream onto the 1 Hz grid, carrying `state` (see HR_CLEAN_STATE) to the next batch.
+
+    A reading is judged against the median of itself and its neighbours, so the
+    last in-range reading of a batch waits for the next one; `flush` judges it
+    against itself at the end of the stream. `cadence_ms` is the declared
+    sampling interval; without it the median spacing of the first batch is used.
+
+    Returns (grid_ms, grid_hr, quality, new_state).
+    """
+    state = dict(state or HR_CLEAN_STATE)
+    raw_count = len(hr)
+    order = np.argsort(times_ms, kind="stable")
+    times_ms, hr = np.asarray(times_ms, dtype=np.int64)[order], np.asarray(hr, dtype=np.int64)[order]
+
+    # Retransmitted readings share a timestamp; keep the last one received
+    keep = np.ones(len(times_ms), dtype=bool)
+    keep[:-1] = times_ms[1:] != times_ms[:-1]
+    if state["last_t"] is not None:
+        keep &= times_ms > state["last_t"]
+    times_ms, hr = times_ms[keep], hr[keep]
+    duplicates = raw_count - len(hr)
+
+    if cadence_ms:
+        state["cadence_ms"] = int(cadence_ms)
+    elif state["cadence_ms"] is None:
+        spaced = times_ms if state["last_t"] is None else np.concatenate(([state["last_t"]], times_ms))
+        if len(spaced) > 1:
+            state["cadence_ms"] = int(np.median(np.diff(spaced)))
+    if len(times_ms):
+        state["last_t"] = int(times_ms[-1])
+    if max_fill_gap_ms is None:
+        max_fill_gap_ms = fill_gap_limit(state["cadence_ms"])
+
+    in_range = (hr >= HR_VALID_MIN) & (hr <= HR_VALID_MAX)
+    outliers = int((~in_range).sum())
+    times_ms, hr = times_ms[in_range], hr[in_range]
+    if state["pending"] is not None:
+        times_ms = np.concatenate(([state["pending"][0]], times_ms))
+        hr = np.concatenate(([state["pending"][1]], hr))
+
+    # Drop single-sample spikes: readings far from the median of their in-range neighbours
+    judged = len(hr) if flush else max(len(hr) - 1, 0)
+    if len(hr):
+        left = hr[0] if state["left_hr"] is None else state["left_hr"]
+        padded = np.concatenate(([left], hr, [hr[-1]]))
+        neighbourhood = np.median(np.stack((padded[:-2], padded[1:-1], padded[2:])), axis=0)
+        accepted = np.abs(hr - neighbourhood)[:judged] <= HR_SPIKE_BPM
+        outliers += judged - int(accepted.sum())
+        state["pending"] = None if flush else [int(times_ms[-1]), int(hr[-1])]
+        if judged:
+            state["left_hr"] = int(hr[judged - 1])
+        times_ms, hr = times_ms[:judged][accepted], hr[:judged][accepted]
+
+    if state["anchor"] is not None:
+        times_ms = np.concatenate(([state["anchor"][0]], times_ms))
+        hr = np.concatenate(([state["anchor"][1]], hr))
+
+    grid_ms = np.zeros(0, dtype=np.int64)
+    gaps = 0
+    if len(hr):
+        # Split into runs with no gap longer than the fill limit and lay a grid over each;
+        # a run carried over from the last batch resumes where its grid left off
+        breaks = np.flatnonzero(np.diff(times_ms) > max_fill_gap_ms) + 1
+        gaps = len(breaks)
+        starts = times_ms[np.concatenate(([0], breaks))]
+        ends = times_ms[np.concatenate((breaks - 1, [len(times_ms) - 1]))]
+        if state["anchor"] is not None:
+            starts[0] = state["next_t"]
+        counts = np.maximum((ends - starts) // HR_GRID_MS + 1, 0)
+        steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        grid_ms = np.repeat(starts, counts) + steps * HR_GRID_MS
+        state["anchor"] = [int(times_ms[-1]), int(hr[-1])]
+        state["next_t"] = int(starts[-1] + counts[-1] * HR_GRID_MS)
+
+    grid_hr = np.rint(np.interp(grid_ms, times_ms, hr)).astype(np.int64) if len(hr) else grid_ms.copy()
+    quality = {
+        "raw_samples": raw_count,
+        "duplicates": duplicates,
+        "outliers": outliers,
+        "gaps": gaps,
+        "clean_samples": len(grid_hr),
+    }
+    return grid_ms, grid_hr, quality, state
+
+
+def clean_hr_arrays(
+    times_ms: np.ndarray,
+    hr: np.ndarray,
+    max_fill_gap_ms: Optional[int] = None,
+    cadence_ms: Optional[int] = None,
+) -> tuple:
+    """Sort, de-duplicate, drop outliers and resample a whole upload onto a 1 Hz grid.
+
+    Returns (grid_ms, grid_hr, quality) where every grid point stands for one
+    second of recording and `quality` counts what was removed.
+    """
+    grid_ms, grid_hr, quality, _ = clean_hr_batch(
+        None, times_ms, hr, flush=True, cadence_ms=cadence_ms, max_fill_gap_ms=max_fill_gap_ms
+    )
+    return grid_ms, grid_hr, quality
+
+
+def calculate_burn_points_clean(hr: np.ndarray, classifier: ZoneClassifier) -> tuple:
+    """calculate_burn_points for a cleaned 1 Hz series, where every sample is one second."""
+    n = len(hr)
+    zone_seconds, total_hr, peak_hr = score_hr_arrays(hr, np.ones(n, dtype=np.int64), classifier)
+    total_points, zone_summaries = summarize_zones(zone_seconds)
+
+    avg_hr = total_hr // n if n else 0
+    return total_points, zone_summaries, avg_hr, peak_hr
+
+
+def clean_samples_field(
+    times_ms: np.ndarray, hr: np.ndarray, classifier: ZoneClassifier, cadence_ms: Optional[int] = None
+) -> tuple:
+    """Clean raw arrays and score them; returns (scores, samples_field) for the workout document."""
+    times_ms, hr, quality = clean_hr_arrays(times_ms, hr, cadence_ms=cadence_ms)
+    offsets = np.diff(times_ms)
+    if len(offsets) and offsets.max() >= 2**31:
+        raise ValueError("Samples must not span more than 24 days")
+    scores = calculate_burn_points_clean(hr, classifier)
+    return scores, {"hr_samples_packed": pack_hr_arrays(times_ms, hr), "hr_quality": quality}
+
+
+# ===================== Scoring Pool =====================
+
+# Cleaning and scoring a long session is pure CPU work that would otherwise
+# stall the event loop (and /api/health with it). Payloads of at least
+# SCORING_POOL_MIN_SAMPLES samples go to a bounded process pool; smaller ones
+# are scored inline, where the IPC round trip would cost more than it saves.
+# SCORING_POOL_WORKERS=0 scores everything inline.
+SCORING_POOL_WORKERS = int(os.environ.get("SCORING_POOL_WORKERS", str(min(2, os.cpu_count() or 1))))
+SCORING_POOL_MIN_SAMPLES = int(os.environ.get("SCORING_POOL_MIN_SAMPLES", "2000"))
+SCORING_POOL_MAX_PENDING = int(os.environ.get("SCORING_POOL_MAX_PENDING", str(4 * max(SCORING_POOL_WORKERS, 1))))
+
+
+def score_samples_job(hr_samples: List[dict], fixed_rate: Optional[tuple], classifier: ZoneClassifier) -> tuple:
+    """Clean and score one upload; `fixed_rate` holds fixed_rate_arrays' arguments for compact payloads.
+
+    Returns (scores, samples_field). Raises ValueError for samples that can't be stored.
+    """
+    if fixed_rate is None:
+        return clean_samples_field(*loose_hr_arrays(hr_samples), classifier)
+    # Declared gaps are dropouts; the declared interval is the stream's cadence
+    return clean_samples_field(*fixed_rate_arrays(*fixed_rate), classifier, cadence_ms=fixed_rate[1])
+
+
+def _timed_call(fn, *args) -> tuple:
+    """Run fn(*args) and return (result, seconds spent), measured where it actually ran."""
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+
+class ScoringPool:
+    """Bounded process pool for scoring jobs, with queue depth and execution-time counters."""
+    
+    def __init__(self, workers: int, min_samples: int, max_pending: int):
+        self.workers = workers
+        self.min_samples = min_samples
+        self.max_pending = max_pending
+        self.executor = None
+        self.slots = asyncio.Semaphore(max_pending)
+        self.waiting = 0
+        self.running = 0
+        self.stats = {mode: {"jobs": 0, "exec_ms_total": 0.0, "exec_ms_max": 0.0} for mode in ("inline", "pool")}
+        self.stats["pool"]["wait_ms_total"] = 0.0
+    
+    def _record(self, mode: str, exec_seconds: float):
+        stats = self.stats[mode]
+        stats["jobs"] += 1
+        stats["exec_ms_total"] += exec_seconds * 1000
+        stats["exec_ms_max"] = max(stats["exec_ms_max"], exec_seconds * 1000)
+    
+    def _executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            # spawn, not fork: forking a process that already runs the event loop and Mongo client threads isn't safe
+            self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self.executor
+    
+    async def run(self, fn, *args, size: int):
+        """fn(*args), in the pool when `size` samples is enough to be worth the round trip."""
+        if self.workers <= 0 or size < self.min_samples:
+            result, seconds = _timed_call(fn, *args)
+            self._record("inline", seconds)
+            return result
+        
+        queued = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        
+        self.running += 1
+        executor = self._executor()
+        try:
+            loop = asyncio.get_running_loop()
+            result, seconds = await loop.run_in_executor(executor, _timed_call, fn, *args)
+        except BrokenProcessPool:
+            logger.warning("Scoring pool worker died; rebuilding the pool and scoring inline")
+            # Release the broken pool's management thread and queued work; other jobs
+            # that failed with it may arrive after a replacement already started
+            executor.shutdown(wait=False, cancel_futures=True)
+            if self.executor is executor:
+                self.executor = None
+            result, seconds = _timed_call(fn, *args)
+            self._record("inline", seconds)
+            return result
+        finally:
+            self.running -= 1
+            self.slots.release()
+        
+        self._record("pool", seconds)
+        self.stats["pool"]["wait_ms_total"] += max(0.0, (time.perf_counter() - queued - seconds) * 1000)
+        return result
+    
+    def snapshot(self) -> dict:
+        """Current queue depth and cumulative timings, for the metrics endpoint."""
+        modes = {}
+        for mode, stats in self.stats.items():
+            jobs = stats["jobs"]
+            modes[mode] = dict(stats, exec_ms_avg=stats["exec_ms_total"] / jobs if jobs else 0.0)
+        pool = modes["pool"]
+        pool["wait_ms_avg"] = pool["wait_ms_total"] / pool["jobs"] if pool["jobs"] else 0.0
+        return {
+            "workers": self.workers,
+            "min_samples": self.min_samples,
+            "max_pending": self.max_pending,
+            "queue_depth": self.waiting + self.running,
+            "waiting": self.waiting,
+            "running": self.running,
+            **modes
+        }
+    
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+# Workers are started on first use and shut down with the app
+scoring_pool = ScoringPool(SCORING_POOL_WORKERS, SCORING_POOL_MIN_SAMPLES, SCORING_POOL_MAX_PENDING)
+
+
+# ===================== Transactions =====================
+
+# auto uses multi-document transactions when the deployment supports them
+# (replica set or sharded cluster); on a standalone mongod writes run in order
+# without one.
+MONGO_TRANSACTIONS = os.environ.get("MONGO_TRANSACTIONS", "auto").lower()
+_transactions_supported = None
+
+
+async def transactions_enabled() -> bool:
+    global _transactions_supported
+    if MONGO_TRANSACTIONS in ("on", "off"):
+        return MONGO_TRANSACTIONS == "on"
+    if _transactions_supported is None:
+        try:
+            hello = await client.admin.command("hello")
+        except Exception as e:
+            logger.warning(f"Could not detect transaction support: {e}")
+            return False
+        _transactions_supported = bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+    return _transactions_supported
+
+
+async def run_in_transaction(write):
+    """Await write(session) inside one transaction, or write(None) where transactions aren't available."""
+    if not await transactions_enabled():
+        return await write(None)
+    async with await client.start_session() as session:
+        async with session.start_transaction():
+            return await write(session)
+
+
+# Counter documents remember the last few events applied to them, so a retried
+# event doesn't count twice
+APPLIED_EVENTS_KEPT = int(os.environ.get("APPLIED_EVENTS_KEPT", "50"))
+
+
+async def upsert_once(collection, updates: List[tuple], event_id: ObjectId):
+    """Apply each (filter, update) upsert unless its document already applied event_id.
+
+    The filter skips documents holding the event, which turns the upsert into
+    an insert that fails on the unique key. That is also how a concurrent first
+    insert of the same document fails, so failed updates are tried once more:
+    by then the document exists, and a second failure means already applied.
+    """
+    for _ in range(2):
+        ops = [
+            UpdateOne(
+                dict(filter, applied_events={"$ne": event_id}),
+                dict(update, **{"$push": {"applied_events": {"$each": [event_id], "$slice": -APPLIED_EVENTS_KEPT}}}),
+                upsert=True
+            )
+            for filter, update in updates
+        ]
+        try:
+            await collection.bulk_write(ops, ordered=False)
+            return
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(err.get("code") != 11000 for err in errors):
+                raise
+            updates = [updates[err["index"]] for err in errors]
+
+
+# ===================== Daily Rollups =====================
+
+# One daily_rollups document per (user_id, day) holds that day's totals, so the
+# dashboard reads a handful of small documents instead of every workout:
+#   points, calories, workouts, zone_seconds {"1".."5": seconds}, target_hit
+# weekly_rollups and monthly_rollups hold the same totals (without target_hit)
+# per ISO week and calendar month, keyed by the bucket's first day, so long
+# ranges stay a few dozen reads. Days are the user's local calendar days, the
+# local_day stamped on each workout when it is saved (workouts from before
+# timezones existed count on their UTC day). Workout writes $inc all three levels;
+# `rebuild-rollups` in maintenance.py regenerates them from history.
+def index_specs() -> list:
+    """(collection, keys, options) for every index the API's queries rely on."""
+    specs = [
+        (collection, [("user_id", 1), ("day", 1)], {"unique": True})
+        for collection in ROLLUP_COLLECTIONS.values()
+    ]
+    specs += [
+        (workouts_collection, [("user_id", 1), ("end_time", -1), ("_id", -1)], {}),
+        (achievements_collection, [("user_id", 1), ("achievement_id", 1)], {"unique": True}),
+        (leaderboard_scores_collection, [("period", 1), ("user_id", 1)], {"unique": True}),
+        (leaderboard_scores_collection, [("period", 1), ("points", -1)], {}),
+        (leaderboard_scores_collection, [("period", 1), ("age_band", 1), ("points", -1)], {}),
+        (leaderboard_scores_collection, [("period", 1), ("updated_at", 1)], {}),
+        (workout_outbox_collection, [("status", 1), ("available_at", 1)], {}),
+        (workout_outbox_collection, [("status", 1), ("created_at", 1)], {}),
+        (workout_outbox_collection, "done_at", {"expireAfterSeconds": OUTBOX_RETENTION_DAYS * 86400}),
+    ]
+    return specs
+
+
+async def ensure_indexes() -> int:
+    """Create the indexes the API's queries rely on; safe to call on every start.
+
+    Each index is built on its own, so one that can't be (say, a unique index
+    over existing duplicates) doesn't stop the rest. Returns how many failed.
+    """
+    failed = 0
+    for collection, keys, options in index_specs():
+        try:
+            await collection.create_index(keys, **options)
+        except Exception as e:
+            failed += 1
+            logger.warning(f"Could not create index {keys} on {collection.name}: {e}")
+    return failed
+
+
+ROLLUP_COLLECTIONS = {
+    "day": daily_rollups_collection,
+    "week": weekly_rollups_collection,
+    "month": monthly_rollups_collection
+}
+
+
+def user_zone(user: dict) -> ZoneInfo:
+    """The user's IANA timezone, UTC when unset or unknown."""
+    try:
+        return ZoneInfo(user.get("timezone") or "UTC")
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo("UTC")
+
+
+def require_valid_timezone(name: str):
+    try:
+        ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise HTTPException(status_code=400, detail=f"Unknown timezone: {name}")
+
+
+def local_day(user: dict, when: datetime) -> str:
+    """The YYYY-MM-DD calendar day `when` falls on for the user."""
+    return as_utc(when).astimezone(user_zone(user)).strftime("%Y-%m-%d")
+
+
+def add_days(day: str, days: int) -> str:
+    return (datetime.strptime(day, "%Y-%m-%d") + timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+user_timezone_cache = LRUCache(ZONE_CLASSIFIER_CACHE_SIZE)
+
+
+async def user_today(user_id: str) -> str:
+    """Today in the user's timezone without loading the user.
+
+    Timezones are cached per process like zone classifiers, so cache keys for
+    date-relative responses cost no database read once warm.
+    """
+    name = user_timezone_cache.get(user_id)
+    if name is None:
+        user = None
+        if ObjectId.is_valid(user_id):
+            user = await users_collection.find_one({"_id": ObjectId(user_id)}, {"timezone": 1})
+        name = (user or {}).get("timezone") or "UTC"
+        user_timezone_cache.set(user_id, name)
+    return local_day({"timezone": name}, datetime.now(timezone.utc))
+
+
+def workout_day(workout: dict) -> str:
+    """The YYYY-MM-DD day a workout counts towards: its stored local_day, else its UTC day."""
+    return workout.get("local_day") or as_utc(workout["end_time"]).strftime("%Y-%m-%d")
+
+
+def rollup_increments(workouts: List[dict]) -> Dict[str, dict]:
+    """Per-day totals of a set of workouts, keyed by day."""
+    days = {}
+    for w in workouts:
+        totals = days.setdefault(workout_day(w), {
+            "points": 0, "calories": 0, "workouts": 0, "zone_seconds": {str(z): 0 for z in range(1, 6)}
+        })
+        totals["points"] += w.get("total_burn_points", 0)
+        totals["calories"] += w.get("calories_burned", 0)
+        totals["workouts"] += 1
+        for z in w.get("zones", []):
+            totals["zone_seconds"][str(z["zone"])] += z["duration_seconds"]
+    return days
+
+
+def bucket_start(day: str, unit: str) -> str:
+    """First day of the day/week/month bucket containing `day` (weeks start on Monday)."""
+    if unit == "month":
+        return day[:8] + "01"
+    if unit == "week":
+        date = datetime.strptime(day, "%Y-%m-%d")
+        return (date - timedelta(days=date.weekday())).strftime("%Y-%m-%d")
+    return day
+
+
+def coarser_rollups(days: Dict[str, dict], unit: str) -> Dict[str, dict]:
+    """Day totals from rollup_increments summed into week or month buckets, keyed by bucket start."""
+    buckets = {}
+    for day, totals in days.items():
+        bucket = buckets.setdefault(bucket_start(day, unit), {
+            "points": 0, "calories": 0, "workouts": 0, "zone_seconds": {str(z): 0 for z in range(1, 6)}
+        })
+        for field in ("points", "calories", "workouts"):
+            bucket[field] += totals[field]
+        for z, seconds in totals["zone_seconds"].items():
+            bucket["zone_seconds"][z] += seconds
+    return buckets
+
+
+def rollup_inc(totals: dict) -> dict:
+    return {
+        "points": totals["points"],
+        "calories": totals["calories"],
+        "workouts": totals["workouts"],
+        **{f"zone_seconds.{z}": seconds for z, seconds in totals["zone_seconds"].items()}
+    }
+
+
+def rollup_updates(user: dict, workouts: List[dict]) -> List[tuple]:
+    """(collection, [(filter, update)]) upserts adding workouts to their days', weeks' and months' rollups."""
+    user_id = str(user["_id"])
+    days = rollup_increments(workouts)
+    writes = [(ROLLUP_COLLECTIONS["day"], [
+        ({"user_id": user_id, "day": day}, {"$inc": rollup_inc(totals), "$setOnInsert": {"target_hit": False}})
+        for day, totals in days.items()
+    ])]
+    for unit in ("week", "month"):
+        writes.append((ROLLUP_COLLECTIONS[unit], [
+            ({"user_id": user_id, "day": start}, {"$inc": rollup_inc(totals)})
+            for start, totals in coarser_rollups(days, unit).items()
+        ]))
+    return writes
+
+
+async def apply_rollups(user: dict, workouts: List[dict], event_id: ObjectId):
+    """Add saved workouts to their rollups, once per outbox event."""
+    for collection, updates in rollup_updates(user, workouts):
+        if updates:
+            await upsert_once(collection, updates, event_id)
+    
+    # Once the day's total reaches the target it stays hit
+    await daily_rollups_collection.update_many(
+        {
+            "user_id": str(user["_id"]),
+            "day": {"$in": list({workout_day(w) for w in workouts})},
+            "target_hit": False,
+            "points": {"$gte": user["daily_burn_target"]}
+        },
+        {"$set": {"target_hit": True}}
+    )
+
+
+async def get_daily_rollups(user_id: str, start_day: str, end_day: Optional[str] = None) -> List[dict]:
+    """Rollups for days in [start_day, end_day), open-ended without end_day, oldest first."""
+    day_range = {"$gte": start_day}
+    if end_day is not None:
+        day_range["$lt"] = end_day
+    return await daily_rollups_collection.find(
+        {"user_id": user_id, "day": day_range}, {"_id": 0, "applied_events": 0}
+    ).sort("day", 1).to_list(None)
+
+
+# ===================== Response Cache =====================
+
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "5000"))
+CACHE_VERSION_INC = {"cache_version": 1}
+
+
+class UserResponseCache:
+    """Per-user cache of read-only GET responses, invalidated by version.
+
+    Every user document has a cache_version that every write path raises,
+    either with "$inc": {"cache_version": 1} in its own user update
+    (CACHE_VERSION_INC) or through bump() when it writes elsewhere. A response
+    is cached under (user, endpoint, params, version) and its ETag is derived
+    from that key, so a client that sends back the current ETag gets a 304
+    without the endpoint running at all. Reading the version is one projected
+    lookup of the user, and since it lives in the database, writes made by
+    other workers or by maintenance.py invalidate every process's entries.
+    Bumping orphans the user's old entries, which then age out of the LRU.
+    """
+
+    def __init__(self, maxsize: int):
+        self.entries = LRUCache(maxsize)
+
+    async def version(self, user_id: str) -> Optional[int]:
+        """The user's current cache_version, or None for an unknown or malformed user id."""
+        try:
+            user = await users_collection.find_one({"_id": ObjectId(user_id)}, {"cache_version": 1})
+        except InvalidId:
+            return None
+        return user.get("cache_version", 0) if user else None
+
+    async def bump(self, *user_ids: str):
+        """Invalidate the users' cached responses after writing something they depend on."""
+        ids = [ObjectId(user_id) for user_id in user_ids if ObjectId.is_valid(user_id)]
+        if ids:
+            await users_collection.update_many({"_id": {"$in": ids}}, {"$inc": CACHE_VERSION_INC})
+
+    async def serve(self, request: Request, user_id: str, endpoint: str, params: dict, compute):
+        """Return the cached response for this key, a 304, or compute() and cache it.
+
+        `params` must hold everything besides the user's own data that the
+        response depends on, including the current day for date-relative views.
+        Unknown users bypass the cache, leaving compute() to report the error.
+        """
+        version = await self.version(user_id)
+        if version is None:
+            return await compute()
+        
+        key = (user_id, endpoint, tuple(sorted(params.items())), version)
+        etag = '"' + hashlib.sha1(repr(key).encode()).hexdigest()[:20] + '"'
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        
+        if_none_match = request.headers.get("if-none-match", "")
+        if etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+            return Response(status_code=304, headers=headers)
+        
+        body = self.entries.get(key)
+        if body is None:
+            body = json.dumps(jsonable_encoder(await compute())).encode()
+            self.entries.set(key, body)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+
+response_cache = UserResponseCache(RESPONSE_CACHE_SIZE)
+
+
+# ===================== Leaderboards =====================
+
+LEADERBOARD_REFRESH_SECONDS = int(os.environ.get("LEADERBOARD_REFRESH_SECONDS", "60"))
+# Catch-up reads start this far before the newest updated_at already read, so
+# a write stamped just before it but committed just after that read isn't missed
+LEADERBOARD_SYNC_OVERLAP = timedelta(seconds=10)
+AGE_BANDS = [(0, 17, "under-18"), (18, 24, "18-24"), (25, 34, "25-34"), (35, 44, "35-44"),
+             (45, 54, "45-54"), (55, 64, "55-64"), (65, 200, "65+")]
+
+
+def age_band(age: int) -> str:
+    return next((band for low, high, band in AGE_BANDS if low <= age <= high), "65+")
+
+
+def leaderboard_period(when: datetime) -> str:
+    """ISO week a workout counts towards, e.g. '2024-W18' (weeks start Monday 00:00 UTC)."""
+    year, week, _ = as_utc(when).isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def next_period_start(now: datetime) -> datetime:
+    monday = (now - timedelta(days=now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+    return monday + timedelta(days=7)
+
+
+class RankedBoard:
+    """Users ordered by points, with O(log n) updates and rank lookups.
+
+    Keys are (-points, user_id) in a SortedList, so the list reads best first
+    and ties break on user_id. Ranks are competition ranks: users on equal
+    points share a rank.
+    """
+
+    def __init__(self):
+        self.order = SortedList()
+        self.points = {}
+
+    def set(self, user_id: str, points: int):
+        self.remove(user_id)
+        self.points[user_id] = points
+        self.order.add((-points, user_id))
+
+    def remove(self, user_id: str):
+        points = self.points.pop(user_id, None)
+        if points is not None:
+            self.order.remove((-points, user_id))
+
+    def rank_of_points(self, points: int) -> int:
+        # "" sorts before every user_id, so this counts users strictly ahead
+        return self.order.bisect_left((-points, "")) + 1
+
+    def rank(self, user_id: str) -> Optional[int]:
+        points = self.points.get(user_id)
+        return None if points is None else self.rank_of_points(points)
+
+    def top(self, n: int) -> List[tuple]:
+        return [(user_id, -neg) for neg, user_id in self.order[:n]]
+
+    def around(self, user_id: str, radius: int) -> List[tuple]:
+        points = self.points.get(user_id)
+        if points is None:
+            return []
+        i = self.order.index((-points, user_id))
+        return [(uid, -neg) for neg, uid in self.order[max(0, i - radius):i + radius + 1]]
+
+    def __len__(self):
+        return len(self.order)
+
+
+LEADERBOARD_PROJECTION = {"_id": 0, "applied_events": 0}
+
+
+class WeeklyLeaderboard:
+    """The current week's standings, kept in memory and backed by leaderboard_scores.
+
+    leaderboard_scores holds one document per (period, user) that workout
+    writes $inc, and is the source of truth for every week. This process keeps
+    the current week as a global RankedBoard plus one per age band. It loads
+    the week lazily and when the week rolls over; every
+    LEADERBOARD_REFRESH_SECONDS it only reads the documents whose updated_at
+    (stamped by the database on each write) is at or after the newest one it
+    has read, to pick up other workers' writes. Nothing is ever recomputed
+    from workouts.
+    """
+
+    def __init__(self):
+        self.period = None
+        self.boards = {}
+        self.members = {}
+        self.synced_to = None
+        self._lock = asyncio.Lock()
+
+    def apply(self, doc: dict):
+        """Place one leaderboard_scores document on the global and age band boards."""
+        user_id = doc["user_id"]
+        previous = self.members.get(user_id)
+        if previous and previous["age_band"] != doc["age_band"]:
+            self.boards[previous["age_band"]].remove(user_id)
+        self.members[user_id] = {"name": doc.get("name", ""), "age_band": doc["age_band"]}
+        self.boards["global"].set(user_id, doc["points"])
+        self.boards.setdefault(doc["age_band"], RankedBoard()).set(user_id, doc["points"])
+
+    async def load(self, period: str):
+        docs = await leaderboard_scores_collection.find({"period": period}, LEADERBOARD_PROJECTION).to_list(None)
+        self.period, self.boards, self.members, self.synced_to = period, {"global": RankedBoard()}, {}, None
+        self.apply_read(docs)
+    
+    async def sync(self):
+        """Apply the loaded week's documents changed since the last read (all of them if none had updated_at)."""
+        query = {"period": self.period}
+        if self.synced_to is not None:
+            query["updated_at"] = {"$gte": self.synced_to - LEADERBOARD_SYNC_OVERLAP}
+        self.apply_read(await leaderboard_scores_collection.find(query, LEADERBOARD_PROJECTION).to_list(None))
+    
+    def apply_read(self, docs: List[dict]):
+        """Apply documents read by load or sync and move the watermark to the newest of them.
+
+        record() applies single documents without moving it, since other
+        workers' writes stamped before its own may not have been read yet.
+        """
+        for doc in docs:
+            self.apply(doc)
+            if doc.get("updated_at") and (self.synced_to is None or doc["updated_at"] > self.synced_to):
+                self.synced_to = doc["updated_at"]
+
+    async def current(self) -> "WeeklyLeaderboard":
+        """Make sure the loaded week is this week, rolling over if it isn't."""
+        period = leaderboard_period(datetime.now(timezone.utc))
+        if self.period != period:
+            async with self._lock:
+                if self.period != period:
+                    await self.load(period)
+        return self
+
+    async def record(self, user: dict, workouts: List[dict], event_id: ObjectId):
+        """Add the workouts' points to their weeks' scores, once per outbox event."""
+        by_period = {}
+        for w in workouts:
+            period = leaderboard_period(w["end_time"])
+            by_period[period] = by_period.get(period, 0) + w["total_burn_points"]
+        
+        user_id = str(user["_id"])
+        details = {"name": user.get("name", ""), "age_band": age_band(user.get("age", 0))}
+        await upsert_once(leaderboard_scores_collection, [
+            (
+                {"period": period, "user_id": user_id},
+                {"$inc": {"points": points}, "$set": details, "$currentDate": {"updated_at": True}}
+            )
+            for period, points in by_period.items()
+        ], event_id)
+        
+        # Totals are set from the stored document, so a concurrent reload can't double count
+        if self.period in by_period:
+            doc = await leaderboard_scores_collection.find_one(
+                {"period": self.period, "user_id": user_id}, LEADERBOARD_PROJECTION
+            )
+            if doc:
+                self.apply(doc)
+    
+    async def run(self):
+        """Background task: catch up on a timer and roll over at the start of each week."""
+        while True:
+            now = datetime.now(timezone.utc)
+            delay = min(LEADERBOARD_REFRESH_SECONDS, (next_period_start(now) - now).total_seconds())
+            await asyncio.sleep(max(delay, 0) + 0.001)
+            try:
+                async with self._lock:
+                    period = leaderboard_period(datetime.now(timezone.utc))
+                    if self.period != period:
+                        await self.load(period)
+                    else:
+                        await self.sync()
+            except Exception as e:
+                logger.warning(f"Leaderboard refresh failed: {e}")
+
+    def entries(self, board: RankedBoard, rows: List[tuple]) -> List[dict]:
+        return [
+            {
+                "rank": board.rank_of_points(points),
+                "user_id": user_id,
+                "name": self.members.get(user_id, {}).get("name", ""),
+                "points": points
+            }
+            for user_id, points in rows
+        ]
+
+
+weekly_leaderboard = WeeklyLeaderboard()
+
+
+# ===================== Workout Outbox =====================
+
+# Saving a workout writes the user update, the workouts and one workout_outbox
+# event (in one transaction where available, see commit_workouts), then returns. In-process workers claim due events
+# and run each step below, recording it in steps_done as it finishes, so a
+# retried event resumes after the last completed step. Steps are safe to
+# repeat: unlocks hit the unique (user_id, achievement_id) index, personal
+# bests only ever raise values, and counter upserts skip documents that
+# already applied the event (upsert_once). A claim leases the event for
+# OUTBOX_LEASE_SECONDS, so events held by a crashed worker are picked up
+# again; failures back off exponentially and give up after
+# OUTBOX_MAX_ATTEMPTS with status "failed", which is kept for inspection.
+# Finished events expire after OUTBOX_RETENTION_DAYS.
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", "4"))
+OUTBOX_POLL_SECONDS = float(os.environ.get("OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_LEASE_SECONDS = int(os.environ.get("OUTBOX_LEASE_SECONDS", "60"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_MAX_BACKOFF_SECONDS = 300
+OUTBOX_RETENTION_DAYS = int(os.environ.get("OUTBOX_RETENTION_DAYS", "7"))
+
+
+async def target_streak_around(user_id: str, workouts: List[dict]) -> int:
+    """Longest run of target-hit days reachable from the workouts' days, read from daily rollups."""
+    days = [workout_day(w) for w in workouts]
+    hit = await daily_rollups_collection.find(
+        {
+            "user_id": user_id,
+            "day": {"$gte": add_days(min(days), 1 - TARGET_STREAK_SPAN), "$lte": add_days(max(days), TARGET_STREAK_SPAN - 1)},
+            "target_hit": True
+        },
+        {"day": 1}
+    ).to_list(None)
+    return longest_day_run([r["day"] for r in hit])
+
+
+async def unlock_step(user: dict, workouts: List[dict], event: dict):
+    changed = WORKOUT_CHANGED_RULES | ({"streak"} if event["streak_changed"] else set())
+    user_after = dict(
+        user,
+        streak_days=max(user.get("streak_days", 0), event["best_streak"]),
+        target_streak=await target_streak_around(str(user["_id"]), workouts) if workouts else 0
+    )
+    await unlock_achievements(str(user["_id"]), await pending_achievements(user_after, workouts, changed))
+
+
+async def personal_bests_step(user: dict, workouts: List[dict], event: dict):
+    await personal_bests_collection.update_one(
+        {"user_id": str(user["_id"])},
+        personal_best_pipeline(
+            personal_best_candidates(workouts), (event["best_streak"], event.get("best_streak_at"))
+        ),
+        upsert=True
+    )
+
+
+async def leaderboard_step(user: dict, workouts: List[dict], event: dict):
+    await weekly_leaderboard.record(user, workouts, event["_id"])
+
+
+async def user_step(user: dict, workouts: List[dict], event: dict):
+    """Apply the user delta a save left on its event, then clear it.
+
+    Events written in a transaction have no delta, and a save that updated the
+    user unsets it; one left behind means the save stopped in between, so the
+    user's applied_events tells whether its update landed. The streak and last
+    workout date only move forward, in case later workouts were saved since.
+    """
+    delta = event.get("user_delta")
+    if delta is None:
+        return
+    applied = {"$concatArrays": [{"$ifNull": ["$applied_events", []]}, [event["_id"]]]}
+    stored_date = {"$ifNull": ["$last_workout_date", ""]}
+    result = await users_collection.update_one(
+        {"_id": user["_id"], "applied_events": {"$ne": event["_id"]}},
+        xp_credit(delta["xp"]) + [{"$set": {
+            "total_burn_points": {"$add": [{"$ifNull": ["$total_burn_points", 0]}, delta["total_burn_points"]]},
+            "total_workouts": {"$add": [{"$ifNull": ["$total_workouts", 0]}, delta["total_workouts"]]},
+            "streak_days": {"$cond": [
+                {"$gte": [delta["last_workout_date"], stored_date]}, delta["streak_days"], "$streak_days"
+            ]},
+            "last_workout_date": {"$max": [stored_date, delta["last_workout_date"]]},
+            "applied_events": {"$slice": [applied, -APPLIED_EVENTS_KEPT]}
+        }}]
+    )
+    await workout_outbox_collection.update_one({"_id": event["_id"]}, {"$unset": {"user_delta": ""}})
+    if result.modified_count:
+        user.update(await users_collection.find_one({"_id": user["_id"]}))
+
+
+async def rollups_step(user: dict, workouts: List[dict], event: dict):
+    await apply_rollups(user, workouts, event["_id"])
+
+
+# The user step goes first so later steps see the updated user; rollups come
+# before achievements, which read target_hit days from them
+OUTBOX_STEPS = {
+    "user": user_step,
+    "rollups": rollups_step,
+    "achievements": unlock_step,
+    "personal_bests": personal_bests_step,
+    "leaderboard": leaderboard_step,
+}
+
+
+# What the outbox steps read from a workout (rollups, achievement rules,
+# personal bests, leaderboard), leaving the stored HR samples behind
+OUTBOX_WORKOUT_FIELDS = {
+    "end_time": 1, "local_day": 1, "total_burn_points": 1, "calories_burned": 1, "zones": 1, "duration_seconds": 1
+}
+
+
+async def apply_workout_event(event: dict):
+    """Run the steps of an outbox event that haven't completed yet."""
+    if event.get("committed") is False:
+        # A save without a transaction stopped before writing all its workouts
+        await workouts_collection.delete_many({"_id": {"$in": event["workout_ids"]}})
+        return
+    
+    user = await users_collection.find_one({"_id": ObjectId(event["user_id"])})
+    if not user:
+        return
+    workouts = await workouts_collection.find(
+        {"_id": {"$in": event["workout_ids"]}}, OUTBOX_WORKOUT_FIELDS
+    ).sort("end_time", 1).to_list(None)
+    for w in workouts:
+        w["id"] = str(w["_id"])
+    
+    for name, step in OUTBOX_STEPS.items():
+        if name in event["steps_done"]:
+            continue
+        await step(user, workouts, event)
+        await workout_outbox_collection.update_one({"_id": event["_id"]}, {"$addToSet": {"steps_done": name}})
+    await response_cache.bump(event["user_id"])
+
+
+class WorkoutOutbox:
+    """Asyncio workers draining workout_outbox, with throughput and lag counters."""
+    
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.tasks = []
+        self.wakeup = asyncio.Event()
+        self.busy = 0
+        self.stats = {"processed": 0, "retried": 0, "failed": 0, "lag_ms_total": 0.0, "lag_ms_max": 0.0, "lag_ms_last": 0.0}
+    
+    def notify(self):
+        """Wake idle workers now instead of at their next poll."""
+        self.wakeup.set()
+    
+    async def claim(self) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        return await workout_outbox_collection.find_one_and_update(
+            {"status": "pending", "available_at": {"$lte": now}},
+            {"$set": {"available_at": now + timedelta(seconds=OUTBOX_LEASE_SECONDS)}, "$inc": {"attempts": 1}},
+            sort=[("available_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+    
+    async def process(self, event: dict):
+        self.busy += 1
+        try:
+            await apply_workout_event(event)
+        except Exception as e:
+            await self.retry_later(event, e)
+            return
+        finally:
+            self.busy -= 1
+        
+        now = datetime.now(timezone.utc)
+        await workout_outbox_collection.update_one(
+            {"_id": event["_id"]}, {"$set": {"status": "done", "done_at": now}}
+        )
+        # Lag is from the workout being saved to its side effects being visible
+        lag_ms = (now - as_utc(event["created_at"])).total_seconds() * 1000
+        self.stats["processed"] += 1
+        self.stats["lag_ms_total"] += lag_ms
+        self.stats["lag_ms_max"] = max(self.stats["lag_ms_max"], lag_ms)
+        self.stats["lag_ms_last"] = lag_ms
+    
+    async def retry_later(self, event: dict, error: Exception):
+        now = datetime.now(timezone.utc)
+        if event["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            logger.error(f"Outbox event {event['_id']} failed after {event['attempts']} attempts: {error}")
+            self.stats["failed"] += 1
+            update = {"status": "failed", "last_error": str(error)}
+        else:
+            logger.warning(f"Outbox event {event['_id']} failed (attempt {event['attempts']}), retrying: {error}")
+            self.stats["retried"] += 1
+            backoff = min(2 ** event["attempts"], OUTBOX_MAX_BACKOFF_SECONDS)
+            update = {"available_at": now + timedelta(seconds=backoff), "last_error": str(error)}
+        await workout_outbox_collection.update_one({"_id": event["_id"]}, {"$set": update})
+    
+    async def drain(self) -> int:
+        """Process events until none are due; returns how many were handled."""
+        handled = 0
+        while (event := await self.claim()) is not None:
+            await self.process(event)
+            handled += 1
+        return handled
+    
+    async def worker(self):
+        while True:
+            # Cleared before draining, so a notify that arrives mid-drain isn't lost
+            self.wakeup.clear()
+            try:
+                await self.drain()
+            except Exception as e:
+                logger.warning(f"Outbox worker error: {e}")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), OUTBOX_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+    
+    def start(self):
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+    
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+    
+    async def snapshot(self) -> dict:
+        """Counters since start plus the backlog as stored, for the metrics endpoint."""
+        processed = self.stats["processed"]
+        oldest = await workout_outbox_collection.find_one(
+            {"status": "pending"}, {"created_at": 1}, sort=[("created_at", 1)]
+        )
+        return {
+            "workers": self.workers,
+            "busy": self.busy,
+            "pending": await workout_outbox_collection.count_documents({"status": "pending"}),
+            "failed_stored": await workout_outbox_collection.count_documents({"status": "failed"}),
+            "oldest_pending_seconds": (
+                (datetime.now(timezone.utc) - as_utc(oldest["created_at"])).total_seconds() if oldest else 0.0
+            ),
+            **self.stats,
+            "lag_ms_avg": self.stats["lag_ms_total"] / processed if processed else 0.0
+        }
+
+
+workout_outbox = WorkoutOutbox(OUTBOX_WORKERS)
+
+
+# ===================== API Endpoints =====================
+
+@app.get("/api/health")
+async def health_check():
+    return {"status": "healthy", "app": "PulseFit", "version": "2.0.0"}
+
+
+@app.get("/api/metrics/scoring")
+async def get_scoring_metrics():
+    """Scoring pool queue depth and execution times"""
+    return scoring_pool.snapshot()
+
+
+@app.get("/api/metrics/outbox")
+async def get_outbox_metrics():
+    """Post-workout outbox backlog, retries and processing lag"""
+    return await workout_outbox.snapshot()
+
+
+# ----- User Endpoints -----
+
+@app.post("/api/users", response_model=UserResponse)
+async def create_user(user: UserCreate):
+    require_valid_timezone(user.timezone)
+    max_hr = user.max_hr or (220 - user.age)
+    
+    user_doc = {
+        "name": user.name,
+        "age": user.age,
+        "weight_kg": user.weight_kg,
+        "height_cm": user.height_cm,
+        "resting_hr": user.resting_hr,
+        "max_hr": max_hr,
+        "daily_burn_target": user.daily_burn_target,
+        "nd_mode": user.nd_mode,
+        "timezone": user.timezone,
+        "xp": 0,
+        "level": 1,
+        "streak_days": 0,
+        "streak_freezes_available": 1,
+        "last_workout_date": None,
+        "total_burn_points": 0,
+        "total_workouts": 0,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    
+    result = await users_collection.insert_one(user_doc)
+    user_doc["id"] = str(result.inserted_id)
+    return UserResponse(**user_doc)
+
+
+def user_response(user: dict) -> UserResponse:
+    user["id"] = str(user["_id"])
+    # Ensure all fields exist with defaults
+    user.setdefault("streak_freezes_available", 1)
+    user.setdefault("total_burn_points", 0)
+    user.setdefault("total_workouts", 0)
+    return UserResponse(**user)
+
+
+@app.get("/api/users/{user_id}", response_model=UserResponse)
+async def get_user(user_id: str, caller_uid: Optional[str] = Depends(verify_firebase_token)):
+    try:
+        user = await users_collection.find_one({"_id": ObjectId(user_id)})
+    except:
+        raise HTTPException(status_code=400, detail="Invalid user ID format")
+    
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    require_owner(caller_uid, user_id)
+    return user_response(user)
+
+
+@app.patch("/api/users/{user_id}", response_model=UserResponse)
+async def update_user(user_id: str, update: UserUpdate, caller_uid: Optional[str] = Depends(verify_firebase_token)):
+    require_owner(caller_uid, user_id)
+    update_data = {k: v for k, v in update.dict().items() if v is not None}
+    
+    if not update_data:
+        raise HTTPException(status_code=400, detail="No fields to update")
+    
+    if "age" in update_data and "max_hr" not in update_data:
+        update_data["max_hr"] = 220 - update_data["age"]
+    if "timezone" in update_data:
+        require_valid_timezone(update_data["timezone"])
+    
+    try:
+        result = await users_collection.update_one(
+            {"_id": ObjectId(user_id)},
+            {"$set": update_data, "$inc": CACHE_VERSION_INC}
+        )
+    except:
+        raise HTTPException(status_code=400, detail="Invalid user ID format")
+    
+    if result.modified_count == 0:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    zone_classifier_cache.pop(user_id)
+    user_timezone_cache.pop(user_id)
+    return await get_user(user_id)
+
+
+@app.post("/api/users/{user_id}/use-streak-freeze")
+async def use_streak_freeze(user_id: str, caller_uid: Optional[str] = Depends(verify_firebase_token)):
+    require_owner(caller_uid, user_id)
+    """Use a streak freeze to preserve streak"""
+    user = await users_collection.find_one({"_id": ObjectId(user_id)})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    freezes = user.get("streak_freezes_available", 0)
+    if freezes <= 0:
+        raise HTTPException(status_code=400, detail="No streak freezes available")
+    
+    await users_collection.update_one(
+        {"_id": ObjectId(user_id)},
+        {
+            "$inc": {"streak_freezes_available": -1, **CACHE_VERSION_INC},
+            "$set": {"last_workout_date": local_day(user, datetime.now(timezone.utc))}
+        }
+    )
+    
+    return {"success": True, "freezes_remaining": freezes - 1}
+
+
+# ----- Settings Endpoints -----
+
+@app.get("/api/users/{user_id}/settings")
+async def get_settings(user_id: str):
+    settings = await settings_collection.find_one({"user_id": user_id})
+    
+    if not settings:
+        return {
+            "user_id": user_id,
+            "sensory": {
+                "animation_level": 100,
+                "sound_level": 100,
+                "haptic_level": 100,
+                "transition_warnings": True,
+                "literal_labels": False
+            },
+            "voice_coach": {
+                "enabled": True,
+                "voice_selection": "default",
+                "speech_rate": "normal",
+                "volume": 80,
+                "min_gap_seconds": 15,
+                "zone_callouts": True,
+                "point_updates": "every_3",
                 "interval_countdown": True,
                 "encouragement": "occasional",
                 "pacing_warnings": True
@@ -726,6 +2426,11 @@ async def get_settings(user_id: str):
 @app.put("/api/users/{user_id}/settings")
 async def update_settings(user_id: str, settings: dict, caller_uid: Optional[str] = Depends(verify_firebase_token)):
     require_owner(caller_uid, user_id)
+    if "zone_settings" in settings:
+        try:
+            settings["zone_settings"] = ZoneSettings(**settings["zone_settings"]).model_dump()
+        except (TypeError, ValidationError):
+            raise HTTPException(status_code=400, detail="Invalid zone_settings")
     settings["user_id"] = user_id
     settings["updated_at"] = datetime.now(timezone.utc).isoformat()
     
@@ -734,28 +2439,69 @@ async def update_settings(user_id: str, settings: dict, caller_uid: Optional[str
         {"$set": settings},
         upsert=True
     )
+    zone_classifier_cache.pop(user_id)
+    await response_cache.bump(user_id)
     
     return await get_settings(user_id)
 
 
 # ----- Workout Endpoints -----
 
-@app.post("/api/workouts", response_model=WorkoutResponse)
-async def create_workout(workout: WorkoutCreate):
-    try:
-        user = await users_collection.find_one({"_id": ObjectId(workout.user_id)})
-    except:
-        raise HTTPException(status_code=400, detail="Invalid user ID")
+async def score_workout_samples(payload: WorkoutSamples, classifier: ZoneClassifier) -> tuple:
+    """Clean and score either sample format; returns (scores, samples_field) for the workout document."""
+    fixed_rate = None
+    if payload.heart_rates is not None:
+        if payload.hr_samples:
+            raise HTTPException(status_code=400, detail="Send either hr_samples or heart_rates, not both")
+        if payload.start_time is None or payload.interval_ms is None:
+            raise HTTPException(status_code=400, detail="heart_rates needs start_time and interval_ms")
+        fixed_rate = (payload.start_time, payload.interval_ms, payload.heart_rates, payload.gaps)
     
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+    size = len(payload.hr_samples) if fixed_rate is None else len(payload.heart_rates)
+    try:
+        return await scoring_pool.run(score_samples_job, payload.hr_samples, fixed_rate, classifier, size=size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def resolve_template_names(template_ids: List[Optional[str]]) -> Dict[str, str]:
+    """Names for built-in and custom template ids, with one query for all custom ones."""
+    names = {}
+    custom_ids = []
+    for template_id in set(filter(None, template_ids)):
+        template = next((t for t in BUILT_IN_TEMPLATES if t["id"] == template_id), None)
+        if template:
+            names[template_id] = template["name"]
+        elif ObjectId.is_valid(template_id):
+            custom_ids.append(ObjectId(template_id))
     
-    total_points, zone_summaries, avg_hr, max_hr = calculate_burn_points(
-        workout.hr_samples, user["max_hr"]
-    )
+    if custom_ids:
+        async for t in templates_collection.find({"_id": {"$in": custom_ids}}, {"name": 1}):
+            names[str(t["_id"])] = t["name"]
+    return names
+
+
+def build_workout_doc(
+    user: dict,
+    scores: tuple,
+    duration_seconds: int,
+    end_time: datetime,
+    streak_days: int,
+    notes: Optional[str],
+    template_id: Optional[str],
+    template_name: Optional[str],
+    samples_field: dict
+) -> dict:
+    """Derive calories, afterburn, target and XP for a scored workout.
+
+    `scores` is the (total_points, zone_summaries, avg_hr, peak_hr) tuple returned
+    by calculate_burn_points or session_totals; `streak_days` is the user's streak
+    going into this workout.
+    """
+    total_points, zone_summaries, avg_hr, max_hr = scores
     
     calories = calculate_calories(
-        workout.duration_seconds, avg_hr, user["weight_kg"], user["age"]
+        duration_seconds, avg_hr, user["weight_kg"], user["age"]
     )
     
     afterburn = calculate_afterburn(zone_summaries, user["weight_kg"])
@@ -766,28 +2512,19 @@ async def create_workout(workout: WorkoutCreate):
     xp_earned = 10 + (total_points * 5) + (20 if target_hit else 0)
     
     # Streak bonus
-    if user.get("streak_days", 0) >= 3:
+    if streak_days >= 3:
         xp_earned += 10
     
-    end_time = datetime.now(timezone.utc)
-    start_time = end_time - timedelta(seconds=workout.duration_seconds)
+    # Stored as BSON dates, which hold milliseconds
+    end_time = end_time.replace(microsecond=end_time.microsecond // 1000 * 1000)
+    start_time = end_time - timedelta(seconds=duration_seconds)
     
-    # Get template name if using one
-    template_name = None
-    if workout.template_id:
-        template = next((t for t in BUILT_IN_TEMPLATES if t["id"] == workout.template_id), None)
-        if template:
-            template_name = template["name"]
-        else:
-            custom_template = await templates_collection.find_one({"_id": ObjectId(workout.template_id)})
-            if custom_template:
-                template_name = custom_template["name"]
-    
-    workout_doc = {
-        "user_id": workout.user_id,
-        "start_time": start_time.isoformat(),
-        "end_time": end_time.isoformat(),
-        "duration_seconds": workout.duration_seconds,
+    return {
+        "user_id": str(user["_id"]),
+        "start_time": start_time,
+        "end_time": end_time,
+        "local_day": local_day(user, end_time),
+        "duration_seconds": duration_seconds,
         "total_burn_points": total_points,
         "zones": zone_summaries,
         "avg_hr": avg_hr,
@@ -796,22 +2533,19 @@ async def create_workout(workout: WorkoutCreate):
         "afterburn_estimate": afterburn,
         "target_hit": target_hit,
         "xp_earned": xp_earned,
-        "notes": workout.notes,
-        "template_id": workout.template_id,
+        "notes": notes,
+        "template_id": template_id,
         "template_name": template_name,
-        "hr_samples": workout.hr_samples
+        **samples_field
     }
-    
-    result = await workouts_collection.insert_one(workout_doc)
-    
-    # Update user stats
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    last_date = user.get("last_workout_date")
-    
-    new_streak = user.get("streak_days", 0)
+
+
+def advance_streak(streak_days: int, last_date: Optional[str], day: str, target_hit: bool) -> int:
+    """Streak after a workout on `day` (YYYY-MM-DD), given the last workout day."""
+    new_streak = streak_days
     if last_date:
         last = datetime.strptime(last_date, "%Y-%m-%d")
-        diff = (datetime.strptime(today, "%Y-%m-%d") - last).days
+        diff = (datetime.strptime(day, "%Y-%m-%d") - last).days
         if diff == 1 and target_hit:
             new_streak += 1
         elif diff > 1:
@@ -819,51 +2553,641 @@ async def create_workout(workout: WorkoutCreate):
         elif diff == 0:
             pass  # Same day, keep streak
     else:
-        new_streak = 1 if target_hit else 0
+        new_streak = 1 if target_hit else 0
+    return new_streak
+
+
+POST_WORKOUT_ATTEMPTS = 3
+
+
+class StaleUserError(Exception):
+    """The user document changed between being read and being updated."""
+
+
+def build_workout_docs(user: dict, entries: List[dict], template_names: Dict[str, str]) -> tuple:
+    """Workout documents for scored entries in end_time order, advancing the streak through them.
+
+    Returns (docs, streak, best_streak, best_streak_at, last_workout_date), where
+    best_streak_at is the end_time of the workout that raised the best streak,
+    None if none did.
+    """
+    streak = user.get("streak_days", 0)
+    best_streak = streak
+    best_streak_at = None
+    last_date = user.get("last_workout_date")
+    docs = []
+    
+    for entry in entries:
+        doc = build_workout_doc(
+            user, entry["scores"], entry["duration_seconds"], entry["end_time"], streak,
+            entry.get("notes"), entry.get("template_id"), template_names.get(entry.get("template_id")),
+            entry["samples_field"]
+        )
+        doc["_id"] = ObjectId()
+        doc["id"] = str(doc["_id"])
+        day = doc["local_day"]
+        streak = advance_streak(streak, last_date, day, doc["target_hit"])
+        if streak > best_streak:
+            best_streak, best_streak_at = streak, doc["end_time"]
+        if not last_date or day > last_date:
+            last_date = day
+        docs.append(doc)
+    
+    return docs, streak, best_streak, best_streak_at, last_date
+
+
+async def commit_workouts(
+    user: dict, docs: List[dict], streak: int, best_streak: int, best_streak_at: Optional[datetime], last_date: str
+) -> dict:
+    """Write the user update, the workouts and their outbox event; returns the event.
+
+    Everything else derived from the workouts (achievements, personal bests,
+    leaderboard, rollups) is applied from the event by the outbox workers.
+    The user update only matches if total_workouts and xp are still what
+    `user` says. If another write got there first it raises StaleUserError
+    and the caller recomputes.
+    
+    With transactions all three writes commit together. Without them the event
+    is written first, carrying the user delta, marked committed: false and held
+    back for OUTBOX_LEASE_SECONDS. It is marked committed once the workouts are
+    in, and released with its delta unset once the user update is. If the
+    process dies in between, the outbox withdraws an uncommitted save, and its
+    user step applies a delta still on the event once the hold runs out.
+    """
+    points = sum(d["total_burn_points"] for d in docs)
+    earned = sum(d["xp_earned"] for d in docs)
+    new_xp = user.get("xp", 0) + earned
+    now = datetime.now(timezone.utc)
+    transactional = await transactions_enabled()
+    event = {
+        "_id": ObjectId(),
+        "user_id": str(user["_id"]),
+        "workout_ids": [d["_id"] for d in docs],
+        # Achievements are evaluated against the best streak reached within the batch
+        "best_streak": best_streak,
+        "best_streak_at": best_streak_at or docs[-1]["end_time"],
+        "streak_changed": best_streak != user.get("streak_days", 0),
+        "status": "pending",
+        "steps_done": [],
+        "attempts": 0,
+        "created_at": now,
+        "available_at": now
+    }
+    user_filter = {"_id": user["_id"], "total_workouts": user.get("total_workouts"), "xp": user.get("xp")}
+    user_update = {
+        "$set": {
+            "xp": new_xp,
+            "level": calculate_level(new_xp),
+            "streak_days": streak,
+            "last_workout_date": last_date
+        },
+        "$inc": {
+            "total_burn_points": points,
+            "total_workouts": len(docs),
+            **CACHE_VERSION_INC
+        }
+    }
+    
+    async def update_user(session) -> bool:
+        result = await users_collection.update_one(user_filter, user_update, session=session)
+        return result.matched_count > 0
+    
+    if transactional:
+        async def write(session):
+            if not await update_user(session):
+                raise StaleUserError()
+            await workouts_collection.insert_many(docs, session=session)
+            await workout_outbox_collection.insert_one(event, session=session)
+        
+        try:
+            await run_in_transaction(write)
+        except PyMongoError as e:
+            # Write conflicts with a concurrent transaction are retried like a stale read
+            if e.has_error_label("TransientTransactionError"):
+                raise StaleUserError() from e
+            raise
+        return event
+    
+    event.update(
+        user_delta={
+            "xp": earned,
+            "total_burn_points": points,
+            "total_workouts": len(docs),
+            "streak_days": streak,
+            "last_workout_date": last_date
+        },
+        committed=False,
+        available_at=now + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+    )
+    await workout_outbox_collection.insert_one(event)
+    try:
+        await workouts_collection.insert_many(docs)
+    except Exception:
+        await withdraw_workout_event(event)
+        raise
+    committed = await workout_outbox_collection.update_one(
+        {"_id": event["_id"], "attempts": 0}, {"$set": {"committed": True}}
+    )
+    if committed.matched_count == 0:
+        # The hold ran out and a worker withdrew the save before it was committed
+        await workouts_collection.delete_many({"_id": {"$in": event["workout_ids"]}})
+        raise StaleUserError()
+    
+    # applied_events lets the user step tell whether this update landed if the delta is left behind
+    user_update["$push"] = {"applied_events": {"$each": [event["_id"]], "$slice": -APPLIED_EVENTS_KEPT}}
+    if not await update_user(None):
+        # Withdraw the save, unless the hold ran out and a worker already took the event over
+        if await withdraw_workout_event(event):
+            raise StaleUserError()
+        return event
+    await workout_outbox_collection.update_one(
+        {"_id": event["_id"], "attempts": 0},
+        {"$set": {"available_at": datetime.now(timezone.utc)}, "$unset": {"user_delta": ""}}
+    )
+    return event
+
+
+async def withdraw_workout_event(event: dict) -> bool:
+    """Delete an unclaimed outbox event and its workouts; False if a worker has claimed it."""
+    result = await workout_outbox_collection.delete_one({"_id": event["_id"], "attempts": 0})
+    if result.deleted_count == 0:
+        return False
+    await workouts_collection.delete_many({"_id": {"$in": event["workout_ids"]}})
+    return True
+
+
+async def save_workouts(user: dict, entries: List[dict]) -> List[dict]:
+    """Persist scored workouts, given in end_time order, and queue their side effects.
+
+    Each entry holds scores, duration_seconds, end_time, samples_field and
+    optional notes / template_id. Returns the stored workout documents.
+    """
+    template_names = await resolve_template_names([e.get("template_id") for e in entries])
+    
+    for attempt in range(POST_WORKOUT_ATTEMPTS):
+        docs, streak, best_streak, best_streak_at, last_date = build_workout_docs(user, entries, template_names)
+        try:
+            await commit_workouts(user, docs, streak, best_streak, best_streak_at, last_date)
+            break
+        except StaleUserError:
+            if attempt == POST_WORKOUT_ATTEMPTS - 1:
+                raise HTTPException(status_code=409, detail="User was updated concurrently, please retry")
+            user = await users_collection.find_one({"_id": user["_id"]})
+    
+    workout_outbox.notify()
+    return docs
+
+
+async def save_scored_workout(
+    user: dict,
+    scores: tuple,
+    duration_seconds: int,
+    notes: Optional[str],
+    template_id: Optional[str],
+    samples_field: dict
+) -> dict:
+    """Persist a workout that just finished; returns the stored workout document."""
+    docs = await save_workouts(user, [{
+        "scores": scores,
+        "duration_seconds": duration_seconds,
+        "end_time": datetime.now(timezone.utc),
+        "notes": notes,
+        "template_id": template_id,
+        "samples_field": samples_field
+    }])
+    return docs[0]
+
+
+@app.post("/api/workouts", response_model=WorkoutResponse)
+async def create_workout(workout: WorkoutCreate):
+    try:
+        user = await users_collection.find_one({"_id": ObjectId(workout.user_id)})
+    except:
+        raise HTTPException(status_code=400, detail="Invalid user ID")
+    
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    classifier = await get_zone_classifier(user)
+    scores, samples_field = await score_workout_samples(workout, classifier)
+    
+    workout_doc = await save_scored_workout(
+        user, scores, workout.duration_seconds, workout.notes, workout.template_id,
+        samples_field
+    )
+    
+    return WorkoutResponse(**workout_doc)
+
+
+BULK_WORKOUTS_MAX = 100
+
+
+def bulk_item_end_time(item: BulkWorkoutItem, now: datetime) -> datetime:
+    """When a queued workout finished: explicit end_time, else its latest sample, else now."""
+    if item.end_time:
+        try:
+            return min(parse_utc(item.end_time), now)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid end_time: {item.end_time}")
+    try:
+        if item.heart_rates:
+            elapsed_ms = (len(item.heart_rates) - 1) * item.interval_ms
+            elapsed_ms += sum(gap.duration_ms - item.interval_ms for gap in item.gaps)
+            return min(parse_utc(item.start_time) + timedelta(milliseconds=elapsed_ms), now)
+        if item.hr_samples:
+            # Queued samples aren't guaranteed to arrive in order
+            return min(max(parse_utc(sample["timestamp"]) for sample in item.hr_samples), now)
+    except Exception:
+        pass  # Malformed payloads are rejected when the item is scored
+    return now
+
+
+@app.post("/api/workouts/bulk")
+async def create_workouts_bulk(req: BulkWorkoutCreate):
+    """Upload workouts queued while offline in one request.
+
+    Workouts are applied in end_time order so streaks advance as if they had
+    been uploaded live, then written in one commit (see commit_workouts).
+    Achievements they unlock are applied by the outbox workers and show up
+    in GET /api/users/{user_id}/achievements.
+    """
+    if not req.workouts:
+        raise HTTPException(status_code=400, detail="No workouts to upload")
+    if len(req.workouts) > BULK_WORKOUTS_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_WORKOUTS_MAX} workouts per upload")
+    
+    try:
+        user = await users_collection.find_one({"_id": ObjectId(req.user_id)})
+    except:
+        raise HTTPException(status_code=400, detail="Invalid user ID")
+    
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    now = datetime.now(timezone.utc)
+    ordered = sorted(
+        ((bulk_item_end_time(item, now), index, item) for index, item in enumerate(req.workouts)),
+        key=lambda entry: (entry[0], entry[1])
+    )
+    classifier = await get_zone_classifier(user)
+    
+    # Items are independent until streaks are applied, so score them concurrently
+    scored = await asyncio.gather(*(score_workout_samples(item, classifier) for item in req.workouts))
+    
+    entries = [
+        {
+            "scores": scored[index][0],
+            "duration_seconds": item.duration_seconds,
+            "end_time": end_time,
+            "notes": item.notes,
+            "template_id": item.template_id,
+            "samples_field": scored[index][1]
+        }
+        for end_time, index, item in ordered
+    ]
+    docs = await save_workouts(user, entries)
+    docs_by_index = {index: doc for (_, index, _), doc in zip(ordered, docs)}
+    
+    return {"workouts": [WorkoutResponse(**docs_by_index[i]) for i in range(len(req.workouts))]}
+
+
+# ----- Live Workout Session Endpoints -----
+
+def session_progress(session: dict) -> dict:
+    """Running totals of a session, safe to return to clients mid-workout."""
+    total_points, zone_summaries, avg_hr, peak_hr = session_totals(session)
+    return {
+        "session_id": str(session["_id"]),
+        "status": session["status"],
+        "sample_count": session["sample_count"],
+        "burn_points": total_points,
+        "zones": zone_summaries,
+        "avg_hr": avg_hr,
+        "peak_hr": peak_hr,
+        "workout_id": session.get("workout_id")
+    }
+
+
+def clean_session_totals(session: dict) -> tuple:
+    """Close out a session's cleaned series: flush the held-back reading and total up.
+
+    Returns (scores, quality, last_chunk) with scores shaped like calculate_burn_points;
+    last_chunk is the packed tail of the grid, or None when flushing added nothing.
+    """
+    classifier = session_classifier(session)
+    empty = np.zeros(0, dtype=np.int64)
+    grid_ms, grid_hr, flushed, _ = clean_hr_batch(session["clean"], empty, empty, flush=True)
+    flush_zone_seconds, flush_hr_sum, flush_peak = score_hr_arrays(grid_hr, np.ones(len(grid_hr), dtype=np.int64), classifier)
+    
+    zone_seconds = [int(a) + int(b) for a, b in zip(session["clean_zone_seconds"], flush_zone_seconds)]
+    quality = {k: int(v) + int(flushed[k]) for k, v in session["hr_quality"].items()}
+    total_points, zone_summaries = summarize_zones(zone_seconds)
+    n = quality["clean_samples"]
+    avg_hr = (session["clean_hr_sum"] + int(flush_hr_sum)) // n if n else 0
+    peak_hr = max(session["clean_peak_hr"], int(flush_peak))
+    last_chunk = pack_hr_arrays(grid_ms, grid_hr) if len(grid_hr) else None
+    return (total_points, zone_summaries, avg_hr, peak_hr), quality, last_chunk
+
+
+async def get_owned_session(session_id: str, caller_uid: Optional[str]) -> dict:
+    """Load a session (without its sample chunks) and check the caller owns it."""
+    try:
+        session = await workout_sessions_collection.find_one(
+            {"_id": ObjectId(session_id)}, {"chunks": 0}
+        )
+    except:
+        raise HTTPException(status_code=400, detail="Invalid session ID")
+    
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    require_owner(caller_uid, session["user_id"])
+    return session
+
+
+@app.post("/api/workout-sessions")
+async def open_workout_session(req: WorkoutSessionCreate, caller_uid: Optional[str] = Depends(verify_firebase_token)):
+    """Start a live workout; samples are appended in batches while it runs"""
+    require_owner(caller_uid, req.user_id)
+    try:
+        user = await users_collection.find_one({"_id": ObjectId(req.user_id)}, {"max_hr": 1, "resting_hr": 1})
+    except:
+        raise HTTPException(status_code=400, detail="Invalid user ID")
+    
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    classifier = await get_zone_classifier(user)
+    now = datetime.now(timezone.utc).isoformat()
+    session = {
+        "user_id": req.user_id,
+        "status": "open",
+        "notes": req.notes,
+        "template_id": req.template_id,
+        "max_hr": user["max_hr"],
+        "zone_profile": classifier.profile(),  # Zones stay consistent for the whole session
+        "seq": 0,
+        "zone_seconds": [0] * 6,
+        "sample_count": 0,
+        "hr_sum": 0,
+        "peak_hr": 0,
+        "first_t": None,
+        "tail": None,
+        # Cleaned 1 Hz series, built batch by batch so finalize doesn't revisit the samples
+        "clean": dict(HR_CLEAN_STATE),
+        "clean_zone_seconds": [0] * 6,
+        "clean_hr_sum": 0,
+        "clean_peak_hr": 0,
+        "hr_quality": {k: 0 for k in ("raw_samples", "duplicates", "outliers", "gaps", "clean_samples")},
+        "chunks": [],
+        "started_at": now,
+        "updated_at": now
+    }
+    
+    result = await workout_sessions_collection.insert_one(session)
+    session["_id"] = result.inserted_id
+    return session_progress(session)
+
+
+@app.get("/api/workout-sessions/{session_id}")
+async def get_workout_session(session_id: str, caller_uid: Optional[str] = Depends(verify_firebase_token)):
+    """Current running totals, e.g. to resume after the app restarts"""
+    return session_progress(await get_owned_session(session_id, caller_uid))
+
+
+@app.post("/api/workout-sessions/{session_id}/samples")
+async def append_session_samples(
+    session_id: str,
+    batch: WorkoutSessionSamples,
+    caller_uid: Optional[str] = Depends(verify_firebase_token)
+):
+    """Append a batch of samples; cost is proportional to the batch, not the session"""
+    session = await get_owned_session(session_id, caller_uid)
+    if session["status"] != "open":
+        raise HTTPException(status_code=409, detail="Session is already finalized")
+    
+    arrays = hr_sample_arrays(batch.hr_samples)
+    if arrays is None:
+        raise HTTPException(status_code=400, detail="Samples need ISO-8601 timestamps and heart rates between 0 and 255")
+    
+    times_ms, hr = arrays
+    if len(hr) == 0:
+        return session_progress(session)
+    
+    classifier = session_classifier(session)
+    zone_seconds, tail = score_session_batch(session["tail"], times_ms, hr, classifier)
+    batch_hr_sum = int(hr.sum())
+    batch_peak = int(hr.max())
+    
+    inc = {f"zone_seconds.{z}": int(secs) for z, secs in enumerate(zone_seconds) if secs}
+    inc.update({"sample_count": len(hr), "hr_sum": batch_hr_sum, "seq": 1})
+    set_fields = {"tail": tail, "updated_at": datetime.now(timezone.utc).isoformat()}
+    if session["first_t"] is None:
+        set_fields["first_t"] = int(times_ms[0])
+    update = {"$inc": inc, "$max": {"peak_hr": batch_peak}, "$set": set_fields}
+    
+    if "clean" in session:
+        grid_ms, grid_hr, quality, set_fields["clean"] = clean_hr_batch(session["clean"], times_ms, hr)
+        clean_zone_seconds, clean_hr_sum, clean_peak = score_hr_arrays(grid_hr, np.ones(len(grid_hr), dtype=np.int64), classifier)
+        inc.update({f"clean_zone_seconds.{z}": int(secs) for z, secs in enumerate(clean_zone_seconds) if secs})
+        inc.update({f"hr_quality.{k}": int(v) for k, v in quality.items() if v})
+        inc["clean_hr_sum"] = int(clean_hr_sum)
+        update["$max"]["clean_peak_hr"] = int(clean_peak)
+        if len(grid_hr):
+            update["$push"] = {"chunks": pack_hr_arrays(grid_ms, grid_hr)}
+    else:
+        # Sessions opened before cleaning was streamed keep their raw samples
+        update["$push"] = {"chunks": pack_hr_arrays(times_ms, hr)}
     
-    new_xp = user.get("xp", 0) + xp_earned
+    # The tail makes appends order-dependent, so only apply on top of the state we scored against
+    result = await workout_sessions_collection.update_one(
+        {"_id": session["_id"], "status": "open", "seq": session["seq"]},
+        update
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=409, detail="Session changed while appending; retry the batch")
     
-    await users_collection.update_one(
-        {"_id": ObjectId(workout.user_id)},
-        {"$set": {
-            "xp": new_xp,
-            "level": calculate_level(new_xp),
-            "streak_days": new_streak,
-            "last_workout_date": today
-        },
-        "$inc": {
-            "total_burn_points": total_points,
-            "total_workouts": 1
-        }}
+    for z, secs in enumerate(zone_seconds):
+        session["zone_seconds"][z] += int(secs)
+    session["sample_count"] += len(hr)
+    session["hr_sum"] += batch_hr_sum
+    session["peak_hr"] = max(session["peak_hr"], batch_peak)
+    session.update(set_fields)
+    return session_progress(session)
+
+
+@app.post("/api/workout-sessions/{session_id}/finalize", response_model=WorkoutResponse)
+async def finalize_workout_session(
+    session_id: str,
+    req: WorkoutSessionFinalize,
+    caller_uid: Optional[str] = Depends(verify_firebase_token)
+):
+    """Close a session and record it as a workout from its cleaned samples"""
+    session = await get_owned_session(session_id, caller_uid)
+    if session["status"] != "open":
+        raise HTTPException(status_code=409, detail="Session is already finalized")
+    
+    # Claim the session so a retried or concurrent finalize can't record it twice
+    claimed = await workout_sessions_collection.find_one_and_update(
+        {"_id": session["_id"], "status": "open", "seq": session["seq"]},
+        {"$set": {"status": "finalized", "updated_at": datetime.now(timezone.utc).isoformat()}},
+        projection={"chunks": 1}
     )
+    if not claimed:
+        raise HTTPException(status_code=409, detail="Session changed while finalizing; retry")
+    
+    try:
+        workout_doc = await record_session_workout(session, claimed, req)
+    except Exception:
+        # Give the claim back so the session can be finalized again
+        await workout_sessions_collection.update_one(
+            {"_id": session["_id"], "status": "finalized", "workout_id": {"$exists": False}},
+            {"$set": {"status": "open", "updated_at": datetime.now(timezone.utc).isoformat()}}
+        )
+        raise
     
-    # Check achievements
-    workout_doc["id"] = str(result.inserted_id)
-    await check_achievements(workout.user_id, workout_doc)
-    await update_personal_bests(workout.user_id, workout_doc)
+    await workout_sessions_collection.update_one(
+        {"_id": session["_id"]},
+        {"$set": {"workout_id": workout_doc["id"]}}
+    )
     
     return WorkoutResponse(**workout_doc)
 
 
+async def record_session_workout(session: dict, claimed: dict, req: WorkoutSessionFinalize) -> dict:
+    """Score a claimed session and save it as a workout; returns the workout document."""
+    user = await users_collection.find_one({"_id": ObjectId(session["user_id"])})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    duration_seconds = req.duration_seconds
+    if duration_seconds is None:
+        duration_seconds = 0
+        if session["tail"] is not None:
+            duration_seconds = (session["tail"]["t"] - session["first_t"]) // 1000 + 1
+    
+    # The running totals drive the live display; the stored workout is scored from the cleaned series
+    if "clean" in session:
+        scores, quality, last_chunk = clean_session_totals(session)
+        chunks = claimed["chunks"] + ([last_chunk] if last_chunk is not None else [])
+        samples_field = {"hr_samples_packed": chunks, "hr_quality": quality}
+    else:
+        scores, samples_field = session_totals(session), {"hr_samples_packed": claimed["chunks"]}
+    
+    return await save_scored_workout(
+        user, scores, duration_seconds,
+        req.notes if req.notes is not None else session["notes"],
+        session["template_id"],
+        samples_field
+    )
+
+
+WORKOUT_FIELDS = set(WorkoutResponse.model_fields) | {"template_id", "hr_quality", "hr_samples"}
+WORKOUT_SAMPLE_FIELDS = ("hr_samples", "hr_samples_packed")
+
+
+def workout_projection(view: str, fields: Optional[str]) -> Optional[dict]:
+    """Mongo projection for a workout read.
+
+    `fields` is a comma-separated list of workout fields and wins over `view`;
+    view=summary drops the samples, view=full returns everything. Samples only
+    leave the database when asked for.
+    """
+    if fields:
+        requested = {f.strip() for f in fields.split(",") if f.strip()}
+        unknown = requested - WORKOUT_FIELDS
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown workout fields: {', '.join(sorted(unknown))}")
+        projection = {f: 1 for f in requested - {"id", "hr_samples"}}
+        if "hr_samples" in requested:
+            projection.update({f: 1 for f in WORKOUT_SAMPLE_FIELDS})
+        return projection or {"_id": 1}
+    if view == "summary":
+        return {f: 0 for f in WORKOUT_SAMPLE_FIELDS}
+    if view == "full":
+        return None
+    raise HTTPException(status_code=400, detail="Invalid view. Use 'summary' or 'full'")
+
+
+WORKOUTS_PAGE_MAX = 100
+
+
+def encode_workout_cursor(workout: dict) -> str:
+    """Opaque position after `workout` in newest-first history order."""
+    end_ms = (as_utc(workout["end_time"]) - _EPOCH_AWARE) // timedelta(milliseconds=1)
+    return base64.urlsafe_b64encode(f"{end_ms}:{workout['_id']}".encode()).decode().rstrip("=")
+
+
+def decode_workout_cursor(cursor: str) -> tuple:
+    """(end_time, _id) from encode_workout_cursor; HTTP 400 if it was tampered with."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        end_ms, workout_id = raw.split(":")
+        return _EPOCH_AWARE + timedelta(milliseconds=int(end_ms)), ObjectId(workout_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
 @app.get("/api/users/{user_id}/workouts")
-async def get_user_workouts(user_id: str, limit: int = 20, offset: int = 0):
-    cursor = workouts_collection.find({"user_id": user_id}).sort("end_time", -1).skip(offset).limit(limit)
+async def get_user_workouts(
+    user_id: str,
+    limit: int = 20,
+    offset: int = 0,
+    cursor: Optional[str] = None,
+    include_total: bool = True,
+    view: str = "summary",
+    fields: Optional[str] = None
+):
+    """Workout history, newest first.
+
+    Pages are keyed on (end_time, _id): pass the previous page's next_cursor
+    to continue, so every page costs the same however deep it is. `offset` is
+    still honoured for older clients when no cursor is given. `total` comes
+    from the user's total_workouts counter rather than a count.
+    """
+    limit = max(1, min(limit, WORKOUTS_PAGE_MAX))
+    projection = workout_projection(view, fields)
+    # next_cursor needs end_time even when the caller didn't ask for it
+    drop_end_time = projection is not None and "end_time" not in projection and 0 not in projection.values()
+    if drop_end_time:
+        projection["end_time"] = 1
     
+    query = {"user_id": user_id}
+    if cursor:
+        end_time, workout_id = decode_workout_cursor(cursor)
+        query["$or"] = [
+            {"end_time": {"$lt": end_time}},
+            {"end_time": end_time, "_id": {"$lt": workout_id}}
+        ]
+    
+    find = workouts_collection.find(query, projection).sort([("end_time", -1), ("_id", -1)])
+    if offset and not cursor:
+        find = find.skip(offset)
+    # One extra document tells us whether there is a next page
+    page = await find.limit(limit + 1).to_list(None)
+    
+    next_cursor = encode_workout_cursor(page[limit - 1]) if len(page) > limit else None
     workouts = []
-    async for w in cursor:
+    for w in page[:limit]:
         w["id"] = str(w.pop("_id"))
-        w.pop("hr_samples", None)
-        workouts.append(w)
-    
-    total = await workouts_collection.count_documents({"user_id": user_id})
+        if drop_end_time:
+            w.pop("end_time", None)
+        workouts.append(inflate_hr_samples(w))
     
-    return {"workouts": workouts, "total": total}
+    response = {"workouts": workouts, "next_cursor": next_cursor}
+    if include_total:
+        user = None
+        if ObjectId.is_valid(user_id):
+            user = await users_collection.find_one({"_id": ObjectId(user_id)}, {"total_workouts": 1})
+        response["total"] = (user or {}).get("total_workouts", 0)
+    return response
 
 
 @app.get("/api/workouts/{workout_id}")
-async def get_workout(workout_id: str):
+async def get_workout(workout_id: str, view: str = "full", fields: Optional[str] = None):
+    projection = workout_projection(view, fields)
     try:
-        workout = await workouts_collection.find_one({"_id": ObjectId(workout_id)})
+        workout = await workouts_collection.find_one({"_id": ObjectId(workout_id)}, projection)
     except:
         raise HTTPException(status_code=400, detail="Invalid workout ID")
     
@@ -871,34 +3195,21 @@ async def get_workout(workout_id: str):
         raise HTTPException(status_code=404, detail="Workout not found")
     
     workout["id"] = str(workout.pop("_id"))
-    return workout
+    return inflate_hr_samples(workout)
 
 
 # ----- Stats & Trends Endpoints -----
 
-@app.get("/api/users/{user_id}/stats")
-async def get_user_stats(user_id: str):
-    user = await users_collection.find_one({"_id": ObjectId(user_id)})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    today_workouts = await workouts_collection.find({
-        "user_id": user_id,
-        "end_time": {"$regex": f"^{today}"}
-    }).to_list(None)
+def stats_payload(user: dict, week: List[dict], today: str) -> dict:
+    """Stats response from the user and their rollups for the last 7 days."""
+    user_id = str(user["_id"])
+    today_rollup = next((r for r in week if r["day"] == today), {})
     
-    today_points = sum(w.get("total_burn_points", 0) for w in today_workouts)
+    today_points = today_rollup.get("points", 0)
     today_target_hit = today_points >= user["daily_burn_target"]
     
-    week_ago = (datetime.now(timezone.utc) - timedelta(days=7)).isoformat()
-    week_workouts = await workouts_collection.find({
-        "user_id": user_id,
-        "end_time": {"$gte": week_ago}
-    }).to_list(None)
-    
-    week_points = sum(w.get("total_burn_points", 0) for w in week_workouts)
-    week_workout_count = len(week_workouts)
+    week_points = sum(r["points"] for r in week)
+    week_workout_count = sum(r["workouts"] for r in week)
     
     return {
         "user_id": user_id,
@@ -906,7 +3217,7 @@ async def get_user_stats(user_id: str):
             "burn_points": today_points,
             "target": user["daily_burn_target"],
             "target_hit": today_target_hit,
-            "workout_count": len(today_workouts)
+            "workout_count": today_rollup.get("workouts", 0)
         },
         "week": {
             "burn_points": week_points,
@@ -930,67 +3241,153 @@ async def get_user_stats(user_id: str):
     }
 
 
-@app.get("/api/users/{user_id}/trends")
-async def get_user_trends(user_id: str, days: int = 30):
-    """Get trend data for charts"""
-    user = await users_collection.find_one({"_id": ObjectId(user_id)})
+STATS_USER_FIELDS = {
+    field: 1 for field in (
+        "daily_burn_target", "streak_days", "streak_freezes_available", "xp", "level",
+        "total_burn_points", "total_workouts"
+    )
+}
+
+
+@app.get("/api/users/{user_id}/stats")
+async def get_user_stats(user_id: str, request: Request):
+    today = await user_today(user_id)
+    return await response_cache.serve(
+        request, user_id, "stats", {"day": today}, lambda: load_user_stats(user_id, today)
+    )
+
+
+async def load_user_stats(user_id: str, today: str) -> dict:
+    """Stats for the user's local `today`, from the rollups of the 7 local days ending there."""
+    user = await users_collection.find_one({"_id": ObjectId(user_id)}, STATS_USER_FIELDS)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    start_date = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
-    workouts = await workouts_collection.find({
-        "user_id": user_id,
-        "end_time": {"$gte": start_date}
-    }).sort("end_time", 1).to_list(None)
+    week = await get_daily_rollups(user_id, add_days(today, -6), add_days(today, 1))
+    return stats_payload(user, week, today)
+
+
+TRENDS_MAX_WEEKS = 8
+TRENDS_DEFAULT_MAX_POINTS = 90
+
+
+def trends_bucket(days: int, max_points: int) -> str:
+    """The finest of day/week/month whose buckets over `days` fit in max_points (month if none do)."""
+    if days <= max_points:
+        return "day"
+    if days // 7 + 1 <= max_points:
+        return "week"
+    return "month"
+
+
+def trends_pipeline(
+    user_id: str, start_day: str, week_starts: List[str], end_day: str, series: bool = True
+) -> List[dict]:
+    """Aggregation over one rollup level producing per-bucket rows, weekly buckets and totals in one pass.
+
+    `week_starts` are the ascending first days of each weekly bucket; a bucket
+    runs up to the next start (or `end_day`), exclusive. They only make sense
+    over daily_rollups. series=False leaves out the per-bucket rows and totals.
+    """
+    facets = {}
+    if series:
+        facets["series"] = [
+            {"$group": {
+                "_id": "$day",
+                "points": {"$sum": "$points"},
+                **{f"zone_{z}": {"$sum": f"$zone_seconds.{z}"} for z in range(1, 6)}
+            }},
+            {"$sort": {"_id": 1}}
+        ]
+        facets["totals"] = [
+            {"$group": {"_id": None, "points": {"$sum": "$points"}, "workouts": {"$sum": "$workouts"}}}
+        ]
+    if week_starts:
+        facets["weekly"] = [
+            {"$bucket": {
+                "groupBy": "$day",
+                "boundaries": week_starts + [end_day],
+                "default": "older",
+                "output": {"points": {"$sum": "$points"}}
+            }}
+        ]
+    
+    return [
+        {"$match": {"user_id": user_id, "day": {"$gte": start_day, "$lt": end_day}}},
+        {"$project": {"_id": 0, "day": 1, "points": 1, "workouts": 1, "zone_seconds": 1}},
+        {"$facet": facets}
+    ]
+
+
+@app.get("/api/users/{user_id}/trends")
+async def get_user_trends(
+    user_id: str, request: Request, days: int = 30, max_points: int = TRENDS_DEFAULT_MAX_POINTS
+):
+    """Get trend data for charts.
+
+    daily_points and zone_distribution hold one row per day while `days` fits
+    in max_points, otherwise one per ISO week or month (see `bucket`), read
+    from the pre-aggregated rollups. Coarse ranges are widened to whole buckets.
+    """
+    today = await user_today(user_id)
+    params = {"day": today, "days": days, "max_points": max_points}
+    return await response_cache.serve(
+        request, user_id, "trends", params, lambda: load_user_trends(user_id, today, days, max_points)
+    )
+
+
+async def aggregate_one(collection, pipeline: List[dict]) -> dict:
+    return (await collection.aggregate(pipeline).to_list(1))[0]
+
+
+async def load_user_trends(user_id: str, today: str, days: int, max_points: int) -> dict:
+    user = await users_collection.find_one({"_id": ObjectId(user_id)}, {"_id": 1})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
     
-    # Daily points
-    daily_points = {}
-    daily_zone_time = {}
+    end_day = add_days(today, 1)
+    weeks = min(TRENDS_MAX_WEEKS, days // 7)
+    # Week i covers the 7 days ending i weeks before today, oldest first
+    week_starts = [add_days(today, -((i + 1) * 7 - 1)) for i in reversed(range(weeks))]
     
-    for w in workouts:
-        date = w["end_time"][:10]
-        daily_points[date] = daily_points.get(date, 0) + w.get("total_burn_points", 0)
-        
-        if date not in daily_zone_time:
-            daily_zone_time[date] = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
-        
-        for z in w.get("zones", []):
-            daily_zone_time[date][z["zone"]] += z["duration_seconds"]
+    bucket = trends_bucket(days, max(1, max_points))
+    start_day = bucket_start(add_days(today, -days), bucket)
+    queries = [aggregate_one(
+        ROLLUP_COLLECTIONS[bucket],
+        trends_pipeline(user_id, start_day, week_starts if bucket == "day" else [], end_day)
+    )]
+    if bucket != "day" and week_starts:
+        # The rolling 7-day weeks don't line up with calendar buckets, so they come from the daily level
+        queries.append(aggregate_one(
+            daily_rollups_collection, trends_pipeline(user_id, week_starts[0], week_starts, end_day, series=False)
+        ))
+    results = await asyncio.gather(*queries)
+    result = results[0]
     
-    # Weekly aggregates
+    week_points = {week["_id"]: week["points"] for week in results[-1].get("weekly", [])}
     weekly_points = []
-    for i in range(min(8, days // 7)):
-        week_start = datetime.now(timezone.utc) - timedelta(days=(i + 1) * 7)
-        week_end = datetime.now(timezone.utc) - timedelta(days=i * 7)
-        
-        week_total = sum(
-            w.get("total_burn_points", 0) 
-            for w in workouts 
-            if week_start.isoformat() <= w["end_time"] < week_end.isoformat()
-        )
+    for i in reversed(range(weeks)):
         weekly_points.append({
             "week": i,
             "label": f"{(i * 7)} - {((i + 1) * 7)} days ago" if i > 0 else "This week",
-            "points": week_total
+            "points": week_points.get(week_starts[weeks - 1 - i], 0)
         })
     
+    totals = result["totals"][0] if result["totals"] else {"points": 0, "workouts": 0}
     return {
-        "daily_points": [{"date": k, "points": v} for k, v in sorted(daily_points.items())],
-        "weekly_points": list(reversed(weekly_points)),
-        "zone_distribution": daily_zone_time,
-        "total_workouts": len(workouts),
-        "avg_points_per_workout": sum(w.get("total_burn_points", 0) for w in workouts) // len(workouts) if workouts else 0
+        "bucket": bucket,
+        "daily_points": [{"date": d["_id"], "points": d["points"]} for d in result["series"]],
+        "weekly_points": weekly_points,
+        "zone_distribution": {d["_id"]: {z: d[f"zone_{z}"] for z in range(1, 6)} for d in result["series"]},
+        "total_workouts": totals["workouts"],
+        "avg_points_per_workout": totals["points"] // totals["workouts"] if totals["workouts"] else 0
     }
 
 
 # ----- Quests Endpoints -----
 
-@app.get("/api/users/{user_id}/quests")
-async def get_daily_quests(user_id: str):
-    user = await users_collection.find_one({"_id": ObjectId(user_id)})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
+def quests_payload(user: dict, rollup: dict, today: str) -> dict:
+    """Quests response from the user and today's rollup ({} before the first workout)."""
     quests = [
         {
             "id": "hit_target",
@@ -1039,28 +3436,13 @@ async def get_daily_quests(user_id: str):
         }
     ]
     
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    today_workouts = await workouts_collection.find({
-        "user_id": user_id,
-        "end_time": {"$regex": f"^{today}"}
-    }).to_list(None)
+    zone_seconds = rollup.get("zone_seconds", {})
     
-    total_points = 0
-    push_seconds = 0
-    peak_reached = False
-    active_plus_seconds = 0
-    total_calories = 0
-    
-    for w in today_workouts:
-        total_points += w.get("total_burn_points", 0)
-        total_calories += w.get("calories_burned", 0)
-        for z in w.get("zones", []):
-            if z["zone"] == 4:
-                push_seconds += z["duration_seconds"]
-            if z["zone"] == 5 and z["duration_seconds"] > 0:
-                peak_reached = True
-            if z["zone"] >= 3:
-                active_plus_seconds += z["duration_seconds"]
+    total_points = rollup.get("points", 0)
+    total_calories = rollup.get("calories", 0)
+    push_seconds = zone_seconds.get("4", 0)
+    peak_reached = zone_seconds.get("5", 0) > 0
+    active_plus_seconds = sum(zone_seconds.get(str(z), 0) for z in (3, 4, 5))
     
     quests[0]["progress"] = total_points
     quests[0]["completed"] = total_points >= user["daily_burn_target"]
@@ -1080,6 +3462,71 @@ async def get_daily_quests(user_id: str):
     return {"quests": quests, "date": today}
 
 
+# What quests_payload reads from the day's rollup
+QUESTS_ROLLUP_FIELDS = {"_id": 0, "points": 1, "calories": 1, "zone_seconds": 1}
+
+
+@app.get("/api/users/{user_id}/quests")
+async def get_daily_quests(user_id: str, request: Request):
+    today = await user_today(user_id)
+    return await response_cache.serve(
+        request, user_id, "quests", {"day": today}, lambda: load_daily_quests(user_id, today)
+    )
+
+
+async def load_daily_quests(user_id: str, today: str) -> dict:
+    user = await users_collection.find_one({"_id": ObjectId(user_id)}, {"daily_burn_target": 1})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    rollup = await daily_rollups_collection.find_one(
+        {"user_id": user_id, "day": today}, QUESTS_ROLLUP_FIELDS
+    ) or {}
+    return quests_payload(user, rollup, today)
+
+
+# ----- Dashboard Endpoint -----
+
+@app.get("/api/users/{user_id}/dashboard")
+async def get_dashboard(user_id: str, request: Request, caller_uid: Optional[str] = Depends(verify_firebase_token)):
+    """Everything the home screen shows, in one request.
+
+    Loads the user once and the last 7 local days of rollups (which include
+    today) once, fetching achievements and personal bests alongside. Each section has
+    the same shape as its standalone endpoint.
+    """
+    require_owner(caller_uid, user_id)
+    today = await user_today(user_id)
+    return await response_cache.serve(
+        request, user_id, "dashboard", {"day": today}, lambda: load_dashboard(user_id, today)
+    )
+
+
+async def load_dashboard(user_id: str, today: str) -> dict:
+    try:
+        user = await users_collection.find_one({"_id": ObjectId(user_id)})
+    except:
+        raise HTTPException(status_code=400, detail="Invalid user ID format")
+    
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    week, user_achievements, pb = await asyncio.gather(
+        get_daily_rollups(user_id, add_days(today, -6), add_days(today, 1)),
+        achievements_collection.find({"user_id": user_id}, {"achievement_id": 1, "unlocked_at": 1}).to_list(None),
+        personal_bests_collection.find_one({"user_id": user_id})
+    )
+    today_rollup = next((r for r in week if r["day"] == today), {})
+    
+    return {
+        "user": user_response(user),
+        "stats": stats_payload(user, week, today),
+        "quests": quests_payload(user, today_rollup, today),
+        "achievements": achievements_payload(user_achievements),
+        "personal_bests": personal_bests_payload(user_id, pb)
+    }
+
+
 # ----- Templates Endpoints -----
 
 @app.get("/api/templates")
@@ -1156,10 +3603,8 @@ async def delete_custom_template(template_id: str):
 
 # ----- Achievements Endpoints -----
 
-@app.get("/api/users/{user_id}/achievements")
-async def get_user_achievements(user_id: str):
-    """Get all achievements with unlock status for user"""
-    user_achievements = await achievements_collection.find({"user_id": user_id}).to_list(None)
+def achievements_payload(user_achievements: List[dict]) -> dict:
+    """Every achievement with the user's unlock status."""
     unlocked_map = {a["achievement_id"]: a["unlocked_at"] for a in user_achievements}
     
     result = []
@@ -1172,31 +3617,141 @@ async def get_user_achievements(user_id: str):
     return {"achievements": result}
 
 
+@app.get("/api/users/{user_id}/achievements")
+async def get_user_achievements(user_id: str, request: Request):
+    """Get all achievements with unlock status for user"""
+    return await response_cache.serve(request, user_id, "achievements", {}, lambda: load_user_achievements(user_id))
+
+
+async def load_user_achievements(user_id: str) -> dict:
+    unlocked = await achievements_collection.find(
+        {"user_id": user_id}, {"achievement_id": 1, "unlocked_at": 1}
+    ).to_list(None)
+    return achievements_payload(unlocked)
+
+
 # ----- Personal Bests Endpoints -----
 
+def personal_bests_payload(user_id: str, pb: Optional[dict]) -> dict:
+    """Personal bests response; bests never set (no workouts yet, or added since) are zero."""
+    pb = dict(pb or {"user_id": user_id})
+    pb.pop("_id", None)
+    for field, date_field in PERSONAL_BEST_DATES.items():
+        pb.setdefault(field, 0)
+        pb.setdefault(date_field, None)
+    return pb
+
+
 @app.get("/api/users/{user_id}/personal-bests")
-async def get_personal_bests(user_id: str):
+async def get_personal_bests(user_id: str, request: Request):
     """Get user's personal bests"""
-    pb = await personal_bests_collection.find_one({"user_id": user_id})
+    return await response_cache.serve(request, user_id, "personal_bests", {}, lambda: load_personal_bests(user_id))
+
+
+async def load_personal_bests(user_id: str) -> dict:
+    pb = await personal_bests_collection.find_one({"user_id": user_id}, {"_id": 0})
+    return personal_bests_payload(user_id, pb)
+
+
+# ----- Leaderboard Endpoints -----
+
+LEADERBOARD_MAX_LIMIT = 100
+
+
+@app.get("/api/leaderboards/weekly")
+async def get_weekly_leaderboard(band: Optional[str] = None, limit: int = 10):
+    """Top of this week's leaderboard, overall or for one age band (e.g. band=25-34)."""
+    leaderboard = await weekly_leaderboard.current()
+    if band is not None and band not in {b for _, _, b in AGE_BANDS}:
+        raise HTTPException(status_code=400, detail="Invalid age band")
+    board = leaderboard.boards.get(band or "global", RankedBoard())
+    limit = max(1, min(limit, LEADERBOARD_MAX_LIMIT))
     
-    if not pb:
-        return {
-            "user_id": user_id,
-            "max_session_points": 0,
-            "max_session_points_date": None,
-            "longest_workout_seconds": 0,
-            "longest_workout_date": None,
-            "longest_peak_seconds": 0,
-            "longest_peak_date": None,
-            "longest_streak": 0
-        }
+    return {
+        "period": leaderboard.period,
+        "band": band,
+        "players": len(board),
+        "entries": leaderboard.entries(board, board.top(limit))
+    }
+
+
+@app.get("/api/users/{user_id}/leaderboard")
+async def get_user_leaderboard(user_id: str, scope: str = "global", limit: int = 10, radius: int = 2):
+    """Where the user stands this week: their rank, the top and the users around them.
+
+    scope is 'global', 'age_band' (the user's own band) or 'friends'.
+    """
+    if scope not in ("global", "age_band", "friends"):
+        raise HTTPException(status_code=400, detail="Invalid scope. Use 'global', 'age_band' or 'friends'")
+    try:
+        user = await users_collection.find_one({"_id": ObjectId(user_id)}, {"age": 1, "friends": 1})
+    except:
+        raise HTTPException(status_code=400, detail="Invalid user ID format")
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
     
-    pb.pop("_id", None)
-    return pb
+    leaderboard = await weekly_leaderboard.current()
+    limit = max(1, min(limit, LEADERBOARD_MAX_LIMIT))
+    radius = max(0, min(radius, LEADERBOARD_MAX_LIMIT))
+    
+    if scope == "friends":
+        # Friends lists are short, so rank them directly from the global scores
+        board = RankedBoard()
+        for member_id in [user_id] + user.get("friends", []):
+            board.set(member_id, leaderboard.boards["global"].points.get(member_id, 0))
+    elif scope == "age_band":
+        board = leaderboard.boards.get(age_band(user.get("age", 0)), RankedBoard())
+    else:
+        board = leaderboard.boards["global"]
+    
+    return {
+        "period": leaderboard.period,
+        "scope": scope,
+        "band": age_band(user.get("age", 0)) if scope == "age_band" else None,
+        "players": len(board),
+        "rank": board.rank(user_id),
+        "points": board.points.get(user_id, 0),
+        "top": leaderboard.entries(board, board.top(limit)),
+        "around": leaderboard.entries(board, board.around(user_id, radius))
+    }
+
+
+@app.post("/api/users/{user_id}/friends/{friend_id}")
+async def add_friend(user_id: str, friend_id: str, caller_uid: Optional[str] = Depends(verify_firebase_token)):
+    require_owner(caller_uid, user_id)
+    if friend_id == user_id:
+        raise HTTPException(status_code=400, detail="Cannot add yourself as a friend")
+    try:
+        friend = await users_collection.find_one({"_id": ObjectId(friend_id)}, {"_id": 1})
+        result = await users_collection.update_one({"_id": ObjectId(user_id)}, {"$addToSet": {"friends": friend_id}, "$inc": CACHE_VERSION_INC})
+    except:
+        raise HTTPException(status_code=400, detail="Invalid user ID format")
+    if not friend or result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {"success": True}
+
+
+@app.delete("/api/users/{user_id}/friends/{friend_id}")
+async def remove_friend(user_id: str, friend_id: str, caller_uid: Optional[str] = Depends(verify_firebase_token)):
+    require_owner(caller_uid, user_id)
+    try:
+        result = await users_collection.update_one({"_id": ObjectId(user_id)}, {"$pull": {"friends": friend_id}, "$inc": CACHE_VERSION_INC})
+    except:
+        raise HTTPException(status_code=400, detail="Invalid user ID format")
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {"success": True}
 
 
 # ----- Export Endpoints -----
 
+def export_json_default(value):
+    """JSON fallback for export: ISO-8601 for dates, str() for ObjectIds and the rest."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
 @app.get("/api/users/{user_id}/export")
 async def export_user_data(user_id: str, format: str = "json", caller_uid: Optional[str] = Depends(verify_firebase_token)):
     require_owner(caller_uid, user_id)
@@ -1207,10 +3762,13 @@ async def export_user_data(user_id: str, format: str = "json", caller_uid: Optio
     
     user["id"] = str(user.pop("_id"))
     
-    workouts = await workouts_collection.find({"user_id": user_id}).to_list(None)
+    # CSV has no per-sample columns, so only the JSON export pulls and decodes samples
+    projection = None if format == "json" else {"hr_samples": 0, "hr_samples_packed": 0}
+    workouts = await workouts_collection.find({"user_id": user_id}, projection).to_list(None)
     for w in workouts:
         w["id"] = str(w.pop("_id"))
-    
+        inflate_hr_samples(w)
+
     settings = await settings_collection.find_one({"user_id": user_id})
     if settings:
         settings.pop("_id", None)
@@ -1234,7 +3792,7 @@ async def export_user_data(user_id: str, format: str = "json", caller_uid: Optio
     
     if format == "json":
         return Response(
-            content=json.dumps(export_data, indent=2, default=str),
+            content=json.dumps(export_data, indent=2, default=export_json_default),
             media_type="application/json",
             headers={"Content-Disposition": f"attachment; filename=pulsefit_export_{user_id}.json"}
         )
@@ -1247,7 +3805,7 @@ async def export_user_data(user_id: str, format: str = "json", caller_uid: Optio
         for w in workouts:
             writer.writerow([
                 w["id"],
-                w["end_time"][:10],
+                workout_day(w),
                 w["duration_seconds"] // 60,
                 w["total_burn_points"],
                 w["avg_hr"],
@@ -1267,6 +3825,48 @@ async def export_user_data(user_id: str, format: str = "json", caller_uid: Optio
 
 # ----- HR Simulation -----
 
+INTENSITY_RANGES = {
+    "easy": (0.50, 0.70),
+    "moderate": (0.60, 0.85),
+    "hard": (0.75, 0.95),
+    "interval": (0.55, 0.95)
+}
+
+
+def simulate_hr_value(classifier: ZoneClassifier, resting_hr: int, intensity: str, target_zone: Optional[int]) -> int:
+    """One simulated heart rate for the given intensity or target zone."""
+    max_hr = classifier.max_hr
+    # If target zone specified, aim for the user's own bpm range for that zone
+    if target_zone:
+        low, high = classifier.bpm_range(target_zone if target_zone in ZONES else 3)
+        base_hr = (low + high) // 2
+        variation = (high - low) // 4
+    else:
+        min_pct, max_pct = INTENSITY_RANGES.get(intensity, (0.60, 0.85))
+        base_hr = int(max_hr * ((min_pct + max_pct) / 2))
+        variation = int(max_hr * (max_pct - min_pct) / 4)
+    
+    hr = base_hr + random.randint(-variation, variation)
+    return max(resting_hr, min(max_hr, hr))
+
+
+def zone_frame(hr: int, classifier: ZoneClassifier) -> dict:
+    """Heart rate plus its zone details, as shown on the live workout screen."""
+    max_hr = classifier.max_hr
+    zone = classifier.zone(hr)
+    zone_info = ZONES[zone]
+    
+    return {
+        "heart_rate": hr,
+        "zone": zone,
+        "zone_name": zone_info["name"],
+        "zone_color": zone_info["color"],
+        "points_per_minute": zone_info["points"],
+        "max_hr": max_hr,
+        "hr_percentage": round((hr / max_hr) * 100, 1) if max_hr > 0 else 0.0
+    }
+
+
 @app.post("/api/simulate-hr")
 async def simulate_heart_rate(req: HRSimulationRequest):
     try:
@@ -1277,40 +3877,117 @@ async def simulate_heart_rate(req: HRSimulationRequest):
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    max_hr = user["max_hr"]
+    classifier = await get_zone_classifier(user)
+    hr = simulate_hr_value(classifier, user["resting_hr"], req.intensity, req.target_zone)
+    return zone_frame(hr, classifier)
+
+
+# ----- Live Zone Stream -----
+
+LIVE_ZONE_MIN_RATE_HZ = 0.2
+LIVE_ZONE_MAX_RATE_HZ = 10.0
+# Frames waiting for a slow client; beyond this the oldest frame is dropped
+LIVE_ZONE_MAX_PENDING = 4
+
+
+@app.websocket("/api/ws/live-zone/{user_id}")
+async def live_zone_stream(
+    websocket: WebSocket,
+    user_id: str,
+    source: str = "simulated",
+    rate_hz: float = Query(1.0, gt=0),
+    intensity: str = "moderate",
+    target_zone: Optional[int] = None,
+    token: Optional[str] = None
+):
+    """Push heart rate, zone, colour and points-per-minute at a fixed rate.
+
+    source=simulated generates heart rates server-side; source=device relays
+    the latest {"heart_rate": n} message the client sent. Either way the client
+    may send {"intensity": ..., "target_zone": ...} to follow template segments.
+    """
+    if FIREBASE_AUTH_ENABLED:
+        try:
+            caller_uid = firebase_auth.verify_id_token(token or "")["uid"]
+        except Exception:
+            await websocket.close(code=1008, reason="Invalid or expired token")
+            return
+        if caller_uid != user_id:
+            await websocket.close(code=1008, reason="Forbidden")
+            return
+    
+    if source not in ("simulated", "device"):
+        await websocket.close(code=1003, reason="source must be 'simulated' or 'device'")
+        return
+    if not math.isfinite(rate_hz):
+        # The clamp below needs a real number; NaN would make the frame loop spin
+        await websocket.close(code=1003, reason="rate_hz must be a finite number")
+        return
+    
+    try:
+        user = await users_collection.find_one({"_id": ObjectId(user_id)}, {"max_hr": 1, "resting_hr": 1})
+    except Exception:
+        user = None
+    if not user:
+        await websocket.close(code=1008, reason="User not found")
+        return
+    
+    await websocket.accept()
+    
+    classifier = await get_zone_classifier(user)
     resting_hr = user["resting_hr"]
+    interval = 1 / min(max(rate_hz, LIVE_ZONE_MIN_RATE_HZ), LIVE_ZONE_MAX_RATE_HZ)
+    state = {"intensity": intensity, "target_zone": target_zone, "device_hr": None}
+    frames: asyncio.Queue = asyncio.Queue(maxsize=LIVE_ZONE_MAX_PENDING)
+    dropped = 0
     
-    # If target zone specified, aim for that zone
-    if req.target_zone:
-        zone_info = ZONES.get(req.target_zone, ZONES[3])
-        min_pct = zone_info["min_pct"] / 100
-        max_pct = zone_info["max_pct"] / 100
-    else:
-        intensity_ranges = {
-            "easy": (0.50, 0.70),
-            "moderate": (0.60, 0.85),
-            "hard": (0.75, 0.95),
-            "interval": (0.55, 0.95)
-        }
-        min_pct, max_pct = intensity_ranges.get(req.intensity, (0.60, 0.85))
+    async def receive_messages():
+        while True:
+            message = await websocket.receive_json()
+            if not isinstance(message, dict):
+                continue
+            if "heart_rate" in message and isinstance(message["heart_rate"], (int, float)):
+                state["device_hr"] = int(message["heart_rate"])
+            if "intensity" in message:
+                state["intensity"] = message["intensity"]
+            if "target_zone" in message:
+                state["target_zone"] = message["target_zone"]
     
-    base_hr = int(max_hr * ((min_pct + max_pct) / 2))
-    variation = int(max_hr * (max_pct - min_pct) / 4)
-    hr = base_hr + random.randint(-variation, variation)
-    hr = max(resting_hr, min(max_hr, hr))
+    async def produce_frames():
+        nonlocal dropped
+        seq = 0
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            if source == "simulated":
+                hr = simulate_hr_value(classifier, resting_hr, state["intensity"], state["target_zone"])
+            else:
+                hr = state["device_hr"]
+            
+            if hr is not None:
+                seq += 1
+                frame = zone_frame(hr, classifier)
+                frame.update({"seq": seq, "source": source, "dropped": dropped})
+                if frames.full():
+                    # Slow client: discard the stalest frame rather than buffer without limit
+                    frames.get_nowait()
+                    dropped += 1
+                frames.put_nowait(frame)
+            
+            next_tick += interval
+            await asyncio.sleep(max(0, next_tick - loop.time()))
     
-    zone = get_zone(hr, max_hr)
-    zone_info = ZONES[zone]
+    async def send_frames():
+        while True:
+            await websocket.send_json(await frames.get())
     
-    return {
-        "heart_rate": hr,
-        "zone": zone,
-        "zone_name": zone_info["name"],
-        "zone_color": zone_info["color"],
-        "points_per_minute": zone_info["points"],
-        "max_hr": max_hr,
-        "hr_percentage": round((hr / max_hr) * 100, 1)
-    }
+    tasks = [asyncio.create_task(t()) for t in (receive_messages, produce_frames, send_frames)]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
 @app.get("/api/zones")
@@ -1695,7 +4372,7 @@ async def admob_ssv_callback(request: Request):
     coins = int(reward_amount) if reward_amount.isdigit() else 10
     await users_collection.update_one(
         {"_id": ObjectId(user_id)} if len(user_id) == 24 else {"firebase_uid": user_id},
-        {"$inc": {"reward_coins": coins}}
+        {"$inc": {"reward_coins": coins, **CACHE_VERSION_INC}}
     )
 
     # Record the callback for deduplication and audit
@@ -1835,7 +4512,7 @@ async def redeem_discount_code(
     # Deduct coins
     await users_collection.update_one(
         {"_id": ObjectId(user_id)},
-        {"$inc": {"reward_coins": -coin_cost}}
+        {"$inc": {"reward_coins": -coin_cost, **CACHE_VERSION_INC}}
     )
 
     # Increment redeemed count
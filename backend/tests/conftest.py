@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Allow tests to import the backend application module directly
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -0,0 +1,59 @@
+"""
+Test the achievement rule index in server.py
+"""
+from server import ACHIEVEMENTS, achievement_earned, evaluate_achievements, history_achievement_ids, longest_day_run
+
+
+def workout(duration_minutes=30, peak_minutes=0, end_time="2024-05-01T12:00:00+00:00", all_zones=False):
+    zones = [{"zone": z, "duration_seconds": 60 if all_zones else 0} for z in range(1, 5)]
+    zones.append({"zone": 5, "duration_seconds": peak_minutes * 60})
+    return {"duration_seconds": duration_minutes * 60, "zones": zones, "end_time": end_time}
+
+
+def ids(achievements):
+    return [a["id"] for a in achievements]
+
+
+class TestEvaluateAchievements:
+    """Indexed evaluation matches checking every rule one by one"""
+
+    def test_counter_thresholds(self):
+        user = {"total_workouts": 100, "streak_days": 8, "total_burn_points": 12000}
+        assert ids(evaluate_achievements(user, [], set())) == [
+            "first_workout", "streak_7", "points_1000", "points_10000", "century_club"
+        ]
+
+    def test_matches_rule_by_rule(self):
+        user = {"total_workouts": 3, "streak_days": 31, "total_burn_points": 999, "timezone": "America/Denver"}
+        workouts = [workout(65, 25, "2024-05-01T12:30:00+00:00"), workout(10, 1, "2024-05-02T04:00:00+00:00", True)]
+        expected = [
+            a["id"] for a in ACHIEVEMENTS
+            if any(achievement_earned(a["requirement"], user, w) for w in workouts)
+        ]
+        assert ids(evaluate_achievements(user, workouts, set())) == expected
+        assert {"early_bird", "night_owl", "peak_20", "zone_master", "marathon_session"} <= set(expected)
+
+    def test_only_changed_rules_are_evaluated(self):
+        user = {"total_workouts": 1, "streak_days": 30, "total_burn_points": 0}
+        assert ids(evaluate_achievements(user, [workout(65)], set(), changed={"workouts"})) == ["first_workout"]
+        assert ids(evaluate_achievements(user, [workout(65)], set(), changed={"duration_minutes"})) == ["marathon_session"]
+
+    def test_unlocked_are_skipped(self):
+        user = {"total_workouts": 100}
+        assert ids(evaluate_achievements(user, [], {"first_workout"}, changed={"workouts"})) == ["century_club"]
+
+
+class TestTargetStreak:
+    """perfect_week counts consecutive days whose total hit the daily target"""
+
+    def test_longest_day_run(self):
+        assert longest_day_run([]) == 0
+        assert longest_day_run(["2024-02-28", "2024-03-01", "2024-02-29", "2024-02-29", "2024-03-03"]) == 3
+
+    def test_history_evaluation(self):
+        user = {"total_workouts": 7, "daily_burn_target": 12}
+        days = [dict(workout(), end_time=f"2024-05-0{d}T12:00:00+00:00", total_burn_points=12) for d in range(1, 8)]
+        assert "perfect_week" in history_achievement_ids(user, days, set())
+        days[3]["total_burn_points"] = 11
+        assert "perfect_week" not in history_achievement_ids(user, days, set())
+        assert history_achievement_ids(user, days, {"first_workout"}) == []
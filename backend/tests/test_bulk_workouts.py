@@ -0,0 +1,103 @@
+"""
+Test the offline bulk upload endpoint in server.py
+"""
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from bson import ObjectId
+
+import server
+from server import BulkWorkoutCreate, BulkWorkoutItem, bulk_item_end_time, create_workouts_bulk
+
+USER_ID = ObjectId()
+START = datetime(2024, 5, 6, 7, 0, tzinfo=timezone.utc)
+
+
+class FakeCollection:
+    def __init__(self, doc=None):
+        self.doc = doc
+
+    async def find_one(self, query, projection=None):
+        return dict(self.doc) if self.doc else None
+
+
+def session(day: int, minutes: int = 20, hr: int = 170) -> dict:
+    start = START + timedelta(days=day)
+    return {
+        "hr_samples": [
+            {"timestamp": (start + timedelta(seconds=i)).isoformat(), "heart_rate": hr} for i in range(minutes * 60)
+        ],
+        "duration_seconds": minutes * 60,
+        "notes": f"day {day}"
+    }
+
+
+@pytest.fixture
+def committed(monkeypatch):
+    """Run the endpoint against a fake user, recording what would be committed."""
+    user = {
+        "_id": USER_ID, "name": "A", "age": 30, "weight_kg": 70, "max_hr": 190, "resting_hr": 60,
+        "daily_burn_target": 5, "xp": 0, "total_workouts": 0, "streak_days": 0, "last_workout_date": None
+    }
+    monkeypatch.setattr(server, "users_collection", FakeCollection(user))
+    monkeypatch.setattr(server, "settings_collection", FakeCollection())
+    monkeypatch.setattr(server.scoring_pool, "workers", 0)
+    commits = []
+
+    async def commit_workouts(user, docs, streak, best_streak, best_streak_at, last_date):
+        commits.append({"docs": docs, "streak": streak, "best_streak": best_streak, "last_date": last_date})
+
+    monkeypatch.setattr(server, "commit_workouts", commit_workouts)
+    return commits
+
+
+def upload(*items) -> list:
+    req = BulkWorkoutCreate(user_id=str(USER_ID), workouts=list(items))
+    return asyncio.run(create_workouts_bulk(req))["workouts"]
+
+
+class TestBulkUpload:
+    """Queued workouts are applied in end_time order and answered in request order"""
+
+    def test_applied_in_end_time_order(self, committed):
+        upload(session(2), session(0), session(1))
+        docs = committed[0]["docs"]
+        assert [d["notes"] for d in docs] == ["day 0", "day 1", "day 2"]
+        assert [d["end_time"] for d in docs] == sorted(d["end_time"] for d in docs)
+
+    def test_streak_advances_across_the_batch(self, committed):
+        upload(session(2), session(0), session(1))
+        commit, = committed
+        assert commit["streak"] == 3 and commit["best_streak"] == 3
+        assert commit["last_date"] == (START + timedelta(days=2)).strftime("%Y-%m-%d")
+
+    def test_response_follows_request_order(self, committed):
+        workouts = upload(session(2), session(0), session(1))
+        assert [w.notes for w in workouts] == ["day 2", "day 0", "day 1"]
+        stored = {d["id"]: d for d in committed[0]["docs"]}
+        assert all(stored[w.id]["notes"] == w.notes for w in workouts)
+
+    def test_times_keep_their_isoformat_wire_form(self, committed):
+        workout, = upload(session(0))
+        body = workout.model_dump(mode="json")
+        assert body["end_time"] == (START + timedelta(seconds=1199)).isoformat()
+        assert body["start_time"].endswith("+00:00")
+
+
+class TestBulkItemEndTime:
+    """When a queued workout finished"""
+
+    def test_latest_sample_even_if_unsorted(self):
+        item = session(0, minutes=2)
+        random.Random(1).shuffle(item["hr_samples"])
+        end_time = bulk_item_end_time(BulkWorkoutItem(**item), datetime.now(timezone.utc))
+        assert end_time == START + timedelta(seconds=119)
+
+    def test_explicit_end_time_wins_and_future_is_capped(self):
+        now = datetime.now(timezone.utc)
+        item = BulkWorkoutItem(**session(0, minutes=1), end_time="2024-05-01T10:00:00Z")
+        assert bulk_item_end_time(item, now) == datetime(2024, 5, 1, 10, 0, tzinfo=timezone.utc)
+        item = BulkWorkoutItem(**session(0, minutes=1), end_time=(now + timedelta(days=1)).isoformat())
+        assert bulk_item_end_time(item, now) == now
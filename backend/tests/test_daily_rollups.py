@@ -0,0 +1,108 @@
+"""
+Test the daily rollup totals in server.py
+"""
+from datetime import datetime, timezone
+
+from server import (
+    ROLLUP_COLLECTIONS, add_days, bucket_start, coarser_rollups, local_day, rollup_increments, rollup_updates,
+    trends_bucket, workout_day,
+)
+
+
+def workout(end_time: str, points: int, calories: int, zone_seconds: dict) -> dict:
+    return {
+        "end_time": end_time,
+        "total_burn_points": points,
+        "calories_burned": calories,
+        "zones": [{"zone": z, "duration_seconds": zone_seconds.get(z, 0)} for z in range(1, 6)],
+    }
+
+
+class TestRollupIncrements:
+    """Workouts are summed per day in the shape stored in daily_rollups"""
+
+    def test_sums_per_day(self):
+        days = rollup_increments([
+            workout("2024-05-01T06:30:00+00:00", 10, 200, {3: 600, 4: 300}),
+            workout("2024-05-01T18:00:00+00:00", 5, 100, {4: 120, 5: 60}),
+            workout("2024-05-02T07:00:00+00:00", 8, 150, {2: 900}),
+        ])
+        assert days == {
+            "2024-05-01": {
+                "points": 15, "calories": 300, "workouts": 2,
+                "zone_seconds": {"1": 0, "2": 0, "3": 600, "4": 420, "5": 60},
+            },
+            "2024-05-02": {
+                "points": 8, "calories": 150, "workouts": 1,
+                "zone_seconds": {"1": 0, "2": 900, "3": 0, "4": 0, "5": 0},
+            },
+        }
+
+    def test_no_workouts(self):
+        assert rollup_increments([]) == {}
+
+    def test_updates_are_batched_per_collection(self):
+        user = {"_id": "u1", "daily_burn_target": 12}
+        writes = rollup_updates(user, [
+            workout("2024-05-01T06:30:00+00:00", 10, 200, {3: 600}),
+            workout("2024-05-02T07:00:00+00:00", 8, 150, {2: 900}),
+        ])
+        assert [collection for collection, _ in writes] == [ROLLUP_COLLECTIONS[u] for u in ("day", "week", "month")]
+        assert [len(updates) for _, updates in writes] == [2, 1, 1]
+        day_filter, day_update = writes[0][1][0]
+        assert day_filter == {"user_id": "u1", "day": "2024-05-01"}
+        assert day_update["$inc"]["points"] == 10 and day_update["$setOnInsert"] == {"target_hit": False}
+
+
+class TestCoarserRollups:
+    """Day totals roll up into ISO weeks and calendar months"""
+
+    def test_bucket_start(self):
+        assert bucket_start("2024-05-01", "day") == "2024-05-01"
+        assert bucket_start("2024-05-01", "week") == "2024-04-29"
+        assert bucket_start("2024-04-29", "week") == "2024-04-29"
+        assert bucket_start("2024-05-31", "month") == "2024-05-01"
+
+    def test_weeks_and_months(self):
+        days = rollup_increments([
+            workout("2024-04-29T06:30:00+00:00", 10, 200, {3: 600}),
+            workout("2024-05-05T18:00:00+00:00", 5, 100, {4: 120}),
+            workout("2024-05-06T07:00:00+00:00", 8, 150, {2: 900}),
+        ])
+        weeks = coarser_rollups(days, "week")
+        assert {start: (t["points"], t["workouts"]) for start, t in weeks.items()} == {
+            "2024-04-29": (15, 2), "2024-05-06": (8, 1)
+        }
+        months = coarser_rollups(days, "month")
+        assert {start: (t["points"], t["workouts"]) for start, t in months.items()} == {
+            "2024-04-01": (10, 1), "2024-05-01": (13, 2)
+        }
+        assert months["2024-05-01"]["zone_seconds"] == {"1": 0, "2": 900, "3": 0, "4": 120, "5": 0}
+
+    def test_trends_bucket_fits_the_point_budget(self):
+        assert trends_bucket(30, 90) == "day"
+        assert trends_bucket(365, 90) == "week"
+        assert trends_bucket(3 * 365, 90) == "month"
+        assert trends_bucket(3 * 365, 5) == "month"
+
+
+class TestLocalDays:
+    """Days follow the user's timezone"""
+
+    def test_local_day(self):
+        late_evening_in_denver = datetime(2024, 5, 2, 3, 30, tzinfo=timezone.utc)
+        assert local_day({"timezone": "America/Denver"}, late_evening_in_denver) == "2024-05-01"
+        assert local_day({"timezone": "Asia/Kolkata"}, late_evening_in_denver) == "2024-05-02"
+        assert local_day({}, late_evening_in_denver) == "2024-05-02"
+        assert local_day({"timezone": "Not/AZone"}, late_evening_in_denver) == "2024-05-02"
+
+    def test_workouts_bucket_on_their_stored_local_day(self):
+        w = workout("2024-05-02T03:30:00+00:00", 10, 200, {})
+        assert workout_day(w) == "2024-05-02"
+        w["local_day"] = "2024-05-01"
+        assert workout_day(w) == "2024-05-01"
+        assert list(rollup_increments([w])) == ["2024-05-01"]
+
+    def test_add_days(self):
+        assert add_days("2024-03-01", -1) == "2024-02-29"
+        assert add_days("2024-12-31", 1) == "2025-01-01"
@@ -0,0 +1,142 @@
+"""
+Test the dashboard endpoint in server.py against the endpoints it combines
+Collections are replaced with a small in-memory stand-in
+"""
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+from bson import ObjectId
+from fastapi.testclient import TestClient
+
+import server
+from server import UserResponseCache, add_days
+
+USER_ID = ObjectId()
+
+
+def matches(doc: dict, query: dict) -> bool:
+    for key, cond in query.items():
+        value = doc.get(key)
+        if isinstance(cond, dict):
+            if "$gte" in cond and not value >= cond["$gte"]:
+                return False
+            if "$lt" in cond and not value < cond["$lt"]:
+                return False
+            if "$in" in cond and value not in cond["$in"]:
+                return False
+        elif value != cond:
+            return False
+    return True
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, key, direction):
+        self.docs.sort(key=lambda d: d[key], reverse=direction < 0)
+        return self
+
+    async def to_list(self, length):
+        return self.docs
+
+
+class FakeCollection:
+    """Reads return copies of every matching document; projections are ignored."""
+
+    def __init__(self, docs=()):
+        self.docs = [dict(d) for d in docs]
+
+    async def find_one(self, query, projection=None):
+        found = [d for d in self.docs if matches(d, query)]
+        return dict(found[0]) if found else None
+
+    def find(self, query, projection=None):
+        return FakeCursor([dict(d) for d in self.docs if matches(d, query)])
+
+    async def update_many(self, query, update):
+        for doc in self.docs:
+            if matches(doc, query):
+                for key, value in update["$inc"].items():
+                    doc[key] = doc.get(key, 0) + value
+
+
+def rollup(day: str, points: int, workouts: int) -> dict:
+    return {
+        "user_id": str(USER_ID), "day": day, "points": points, "calories": points * 20, "workouts": workouts,
+        "zone_seconds": {"1": 60, "2": 120, "3": 400, "4": 320, "5": 30 if points > 10 else 0},
+        "target_hit": points >= 12, "applied_events": [ObjectId()]
+    }
+
+
+@pytest.fixture
+def client(monkeypatch):
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    user_id = str(USER_ID)
+    collections = {
+        "users_collection": FakeCollection([{
+            "_id": USER_ID, "name": "A", "age": 30, "weight_kg": 70.0, "height_cm": 175.0, "resting_hr": 60,
+            "max_hr": 190, "daily_burn_target": 12, "nd_mode": "standard", "timezone": "UTC", "xp": 340,
+            "level": 4, "streak_days": 3, "last_workout_date": today, "total_burn_points": 61,
+            "total_workouts": 5, "created_at": "2024-01-01T00:00:00+00:00"
+        }]),
+        "daily_rollups_collection": FakeCollection([
+            rollup(add_days(today, -8), 30, 2), rollup(add_days(today, -6), 9, 1),
+            rollup(add_days(today, -2), 14, 1), rollup(today, 18, 2),
+        ]),
+        "achievements_collection": FakeCollection([
+            {"_id": ObjectId(), "user_id": user_id, "achievement_id": "first_workout",
+             "unlocked_at": "2024-05-01T06:30:00+00:00", "xp_credited": True},
+            {"_id": ObjectId(), "user_id": user_id, "achievement_id": "streak_3",
+             "unlocked_at": "2024-05-03T06:30:00+00:00", "xp_credited": True},
+        ]),
+        "personal_bests_collection": FakeCollection([{
+            "_id": ObjectId(), "user_id": user_id, "max_session_points": 18,
+            "max_session_points_date": "2024-05-03T06:30:00+00:00", "longest_streak": 3
+        }]),
+    }
+    for name, collection in collections.items():
+        monkeypatch.setattr(server, name, collection)
+    monkeypatch.setattr(server, "FIREBASE_AUTH_ENABLED", False)
+    monkeypatch.setattr(server, "response_cache", UserResponseCache(maxsize=10))
+    client = TestClient(server.app)
+    client.users = collections["users_collection"]
+    return client
+
+
+class TestDashboard:
+    """One request giving what the home screen's separate endpoints give"""
+
+    def test_sections_match_their_endpoints(self, client):
+        base = f"/api/users/{USER_ID}"
+        dashboard = client.get(f"{base}/dashboard").json()
+        assert dashboard["user"] == client.get(base).json()
+        assert dashboard["stats"] == client.get(f"{base}/stats").json()
+        assert dashboard["quests"] == client.get(f"{base}/quests").json()
+        assert dashboard["achievements"] == client.get(f"{base}/achievements").json()
+        assert dashboard["personal_bests"] == client.get(f"{base}/personal-bests").json()
+        # The fixture isn't trivially empty: rollups outside the 7 days are left out
+        assert dashboard["stats"]["week"] == {"burn_points": 41, "workout_count": 4, "avg_points_per_workout": 10}
+        assert dashboard["quests"]["quests"][0]["completed"] is True
+
+    def test_cached_until_bumped(self, client, monkeypatch):
+        load_dashboard = server.load_dashboard
+        loads = []
+
+        async def counting_load(user_id, today):
+            loads.append(user_id)
+            return await load_dashboard(user_id, today)
+
+        monkeypatch.setattr(server, "load_dashboard", counting_load)
+        url = f"/api/users/{USER_ID}/dashboard"
+        first = client.get(url)
+        second = client.get(url)
+        assert len(loads) == 1 and first.json() == second.json()
+        etag = first.headers["etag"]
+        assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+        asyncio.run(server.response_cache.bump(str(USER_ID)))
+        third = client.get(url, headers={"If-None-Match": etag})
+        assert third.status_code == 200 and third.headers["etag"] != etag
+        assert len(loads) == 2 and client.users.docs[0]["cache_version"] == 1
@@ -0,0 +1,166 @@
+"""
+Test the HR cleaning / 1 Hz resampling stage in server.py
+"""
+import numpy as np
+
+from server import (
+    HR_CLEAN_STATE, HR_GRID_MS, ZoneClassifier, calculate_burn_points, calculate_burn_points_clean,
+    clean_hr_arrays, clean_hr_batch, clean_samples_field, clean_session_totals, loose_hr_arrays,
+    pack_hr_arrays, score_hr_arrays, unpack_hr_arrays, unpack_hr_samples,
+)
+
+START_MS = 1714545000000
+
+
+def series(rates, step_ms=1000, start_ms=START_MS):
+    hr = np.array(rates, dtype=np.int64)
+    return start_ms + np.arange(len(hr), dtype=np.int64) * step_ms, hr
+
+
+class TestCleanHrArrays:
+    """Sorting, de-duplication, outlier rejection and gap handling"""
+
+    def test_clean_1hz_series_is_unchanged(self):
+        times_ms, hr = series(np.arange(100, 160))
+        grid_ms, grid_hr, quality = clean_hr_arrays(times_ms, hr)
+        assert grid_ms.tolist() == times_ms.tolist()
+        assert grid_hr.tolist() == hr.tolist()
+        assert quality == {"raw_samples": 60, "duplicates": 0, "outliers": 0, "gaps": 0, "clean_samples": 60}
+
+    def test_out_of_order_and_duplicates(self):
+        times_ms, hr = series([120, 121, 122, 123, 124])
+        times_ms = np.concatenate((times_ms[[3, 0, 2, 1, 4]], times_ms[[2]]))
+        hr = np.concatenate((hr[[3, 0, 2, 1, 4]], [130]))
+        grid_ms, grid_hr, quality = clean_hr_arrays(times_ms, hr)
+        assert grid_ms.tolist() == series(range(5))[0].tolist()
+        assert grid_hr.tolist() == [120, 121, 130, 123, 124]   # last reading for a repeated time wins
+        assert quality["duplicates"] == 1
+
+    def test_dropouts_and_spikes_are_removed(self):
+        rates = [140] * 10
+        rates[3] = 0     # sensor dropout
+        rates[6] = 255   # saturated reading
+        rates[8] = 190   # single-sample spike
+        grid_ms, grid_hr, quality = clean_hr_arrays(*series(rates))
+        assert quality["outliers"] == 3
+        # Removed points are refilled from their neighbours, so the timeline stays 1 Hz
+        assert len(grid_hr) == 10 and set(grid_hr.tolist()) == {140}
+
+    def test_short_gaps_are_interpolated(self):
+        times_ms = np.array([START_MS, START_MS + 4000], dtype=np.int64)
+        grid_ms, grid_hr, _ = clean_hr_arrays(times_ms, np.array([100, 140]))
+        assert (np.diff(grid_ms) == HR_GRID_MS).all()
+        assert grid_hr.tolist() == [100, 110, 120, 130, 140]
+
+    def test_long_gaps_count_for_nothing(self):
+        before, hr_before = series([150] * 30)
+        after, hr_after = series([150] * 30, start_ms=START_MS + 10 * 60 * 1000)
+        grid_ms, grid_hr, quality = clean_hr_arrays(
+            np.concatenate((before, after)), np.concatenate((hr_before, hr_after)), max_fill_gap_ms=10000
+        )
+        assert len(grid_hr) == 60 and quality["gaps"] == 1
+        # The raw engine charges the whole 10 minutes to the sample before the gap
+        classifier = ZoneClassifier(190)
+        samples = unpack_hr_samples(pack_hr_arrays(np.concatenate((before, after)), np.concatenate((hr_before, hr_after))))
+        raw = calculate_burn_points(samples, 190)
+        clean = calculate_burn_points_clean(grid_hr, classifier)
+        assert sum(z["duration_seconds"] for z in clean[1]) == 60
+        assert sum(z["duration_seconds"] for z in raw[1]) > 600
+
+    def test_sparse_cadence_is_filled(self):
+        # A 15 s cadence is the stream's normal spacing, not a run of dropouts
+        times_ms, hr = series([160] * 240, step_ms=15000)
+        grid_ms, grid_hr, quality = clean_hr_arrays(times_ms, hr)
+        assert quality["gaps"] == 0 and len(grid_hr) == 239 * 15 + 1
+        # A dropout of several intervals is still left empty
+        after, hr_after = series([160] * 10, step_ms=15000, start_ms=int(times_ms[-1]) + 5 * 60 * 1000)
+        _, _, quality = clean_hr_arrays(np.concatenate((times_ms, after)), np.concatenate((hr, hr_after)))
+        assert quality["gaps"] == 1
+
+    def test_declared_cadence(self):
+        times_ms, hr = series([160, 161, 162], step_ms=40000)
+        assert clean_hr_arrays(times_ms, hr, cadence_ms=1000)[2]["gaps"] == 2
+        assert clean_hr_arrays(times_ms, hr, cadence_ms=15000)[2]["gaps"] == 0
+
+    def test_cadence_is_capped(self):
+        times_ms, hr = series([160, 160], step_ms=30 * 24 * 3600 * 1000)
+        grid_ms, _, quality = clean_hr_arrays(times_ms, hr)
+        assert quality["gaps"] == 1 and len(grid_ms) == 2
+
+    def test_sub_second_samples_are_downsampled(self):
+        times_ms, hr = series([150] * 40, step_ms=250)
+        grid_ms, grid_hr, quality = clean_hr_arrays(times_ms, hr)
+        assert quality["clean_samples"] == 10 == len(grid_hr)
+
+    def test_empty(self):
+        grid_ms, grid_hr, quality = clean_hr_arrays(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        assert len(grid_ms) == len(grid_hr) == 0 and quality["clean_samples"] == 0
+        total_points, _, avg_hr, peak_hr = calculate_burn_points_clean(grid_hr, ZoneClassifier(190))
+        assert (total_points, avg_hr, peak_hr) == (0, 0, 0)
+
+    def test_avg_hr_ignores_dropouts(self):
+        rates = [150] * 20 + [0] * 5 + [150] * 20
+        _, grid_hr, _ = clean_hr_arrays(*series(rates))
+        assert calculate_burn_points_clean(grid_hr, ZoneClassifier(190))[2] == 150
+
+
+def stream_session(times_ms, hr, batch_sizes, classifier):
+    """Append batches the way a live session does, keeping only running totals and chunks."""
+    session = {
+        "max_hr": classifier.max_hr, "clean": dict(HR_CLEAN_STATE), "clean_zone_seconds": [0] * 6,
+        "clean_hr_sum": 0, "clean_peak_hr": 0, "hr_quality": {}, "chunks": [],
+    }
+    start = 0
+    for size in batch_sizes:
+        batch = slice(start, start + size)
+        grid_ms, grid_hr, quality, session["clean"] = clean_hr_batch(session["clean"], times_ms[batch], hr[batch])
+        zone_seconds, hr_sum, peak = score_hr_arrays(grid_hr, np.ones(len(grid_hr), dtype=np.int64), classifier)
+        session["clean_zone_seconds"] = [a + int(b) for a, b in zip(session["clean_zone_seconds"], zone_seconds)]
+        session["clean_hr_sum"] += hr_sum
+        session["clean_peak_hr"] = max(session["clean_peak_hr"], peak)
+        for k, v in quality.items():
+            session["hr_quality"][k] = session["hr_quality"].get(k, 0) + v
+        if len(grid_hr):
+            session["chunks"].append(pack_hr_arrays(grid_ms, grid_hr))
+        start += size
+    return session
+
+
+class TestStreamingClean:
+    """Cleaning a live session batch by batch matches cleaning the whole upload"""
+
+    def test_batches_match_whole_series(self):
+        rng = np.random.default_rng(7)
+        rates = rng.integers(120, 170, 900)
+        rates[rng.choice(900, 30, replace=False)] = 0
+        rates[rng.choice(900, 10, replace=False)] = 220
+        times_ms, hr = series(rates)
+        times_ms[500:] += 3 * 60 * 1000   # a real dropout
+        classifier = ZoneClassifier(190)
+
+        expected, field = clean_samples_field(times_ms, hr, classifier)
+        for batch_sizes in ([900], [1] * 900, rng.integers(1, 60, 100).tolist()):
+            session = stream_session(times_ms, hr, batch_sizes, classifier)
+            scores, quality, last_chunk = clean_session_totals(session)
+            chunks = session["chunks"] + ([last_chunk] if last_chunk is not None else [])
+            streamed = np.concatenate([unpack_hr_arrays(chunk)[1] for chunk in chunks])
+            assert streamed.tolist() == unpack_hr_arrays(field["hr_samples_packed"])[1].tolist()
+            assert scores == expected
+            assert quality == field["hr_quality"]
+
+
+class TestLooseHrArrays:
+    """Tolerant extraction from client sample dicts"""
+
+    def test_skips_unusable_samples(self):
+        samples = [
+            {"timestamp": "2024-05-01T06:30:00Z", "heart_rate": 150},
+            {"timestamp": "not-a-timestamp", "heart_rate": 151},
+            {"heart_rate": 152},
+            {"timestamp": "2024-05-01T06:30:02Z"},
+            {"timestamp": "2024-05-01T06:30:03Z", "heart_rate": "153"},
+            {"timestamp": "2024-05-01T06:30:04", "heart_rate": 154.4},
+        ]
+        times_ms, hr = loose_hr_arrays(samples)
+        assert hr.tolist() == [150, 154]
+        assert (times_ms - START_MS).tolist() == [0, 4000]
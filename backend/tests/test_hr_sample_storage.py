@@ -0,0 +1,69 @@
+"""
+Test the packed binary hr_samples storage format
+"""
+import struct
+
+import pytest
+
+from server import (
+    calculate_burn_points, inflate_hr_samples,
+    pack_hr_samples, unpack_hr_samples,
+)
+
+
+SAMPLES = [
+    {"timestamp": "2024-05-01T06:30:00Z", "heart_rate": 92},
+    {"timestamp": "2024-05-01T06:30:01Z", "heart_rate": 95},
+    {"timestamp": "2024-05-01T06:30:02.500Z", "heart_rate": 131},
+    {"timestamp": "2024-05-01T06:30:09Z", "heart_rate": 178},
+    {"timestamp": "2024-05-01T06:30:05Z", "heart_rate": 0},
+]
+
+
+class TestPackedRoundTrip:
+    """Packing then unpacking keeps every sample"""
+
+    def test_round_trip(self):
+        decoded = unpack_hr_samples(pack_hr_samples(SAMPLES))
+        assert [s["heart_rate"] for s in decoded] == [s["heart_rate"] for s in SAMPLES]
+        assert [s["timestamp"] for s in decoded] == [
+            "2024-05-01T06:30:00.000Z", "2024-05-01T06:30:01.000Z", "2024-05-01T06:30:02.500Z",
+            "2024-05-01T06:30:09.000Z", "2024-05-01T06:30:05.000Z",
+        ]
+
+    def test_scoring_unchanged_after_round_trip(self):
+        decoded = unpack_hr_samples(pack_hr_samples(SAMPLES))
+        assert calculate_burn_points(decoded, 190) == calculate_burn_points(SAMPLES, 190)
+
+    def test_empty(self):
+        assert unpack_hr_samples(pack_hr_samples([])) == []
+
+    def test_compact(self):
+        assert len(pack_hr_samples(SAMPLES)) == struct.calcsize("<BqI") + 4 * 4 + 5
+
+    def test_unknown_version_rejected(self):
+        blob = b"\x02" + bytes(pack_hr_samples(SAMPLES))[1:]
+        with pytest.raises(ValueError):
+            unpack_hr_samples(blob)
+
+
+class TestRawFallback:
+    """Samples that cannot be packed losslessly are left for the raw list field"""
+
+    @pytest.mark.parametrize("sample", [
+        {"timestamp": "garbage", "heart_rate": 120},
+        {"timestamp": "2024-05-01T06:31:00Z", "heart_rate": 300},
+        {"timestamp": "2024-05-01T06:31:00Z", "heart_rate": 120.5},
+    ])
+    def test_unpackable_samples(self, sample):
+        assert pack_hr_samples(SAMPLES + [sample]) is None
+
+    def test_inflate_packed_document(self):
+        doc = {"id": "w1", "hr_samples_packed": pack_hr_samples(SAMPLES)}
+        inflate_hr_samples(doc)
+        assert "hr_samples_packed" not in doc
+        assert len(doc["hr_samples"]) == len(SAMPLES)
+
+    def test_inflate_raw_document_untouched(self):
+        doc = {"id": "w1", "hr_samples": SAMPLES}
+        assert inflate_hr_samples(doc)["hr_samples"] is SAMPLES
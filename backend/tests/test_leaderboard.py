@@ -0,0 +1,130 @@
+"""
+Test the weekly leaderboard structures in server.py
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import server
+from server import (
+    LEADERBOARD_SYNC_OVERLAP, RankedBoard, WeeklyLeaderboard, age_band, leaderboard_period, next_period_start
+)
+
+
+class TestRankedBoard:
+    """Ordering, competition ranks and neighbourhoods"""
+
+    def board(self, scores: dict) -> RankedBoard:
+        board = RankedBoard()
+        for user_id, points in scores.items():
+            board.set(user_id, points)
+        return board
+
+    def test_top_and_rank(self):
+        board = self.board({"a": 10, "b": 30, "c": 20, "d": 5})
+        assert board.top(2) == [("b", 30), ("c", 20)]
+        assert [board.rank(u) for u in "bcad"] == [1, 2, 3, 4]
+        assert board.rank("nobody") is None
+
+    def test_ties_share_a_rank(self):
+        board = self.board({"a": 10, "b": 20, "c": 20, "d": 5})
+        assert (board.rank("b"), board.rank("c"), board.rank("a"), board.rank("d")) == (1, 1, 3, 4)
+
+    def test_updates_move_users(self):
+        board = self.board({"a": 10, "b": 20})
+        board.set("a", 25)
+        assert board.top(2) == [("a", 25), ("b", 20)] and len(board) == 2
+        board.remove("a")
+        assert board.top(5) == [("b", 20)]
+
+    def test_around(self):
+        board = self.board({u: p for u, p in zip("abcdefg", range(70, 0, -10))})
+        assert [u for u, _ in board.around("d", 2)] == list("bcdef")
+        assert [u for u, _ in board.around("a", 1)] == list("ab")
+        assert board.around("nobody", 1) == []
+
+
+class TestPeriods:
+    """ISO weeks starting Monday 00:00 UTC"""
+
+    def test_period_and_rollover(self):
+        sunday_night = datetime(2024, 5, 5, 23, 59, tzinfo=timezone.utc)
+        assert leaderboard_period(sunday_night) == "2024-W18"
+        assert leaderboard_period(next_period_start(sunday_night)) == "2024-W19"
+        assert next_period_start(sunday_night) == datetime(2024, 5, 6, tzinfo=timezone.utc)
+
+    def test_age_bands(self):
+        assert [age_band(a) for a in (12, 18, 34, 35, 64, 90)] == ["under-18", "18-24", "25-34", "35-44", "55-64", "65+"]
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length):
+        return self.docs
+
+
+class FakeScores:
+    """leaderboard_scores documents, remembering how many each find returned."""
+
+    def __init__(self):
+        self.docs = []
+        self.reads = []
+
+    def find(self, query, projection=None):
+        since = query.get("updated_at", {}).get("$gte")
+        found = [
+            dict(d) for d in self.docs
+            if d["period"] == query["period"] and (since is None or d["updated_at"] >= since)
+        ]
+        self.reads.append(len(found))
+        return FakeCursor(found)
+
+
+T0 = datetime(2024, 5, 6, 12, 0, tzinfo=timezone.utc)
+
+
+class TestWeeklyLeaderboardSync:
+    """Catch-up reads only what changed since the newest document read"""
+
+    def setup_method(self):
+        self.scores = FakeScores()
+        self.leaderboard = WeeklyLeaderboard()
+
+    def score(self, user_id, points, updated_at, period="2024-W19"):
+        self.scores.docs = [d for d in self.scores.docs if (d["period"], d["user_id"]) != (period, user_id)]
+        self.scores.docs.append({
+            "period": period, "user_id": user_id, "points": points, "name": user_id,
+            "age_band": "25-34", "updated_at": updated_at
+        })
+
+    def test_sync_reads_only_recent_changes(self, monkeypatch):
+        monkeypatch.setattr(server, "leaderboard_scores_collection", self.scores)
+        for i in range(5):
+            self.score(f"u{i}", 10 * i, T0 - timedelta(hours=i + 1))
+        asyncio.run(self.leaderboard.load("2024-W19"))
+        self.score("u1", 100, T0 + timedelta(minutes=1))
+        asyncio.run(self.leaderboard.sync())
+        # The changed document, plus the newest one already read (u0) inside the overlap
+        assert self.scores.reads == [5, 2]
+        assert self.leaderboard.boards["global"].top(1) == [("u1", 100)]
+        assert self.leaderboard.synced_to == T0 + timedelta(minutes=1)
+
+    def test_late_write_inside_the_overlap_is_caught(self, monkeypatch):
+        monkeypatch.setattr(server, "leaderboard_scores_collection", self.scores)
+        self.score("u1", 10, T0)
+        asyncio.run(self.leaderboard.load("2024-W19"))
+        # Stamped before the newest document read, but committed after the read
+        self.score("u2", 20, T0 - LEADERBOARD_SYNC_OVERLAP / 2)
+        asyncio.run(self.leaderboard.sync())
+        assert self.leaderboard.boards["global"].top(2) == [("u2", 20), ("u1", 10)]
+        assert self.leaderboard.synced_to == T0
+
+    def test_rollover_starts_from_the_new_week(self, monkeypatch):
+        monkeypatch.setattr(server, "leaderboard_scores_collection", self.scores)
+        self.score("u1", 50, T0, period="2024-W19")
+        self.score("u2", 5, T0 + timedelta(days=7), period="2024-W20")
+        asyncio.run(self.leaderboard.load("2024-W19"))
+        asyncio.run(self.leaderboard.load("2024-W20"))
+        assert self.leaderboard.boards["global"].top(5) == [("u2", 5)]
+        assert self.leaderboard.synced_to == T0 + timedelta(days=7)
@@ -0,0 +1,87 @@
+"""
+Test the live zone WebSocket stream in server.py
+"""
+import asyncio
+import time
+
+import pytest
+from bson import ObjectId
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+import server
+
+USER_ID = ObjectId()
+
+
+class FakeUsers:
+    async def find_one(self, query, projection=None):
+        if query["_id"] == USER_ID:
+            return {"_id": USER_ID, "max_hr": 190, "resting_hr": 60}
+        return None
+
+
+class FakeSettings:
+    async def find_one(self, query, projection=None):
+        return None
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(server, "users_collection", FakeUsers())
+    monkeypatch.setattr(server, "settings_collection", FakeSettings())
+    monkeypatch.setattr(server, "FIREBASE_AUTH_ENABLED", False)
+    return TestClient(server.app)
+
+
+def url(**params) -> str:
+    query = "&".join(f"{key}={value}" for key, value in params.items())
+    return f"/api/ws/live-zone/{USER_ID}?{query}"
+
+
+class TestLiveZoneStream:
+    """Frame rate, backpressure and device heart rates"""
+
+    @pytest.mark.parametrize("rate_hz", ["nan", "inf", "0", "-1"])
+    def test_invalid_rates_are_rejected(self, client, rate_hz):
+        with pytest.raises(WebSocketDisconnect):
+            with client.websocket_connect(url(rate_hz=rate_hz)) as ws:
+                ws.receive_json()
+
+    def test_rate_is_clamped_to_the_maximum(self, client):
+        with client.websocket_connect(url(rate_hz=1000)) as ws:
+            ws.receive_json()
+            started = time.monotonic()
+            frames = [ws.receive_json() for _ in range(3)]
+            elapsed = time.monotonic() - started
+        assert [f["seq"] for f in frames] == [2, 3, 4]
+        assert elapsed >= 3 / server.LIVE_ZONE_MAX_RATE_HZ * 0.8
+
+    def test_slow_client_drops_stale_frames(self, client, monkeypatch):
+        monkeypatch.setattr(server, "LIVE_ZONE_MAX_RATE_HZ", 500.0)
+        send_json = WebSocket.send_json
+
+        async def slow_send_json(self, data, mode="text"):
+            await asyncio.sleep(0.05)
+            await send_json(self, data, mode)
+
+        monkeypatch.setattr(WebSocket, "send_json", slow_send_json)
+        with client.websocket_connect(url(rate_hz=500)) as ws:
+            frames = [ws.receive_json() for _ in range(5)]
+        last = frames[-1]
+        assert last["dropped"] > 0
+        # Every produced frame was either sent, dropped or is still among the few pending
+        assert last["seq"] - last["dropped"] <= len(frames) + server.LIVE_ZONE_MAX_PENDING
+
+    def test_device_heart_rate_is_relayed(self, client):
+        with client.websocket_connect(url(source="device", rate_hz=10)) as ws:
+            ws.send_json({"heart_rate": 150})
+            frame = ws.receive_json()
+            assert frame["heart_rate"] == 150 and frame["source"] == "device"
+            assert frame["zone"] == server.ZoneClassifier.from_settings(
+                {"max_hr": 190, "resting_hr": 60}, None
+            ).zone(150)
+            ws.send_json({"heart_rate": 100})
+            while frame["heart_rate"] != 100:
+                frame = ws.receive_json()
+            assert frame["seq"] > 1
@@ -0,0 +1,66 @@
+"""
+Test the personal-bests updates in server.py
+"""
+from datetime import datetime, timezone
+
+from server import (
+    PERSONAL_BEST_DATES, personal_best_candidates, personal_best_pipeline, personal_bests_from_history,
+    personal_bests_payload,
+)
+
+
+def workout(day: int, points: int, duration_seconds: int, zone_seconds: dict, target_hit: bool = True) -> dict:
+    return {
+        "end_time": datetime(2024, 5, day, 12, tzinfo=timezone.utc),
+        "local_day": f"2024-05-{day:02d}",
+        "total_burn_points": points,
+        "duration_seconds": duration_seconds,
+        "target_hit": target_hit,
+        "zones": [{"zone": z, "duration_seconds": zone_seconds.get(z, 0)} for z in range(1, 6)],
+    }
+
+
+class TestPersonalBests:
+    """Bests are running maxima dated by the first workout to reach them"""
+
+    def test_candidates(self):
+        best = personal_best_candidates([
+            workout(1, 10, 600, {2: 300, 5: 60}),
+            workout(2, 10, 900, {2: 200}),
+            workout(3, 12, 300, {}),
+        ])
+        assert best["max_session_points"] == (12, datetime(2024, 5, 3, 12, tzinfo=timezone.utc))
+        assert best["longest_workout_seconds"][0] == 900
+        assert best["longest_zone2_seconds"] == (300, datetime(2024, 5, 1, 12, tzinfo=timezone.utc))
+        assert best["longest_peak_seconds"][0] == 60
+        assert "longest_zone1_seconds" not in best
+
+    def test_pipeline_is_one_conditional_stage(self):
+        when = datetime(2024, 5, 1, tzinfo=timezone.utc)
+        stage, = personal_best_pipeline({"max_session_points": (12, when)}, streak=(4, when))
+        assert set(stage["$set"]) == {"max_session_points", "max_session_points_date", "longest_streak", "longest_streak_date"}
+        assert stage["$set"]["longest_streak"] == {"$max": [{"$ifNull": ["$longest_streak", 0]}, 4]}
+        assert stage["$set"]["max_session_points_date"]["$cond"][1] == {"$literal": when}
+
+    def test_history_recompute(self):
+        workouts = [
+            workout(3, 5, 600, {}),
+            workout(1, 8, 300, {4: 120}),
+            workout(2, 6, 300, {}),
+            workout(5, 2, 300, {}),
+        ]
+        doc = personal_bests_from_history({"_id": "u1", "streak_days": 1}, workouts)
+        assert doc["max_session_points"] == 8 and doc["longest_zone4_seconds"] == 120
+        assert (doc["longest_streak"], doc["longest_streak_date"]) == (3, datetime(2024, 5, 3, 12, tzinfo=timezone.utc))
+        assert doc["longest_zone1_seconds"] == 0 and doc["longest_zone1_date"] is None
+
+    def test_history_dates_from_legacy_strings(self):
+        legacy = dict(workout(1, 8, 300, {}), end_time="2024-05-01T12:00:00+00:00")
+        doc = personal_bests_from_history({"_id": "u1"}, [legacy, workout(2, 5, 600, {})])
+        assert doc["max_session_points_date"] == datetime(2024, 5, 1, 12, tzinfo=timezone.utc)
+        assert isinstance(doc["longest_streak_date"], datetime)
+
+    def test_payload_fills_missing_fields(self):
+        payload = personal_bests_payload("u1", {"_id": "x", "user_id": "u1", "max_session_points": 9})
+        assert payload["max_session_points"] == 9 and payload["longest_streak"] == 0
+        assert set(PERSONAL_BEST_DATES) | set(PERSONAL_BEST_DATES.values()) | {"user_id"} == set(payload)
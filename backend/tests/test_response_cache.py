@@ -0,0 +1,104 @@
+"""
+Test the per-user response cache in server.py
+"""
+import asyncio
+
+import pytest
+from bson import ObjectId
+from starlette.requests import Request
+
+import server
+from server import UserResponseCache
+
+U1, U2 = str(ObjectId()), str(ObjectId())
+
+
+def request(if_none_match: str = None) -> Request:
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers})
+
+
+class FakeUsers:
+    """User documents holding only cache_version, as the cache reads and bumps them."""
+
+    def __init__(self, *user_ids):
+        self.docs = {ObjectId(user_id): {"_id": ObjectId(user_id)} for user_id in user_ids}
+
+    async def find_one(self, query, projection=None):
+        doc = self.docs.get(query["_id"])
+        return dict(doc) if doc else None
+
+    async def update_many(self, query, update):
+        for user_id in query["_id"]["$in"]:
+            doc = self.docs[user_id]
+            doc["cache_version"] = doc.get("cache_version", 0) + update["$inc"]["cache_version"]
+
+
+class TestUserResponseCache:
+    """Responses are reused until the user's version is bumped"""
+
+    @pytest.fixture(autouse=True)
+    def users(self, monkeypatch):
+        self.users = FakeUsers(U1, U2)
+        monkeypatch.setattr(server, "users_collection", self.users)
+
+    def setup_method(self):
+        self.cache = UserResponseCache(maxsize=10)
+        self.calls = 0
+
+    async def compute(self):
+        self.calls += 1
+        return {"calls": self.calls}
+
+    def serve(self, user_id=U1, params=None, if_none_match=None, cache=None):
+        cache = cache or self.cache
+        return asyncio.run(cache.serve(request(if_none_match), user_id, "stats", params or {}, self.compute))
+
+    def test_hit_and_not_modified(self):
+        first = self.serve()
+        second = self.serve()
+        assert self.calls == 1 and first.body == second.body
+        assert self.serve(if_none_match=first.headers["etag"]).status_code == 304
+        assert self.serve(if_none_match=f'"other", W/{first.headers["etag"]}').status_code == 304
+        assert self.calls == 1
+
+    def test_bump_invalidates(self):
+        etag = self.serve().headers["etag"]
+        asyncio.run(self.cache.bump(U1))
+        response = self.serve(if_none_match=etag)
+        assert response.status_code == 200 and response.headers["etag"] != etag
+        assert self.calls == 2
+
+    def test_version_is_shared_between_processes(self):
+        # Another worker (or maintenance.py) raising cache_version invalidates this one
+        other = UserResponseCache(maxsize=10)
+        etag = self.serve().headers["etag"]
+        assert self.serve(if_none_match=etag, cache=other).status_code == 304
+        self.users.docs[ObjectId(U1)]["cache_version"] = 7
+        assert self.serve(if_none_match=etag).status_code == 200
+        assert self.calls == 2
+
+    def test_keys_are_per_user_and_params(self):
+        self.serve()
+        self.serve(user_id=U2)
+        self.serve(params={"days": 14})
+        assert self.calls == 3
+        asyncio.run(self.cache.bump(U2))
+        self.serve()
+        assert self.calls == 3
+
+    def test_unknown_users_bypass_the_cache(self):
+        for user_id in (str(ObjectId()), "not-an-id"):
+            response = self.serve(user_id=user_id)
+            assert response == {"calls": self.calls}
+        assert self.calls == 2 and len(self.cache.entries) == 0
+
+    def test_errors_are_not_cached(self):
+        async def fail():
+            raise ValueError("boom")
+        for _ in range(2):
+            try:
+                asyncio.run(self.cache.serve(request(), U1, "stats", {}, fail))
+            except ValueError:
+                pass
+        assert len(self.cache.entries) == 0
@@ -0,0 +1,79 @@
+"""
+Test the scoring process pool in server.py
+"""
+import asyncio
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pytest
+
+from server import ScoringPool, ZoneClassifier, score_samples_job
+
+
+def fixed_rate(n: int) -> tuple:
+    rng = np.random.default_rng(n)
+    return ("2024-05-01T06:30:00Z", 1000, rng.integers(90, 190, n).tolist(), [])
+
+
+class TestScoringPool:
+    """Large payloads run in worker processes, small ones inline, with the same results"""
+
+    def test_small_payloads_stay_inline(self):
+        pool = ScoringPool(workers=1, min_samples=1000, max_pending=2)
+        args = ([], fixed_rate(600), ZoneClassifier(185))
+        result = asyncio.run(pool.run(score_samples_job, *args, size=600))
+        assert result == score_samples_job(*args)
+        assert pool.executor is None
+        assert pool.snapshot()["inline"]["jobs"] == 1 and pool.snapshot()["pool"]["jobs"] == 0
+
+    def test_large_payloads_use_the_pool(self):
+        pool = ScoringPool(workers=1, min_samples=1000, max_pending=2)
+        args = ([], fixed_rate(5000), ZoneClassifier(185))
+
+        async def score_concurrently():
+            return await asyncio.gather(*(pool.run(score_samples_job, *args, size=5000) for _ in range(3)))
+
+        try:
+            results = asyncio.run(score_concurrently())
+        finally:
+            pool.shutdown()
+        assert all(result == score_samples_job(*args) for result in results)
+
+        metrics = pool.snapshot()
+        assert metrics["pool"]["jobs"] == 3 and metrics["inline"]["jobs"] == 0
+        assert metrics["queue_depth"] == 0
+        assert metrics["pool"]["exec_ms_max"] > 0
+
+    def test_disabled_pool_scores_inline(self):
+        pool = ScoringPool(workers=0, min_samples=1, max_pending=1)
+        args = ([], fixed_rate(5000), ZoneClassifier(185))
+        asyncio.run(pool.run(score_samples_job, *args, size=5000))
+        assert pool.executor is None and pool.snapshot()["inline"]["jobs"] == 1
+
+    def test_errors_propagate_from_workers(self):
+        pool = ScoringPool(workers=1, min_samples=1, max_pending=1)
+        bad = ("2024-05-01T06:30:00Z", 1000, [150, 300], [])
+        try:
+            with pytest.raises(ValueError):
+                asyncio.run(pool.run(score_samples_job, [], bad, ZoneClassifier(185), size=2))
+        finally:
+            pool.shutdown()
+        assert pool.snapshot()["queue_depth"] == 0
+
+    def test_broken_pool_is_shut_down_and_replaced(self):
+        class BrokenExecutor:
+            shutdowns = []
+
+            def submit(self, fn, *args):
+                raise BrokenProcessPool("worker died")
+
+            def shutdown(self, wait=True, cancel_futures=False):
+                self.shutdowns.append((wait, cancel_futures))
+
+        pool = ScoringPool(workers=1, min_samples=1, max_pending=1)
+        broken = pool.executor = BrokenExecutor()
+        args = ([], fixed_rate(50), ZoneClassifier(185))
+        result = asyncio.run(pool.run(score_samples_job, *args, size=50))
+        assert result == score_samples_job(*args)
+        assert broken.shutdowns == [(False, True)] and pool.executor is None
+        assert pool.snapshot()["inline"]["jobs"] == 1 and pool.snapshot()["queue_depth"] == 0
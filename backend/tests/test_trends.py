@@ -0,0 +1,185 @@
+"""
+Test the trends aggregation in server.py against the per-day computation it replaced
+The rollup collections are replaced with a small interpreter for the pipeline stages used
+"""
+import asyncio
+import random
+
+import pytest
+from bson import ObjectId
+
+import server
+from server import add_days, bucket_start, coarser_rollups, load_user_trends
+
+USER_ID = str(ObjectId())
+# Sunday 3 March 2024: the month turned two days ago, and February had 29 days
+TODAY = "2024-03-03"
+
+
+def field(doc: dict, path: str):
+    for part in path.lstrip("$").split("."):
+        doc = (doc or {}).get(part)
+    return doc
+
+
+def run_pipeline(docs: list, pipeline: list) -> list:
+    for stage in pipeline:
+        (op, arg), = stage.items()
+        if op == "$match":
+            day = arg["day"]
+            docs = [
+                d for d in docs
+                if d["user_id"] == arg["user_id"] and day["$gte"] <= d["day"] < day["$lt"]
+            ]
+        elif op == "$project":
+            docs = [{k: v for k, v in d.items() if arg.get(k)} for d in docs]
+        elif op == "$facet":
+            docs = [{name: run_pipeline(docs, branch) for name, branch in arg.items()}]
+        elif op == "$group":
+            groups = {}
+            for d in docs:
+                key = field(d, arg["_id"]) if arg["_id"] else None
+                group = groups.setdefault(key, {"_id": key, **{k: 0 for k in arg if k != "_id"}})
+                for name, acc in arg.items():
+                    if name != "_id":
+                        group[name] += field(d, acc["$sum"]) or 0
+            docs = list(groups.values())
+        elif op == "$sort":
+            docs = sorted(docs, key=lambda d: d["_id"])
+        elif op == "$bucket":
+            bounds = arg["boundaries"]
+            groups = {}
+            for d in docs:
+                value = field(d, arg["groupBy"])
+                key = next((low for low, high in zip(bounds, bounds[1:]) if low <= value < high), arg["default"])
+                group = groups.setdefault(key, {"_id": key, "points": 0})
+                group["points"] += field(d, arg["output"]["points"]["$sum"])
+            docs = list(groups.values())
+        else:
+            raise AssertionError(f"unexpected stage {op}")
+    return docs
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length):
+        return self.docs[:length]
+
+
+class FakeRollups:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def aggregate(self, pipeline):
+        return FakeCursor(run_pipeline(self.docs, pipeline))
+
+
+class FakeUsers:
+    async def find_one(self, query, projection=None):
+        return {"_id": query["_id"]}
+
+
+def daily_totals(days: int = 220, seed: int = 7) -> dict:
+    """Day -> rollup totals over the days up to TODAY, with about a third of the days empty."""
+    rng = random.Random(seed)
+    totals = {}
+    for i in range(days):
+        if rng.random() < 0.35:
+            continue
+        totals[add_days(TODAY, -i)] = {
+            "points": rng.randint(1, 40),
+            "calories": rng.randint(50, 600),
+            "workouts": rng.randint(1, 3),
+            "zone_seconds": {str(z): rng.randint(0, 900) for z in range(1, 6)},
+        }
+    return totals
+
+
+def rollup_docs(totals: dict) -> list:
+    return [dict(t, user_id=USER_ID, day=day) for day, t in totals.items()]
+
+
+def per_day_trends(totals: dict, start_day: str, days: int) -> dict:
+    """The trends computation before the aggregation, reading every daily rollup since start_day."""
+    rollups = [dict(t, day=day) for day, t in sorted(totals.items()) if start_day <= day <= TODAY]
+    daily_points = {r["day"]: r["points"] for r in rollups}
+    daily_zone_time = {r["day"]: {z: r["zone_seconds"].get(str(z), 0) for z in range(1, 6)} for r in rollups}
+    weekly_points = []
+    for i in range(min(8, days // 7)):
+        week_start, week_end = add_days(TODAY, -(i + 1) * 7), add_days(TODAY, -i * 7)
+        weekly_points.append({
+            "week": i,
+            "label": f"{(i * 7)} - {((i + 1) * 7)} days ago" if i > 0 else "This week",
+            "points": sum(r["points"] for r in rollups if week_start < r["day"] <= week_end)
+        })
+    total_workouts = sum(r["workouts"] for r in rollups)
+    return {
+        "daily_points": [{"date": k, "points": v} for k, v in sorted(daily_points.items())],
+        "weekly_points": list(reversed(weekly_points)),
+        "zone_distribution": daily_zone_time,
+        "total_workouts": total_workouts,
+        "avg_points_per_workout": sum(daily_points.values()) // total_workouts if total_workouts else 0
+    }
+
+
+def bucketed(expected: dict, unit: str) -> dict:
+    """Per-day trends with the series summed into week or month buckets."""
+    points, zones = {}, {}
+    for row in expected["daily_points"]:
+        start = bucket_start(row["date"], unit)
+        points[start] = points.get(start, 0) + row["points"]
+        bucket = zones.setdefault(start, {z: 0 for z in range(1, 6)})
+        for z, seconds in expected["zone_distribution"][row["date"]].items():
+            bucket[z] += seconds
+    return dict(
+        expected,
+        daily_points=[{"date": k, "points": v} for k, v in sorted(points.items())],
+        zone_distribution=zones
+    )
+
+
+@pytest.fixture
+def totals(monkeypatch):
+    totals = daily_totals()
+    collections = {
+        "day": FakeRollups(rollup_docs(totals)),
+        **{unit: FakeRollups(rollup_docs(coarser_rollups(totals, unit))) for unit in ("week", "month")},
+    }
+    for unit, collection in collections.items():
+        monkeypatch.setitem(server.ROLLUP_COLLECTIONS, unit, collection)
+    monkeypatch.setattr(server, "daily_rollups_collection", collections["day"])
+    monkeypatch.setattr(server, "users_collection", FakeUsers())
+    return totals
+
+
+def trends(days: int, max_points: int) -> dict:
+    return asyncio.run(load_user_trends(USER_ID, TODAY, days, max_points))
+
+
+class TestTrends:
+    """One aggregation per rollup level gives what the per-day loop did"""
+
+    @pytest.mark.parametrize("days", [6, 7, 30, 45, 90])
+    def test_daily_matches_per_day(self, totals, days):
+        result = trends(days, 90)
+        assert result.pop("bucket") == "day"
+        assert result == per_day_trends(totals, add_days(TODAY, -days), days)
+
+    @pytest.mark.parametrize("days, max_points, unit", [(60, 20, "week"), (120, 20, "week"), (200, 12, "month")])
+    def test_coarse_buckets_match_per_day(self, totals, days, max_points, unit):
+        result = trends(days, max_points)
+        assert result.pop("bucket") == unit
+        # Coarse ranges start on a whole bucket; the rolling weeks are still read per day
+        start_day = bucket_start(add_days(TODAY, -days), unit)
+        assert result == bucketed(per_day_trends(totals, start_day, days), unit)
+
+    def test_empty_history(self, monkeypatch):
+        for unit in ("day", "week", "month"):
+            monkeypatch.setitem(server.ROLLUP_COLLECTIONS, unit, FakeRollups([]))
+        monkeypatch.setattr(server, "daily_rollups_collection", server.ROLLUP_COLLECTIONS["day"])
+        monkeypatch.setattr(server, "users_collection", FakeUsers())
+        result = trends(30, 90)
+        assert result["daily_points"] == [] and result["total_workouts"] == 0
+        assert [w["points"] for w in result["weekly_points"]] == [0, 0, 0, 0]
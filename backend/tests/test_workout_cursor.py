@@ -0,0 +1,29 @@
+"""
+Test the workout history cursors in server.py
+"""
+from datetime import datetime, timezone
+
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException
+
+from server import decode_workout_cursor, encode_workout_cursor
+
+
+class TestWorkoutCursor:
+    """Cursors round-trip the (end_time, _id) sort key and reject anything else"""
+
+    def test_round_trip(self):
+        workout = {"_id": ObjectId(), "end_time": datetime(2024, 5, 1, 7, 15, 30, 123000, tzinfo=timezone.utc)}
+        assert decode_workout_cursor(encode_workout_cursor(workout)) == (workout["end_time"], workout["_id"])
+
+    def test_legacy_string_end_time(self):
+        workout = {"_id": ObjectId(), "end_time": "2024-05-01T07:15:30+00:00"}
+        end_time, _ = decode_workout_cursor(encode_workout_cursor(workout))
+        assert end_time == datetime(2024, 5, 1, 7, 15, 30, tzinfo=timezone.utc)
+
+    @pytest.mark.parametrize("cursor", ["", "zzz", "MTIzOm5vdC1hbi1pZA", "bm8tY29sb24"])
+    def test_rejects_garbage(self, cursor):
+        with pytest.raises(HTTPException) as exc:
+            decode_workout_cursor(cursor)
+        assert exc.value.status_code == 400
@@ -0,0 +1,404 @@
+"""
+Test saving workouts, the workout outbox and idempotent counter upserts in server.py
+Collections are replaced with a small in-memory stand-in
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException
+from pymongo.errors import BulkWriteError, OperationFailure
+
+import server
+from server import (
+    OUTBOX_LEASE_SECONDS, OUTBOX_MAX_ATTEMPTS, POST_WORKOUT_ATTEMPTS, StaleUserError, WorkoutOutbox,
+    commit_workouts, save_workouts, upsert_once
+)
+
+
+def matches(doc: dict, query: dict) -> bool:
+    for key, cond in query.items():
+        value = doc.get(key)
+        if isinstance(cond, dict) and any(k.startswith("$") for k in cond):
+            for op, arg in cond.items():
+                if op == "$lte" and not (value is not None and value <= arg):
+                    return False
+                if op == "$in" and value not in arg:
+                    return False
+                if op == "$ne" and (arg in value if isinstance(value, list) else value == arg):
+                    return False
+        elif isinstance(value, list) and not isinstance(cond, list):
+            if cond not in value:
+                return False
+        elif value != cond:
+            return False
+    return True
+
+
+def apply_update(doc: dict, update: dict):
+    for key, value in update.get("$set", {}).items():
+        doc[key] = value
+    for key, value in update.get("$inc", {}).items():
+        doc[key] = doc.get(key, 0) + value
+    for key, value in update.get("$addToSet", {}).items():
+        if value not in doc.setdefault(key, []):
+            doc[key].append(value)
+    for key, value in update.get("$push", {}).items():
+        doc[key] = (doc.get(key, []) + value["$each"])[value["$slice"]:]
+    for key in update.get("$unset", {}):
+        doc.pop(key, None)
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, key, direction):
+        self.docs.sort(key=lambda d: d[key], reverse=direction < 0)
+        return self
+
+    async def to_list(self, length):
+        return self.docs
+
+
+class FakeCollection:
+    """The handful of motor collection methods the outbox uses, with a unique key for upserts."""
+
+    def __init__(self, docs=(), unique=()):
+        self.docs = [dict(d) for d in docs]
+        self.unique = unique
+
+    def find_matching(self, query):
+        return [d for d in self.docs if matches(d, query)]
+
+    async def find_one(self, query, projection=None, sort=None):
+        found = self.find_matching(query)
+        return dict(found[0]) if found else None
+
+    def find(self, query, projection=None):
+        return FakeCursor([dict(d) for d in self.find_matching(query)])
+
+    async def find_one_and_update(self, query, update, sort=None, return_document=None):
+        found = self.find_matching(query)
+        if sort:
+            key, direction = sort[0]
+            found.sort(key=lambda d: d[key], reverse=direction < 0)
+        if not found:
+            return None
+        apply_update(found[0], update)
+        return dict(found[0])
+
+    async def update_one(self, query, update, upsert=False, session=None):
+        found = self.find_matching(query)
+        if found:
+            apply_update(found[0], update)
+        return type("UpdateResult", (), {"matched_count": len(found[:1])})()
+
+    async def insert_one(self, doc, session=None):
+        self.docs.append(dict(doc))
+
+    async def insert_many(self, docs, session=None):
+        self.docs += [dict(d) for d in docs]
+
+    async def delete_one(self, query):
+        found = self.find_matching(query)[:1]
+        self.docs = [d for d in self.docs if d not in found]
+        return type("DeleteResult", (), {"deleted_count": len(found)})()
+
+    async def delete_many(self, query):
+        self.docs = [d for d in self.docs if not matches(d, query)]
+
+    async def bulk_write(self, ops, ordered=True):
+        errors = []
+        for index, op in enumerate(ops):
+            found = self.find_matching(op._filter)
+            if found:
+                apply_update(found[0], op._doc)
+                continue
+            doc = {k: v for k, v in op._filter.items() if not isinstance(v, dict)}
+            if any(all(d.get(k) == doc.get(k) for k in self.unique) for d in self.docs):
+                errors.append({"index": index, "code": 11000})
+                continue
+            apply_update(doc, op._doc)
+            self.docs.append(doc)
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+
+
+USER_ID = ObjectId()
+WORKOUT_ID = ObjectId()
+
+
+def event(**fields) -> dict:
+    now = datetime.now(timezone.utc)
+    return dict({
+        "_id": ObjectId(),
+        "user_id": str(USER_ID),
+        "workout_ids": [WORKOUT_ID],
+        "status": "pending",
+        "steps_done": [],
+        "attempts": 0,
+        "created_at": now,
+        "available_at": now - timedelta(seconds=1),
+    }, **fields)
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    """An outbox over fake collections whose steps only record their calls."""
+    collections = {
+        "users_collection": FakeCollection([{"_id": USER_ID}]),
+        "workouts_collection": FakeCollection([{"_id": WORKOUT_ID, "user_id": str(USER_ID), "end_time": 1}]),
+        "workout_outbox_collection": FakeCollection(),
+    }
+    for name, collection in collections.items():
+        monkeypatch.setattr(server, name, collection)
+
+    async def bump(*user_ids):
+        pass
+
+    monkeypatch.setattr(server.response_cache, "bump", bump)
+
+    calls = []
+    failures = {}
+
+    def step(name):
+        async def run(user, workouts, evt):
+            calls.append(name)
+            if failures.get(name):
+                failures[name] -= 1
+                raise RuntimeError(f"{name} failed")
+        return run
+
+    monkeypatch.setattr(server, "OUTBOX_STEPS", {name: step(name) for name in ("first", "second", "third")})
+    box = WorkoutOutbox(workers=1)
+    box.events = collections["workout_outbox_collection"]
+    box.calls = calls
+    box.failures = failures
+    return box
+
+
+class TestWorkoutOutbox:
+    """Claiming, leasing, retrying and resuming events"""
+
+    def test_claim_leases_the_event(self, outbox):
+        outbox.events.docs.append(event())
+        claimed = asyncio.run(outbox.claim())
+        assert claimed["attempts"] == 1
+        lease = claimed["available_at"] - datetime.now(timezone.utc)
+        assert timedelta(seconds=OUTBOX_LEASE_SECONDS - 5) < lease <= timedelta(seconds=OUTBOX_LEASE_SECONDS)
+        # Held by the lease until it runs out
+        assert asyncio.run(outbox.claim()) is None
+        outbox.events.docs[0]["available_at"] = datetime.now(timezone.utc) - timedelta(seconds=1)
+        assert asyncio.run(outbox.claim())["attempts"] == 2
+
+    def test_not_yet_due_and_finished_events_are_skipped(self, outbox):
+        outbox.events.docs += [
+            event(available_at=datetime.now(timezone.utc) + timedelta(minutes=5)),
+            event(status="done"),
+        ]
+        assert asyncio.run(outbox.claim()) is None
+
+    def test_drain_runs_every_step(self, outbox):
+        outbox.events.docs.append(event())
+        assert asyncio.run(outbox.drain()) == 1
+        stored = outbox.events.docs[0]
+        assert outbox.calls == ["first", "second", "third"]
+        assert stored["status"] == "done" and stored["steps_done"] == ["first", "second", "third"]
+        assert outbox.stats["processed"] == 1
+
+    def test_retry_resumes_after_completed_steps(self, outbox):
+        outbox.events.docs.append(event())
+        outbox.failures["second"] = 1
+        assert asyncio.run(outbox.drain()) == 1
+        stored = outbox.events.docs[0]
+        assert stored["status"] == "pending" and stored["steps_done"] == ["first"]
+        assert stored["last_error"] == "second failed" and outbox.stats["retried"] == 1
+        # Backed off: not due again straight away
+        assert stored["available_at"] > datetime.now(timezone.utc)
+
+        stored["available_at"] = datetime.now(timezone.utc) - timedelta(seconds=1)
+        asyncio.run(outbox.drain())
+        assert outbox.calls == ["first", "second", "second", "third"]
+        assert stored["status"] == "done"
+
+    def test_uncommitted_save_is_withdrawn(self, outbox):
+        # A save without a transaction stopped before marking its event committed
+        outbox.events.docs.append(event(committed=False))
+        asyncio.run(outbox.drain())
+        assert outbox.calls == [] and server.workouts_collection.docs == []
+        assert outbox.events.docs[0]["status"] == "done"
+
+    def test_gives_up_after_max_attempts(self, outbox):
+        outbox.events.docs.append(event(attempts=OUTBOX_MAX_ATTEMPTS - 1))
+        outbox.failures["first"] = 1
+        asyncio.run(outbox.drain())
+        assert outbox.events.docs[0]["status"] == "failed" and outbox.stats["failed"] == 1
+
+
+class TestUpsertOnce:
+    """Counter upserts apply each event at most once"""
+
+    def counters(self, docs=()):
+        return FakeCollection(docs, unique=("user_id", "day"))
+
+    def upsert(self, collection, event_id, points=5):
+        asyncio.run(upsert_once(collection, [({"user_id": "u1", "day": "2024-05-01"}, {"$inc": {"points": points}})], event_id))
+
+    def test_inserts_then_increments(self):
+        collection = self.counters()
+        self.upsert(collection, ObjectId())
+        self.upsert(collection, ObjectId(), points=3)
+        doc, = collection.docs
+        assert doc["points"] == 8 and len(doc["applied_events"]) == 2
+
+    def test_repeated_event_counts_once(self):
+        collection = self.counters()
+        event_id = ObjectId()
+        self.upsert(collection, event_id)
+        self.upsert(collection, event_id)
+        assert collection.docs[0]["points"] == 5
+
+    def test_concurrent_first_insert_is_retried_as_update(self):
+        # Another writer created the document after this one's filter missed it
+        collection = self.counters()
+        find_matching = collection.find_matching
+        raced = []
+
+        def racing_find(query):
+            if not raced:
+                raced.append(True)
+                collection.docs.append({"user_id": "u1", "day": "2024-05-01", "points": 2, "applied_events": []})
+                return []
+            return find_matching(query)
+
+        collection.find_matching = racing_find
+        self.upsert(collection, ObjectId())
+        doc, = collection.docs
+        assert doc["points"] == 7
+
+    def test_applied_events_are_capped(self, monkeypatch):
+        monkeypatch.setattr(server, "APPLIED_EVENTS_KEPT", 3)
+        collection = self.counters()
+        events = [ObjectId() for _ in range(5)]
+        for event_id in events:
+            self.upsert(collection, event_id, points=1)
+        assert collection.docs[0]["applied_events"] == events[-3:]
+
+
+def entry(minutes_ago=0, points=10) -> dict:
+    return {
+        "scores": (points, [], 140, 160),
+        "duration_seconds": 1800,
+        "end_time": datetime.now(timezone.utc) - timedelta(minutes=minutes_ago),
+        "samples_field": {}
+    }
+
+
+class TestSaveWorkouts:
+    """The user update, workouts and outbox event are written together, or retried from a fresh read"""
+
+    @pytest.fixture(autouse=True)
+    def collections(self, monkeypatch):
+        self.users = FakeCollection([{
+            "_id": USER_ID, "name": "A", "age": 30, "weight_kg": 70, "daily_burn_target": 12,
+            "xp": 0, "level": 1, "total_workouts": 0, "total_burn_points": 0, "streak_days": 0
+        }])
+        self.workouts = FakeCollection()
+        self.events = FakeCollection()
+        monkeypatch.setattr(server, "users_collection", self.users)
+        monkeypatch.setattr(server, "workouts_collection", self.workouts)
+        monkeypatch.setattr(server, "workout_outbox_collection", self.events)
+        self.transactions = False
+
+        async def transactions_enabled():
+            return self.transactions
+
+        async def run_in_transaction(write):
+            return await write(None)
+
+        monkeypatch.setattr(server, "transactions_enabled", transactions_enabled)
+        monkeypatch.setattr(server, "run_in_transaction", run_in_transaction)
+
+    def user(self) -> dict:
+        return dict(self.users.docs[0])
+
+    def save(self, *entries):
+        return asyncio.run(save_workouts(self.user(), list(entries) or [entry()]))
+
+    def race_user_updates(self, times):
+        """Have another write raise the user's xp just before each of the next `times` user updates."""
+        update_one = self.users.update_one
+        raced = []
+
+        async def racing_update(query, update, **kwargs):
+            if len(raced) < times:
+                raced.append(True)
+                self.users.docs[0]["xp"] += 1
+            return await update_one(query, update, **kwargs)
+
+        self.users.update_one = racing_update
+        return raced
+
+    def test_without_transactions_the_event_is_committed_and_released(self):
+        docs = self.save(entry(minutes_ago=5), entry())
+        user = self.user()
+        stored, = self.events.docs
+        assert len(self.workouts.docs) == 2 and user["total_workouts"] == 2
+        assert user["xp"] == sum(d["xp_earned"] for d in docs)
+        assert stored["committed"] is True and "user_delta" not in stored
+        assert stored["available_at"] <= datetime.now(timezone.utc)
+        assert user["applied_events"] == [stored["_id"]]
+
+    def test_transactional_event_has_no_user_delta(self):
+        self.transactions = True
+        self.save()
+        stored, = self.events.docs
+        assert "user_delta" not in stored and "committed" not in stored
+        assert self.user()["total_workouts"] == 1 and "applied_events" not in self.user()
+
+    def test_concurrent_user_update_is_retried_once(self):
+        raced = self.race_user_updates(1)
+        docs = self.save()
+        user = self.user()
+        assert raced == [True]
+        # The stale attempt was withdrawn, the retry kept the other write's xp
+        assert len(self.workouts.docs) == 1 and len(self.events.docs) == 1
+        assert self.workouts.docs[0]["_id"] == docs[0]["_id"]
+        assert user["total_workouts"] == 1 and user["xp"] == 1 + docs[0]["xp_earned"]
+
+    def test_gives_up_with_409(self):
+        raced = self.race_user_updates(POST_WORKOUT_ATTEMPTS)
+        with pytest.raises(HTTPException) as e:
+            self.save()
+        assert e.value.status_code == 409 and len(raced) == POST_WORKOUT_ATTEMPTS
+        assert self.workouts.docs == [] and self.events.docs == []
+        assert self.user()["total_workouts"] == 0
+
+    def test_transient_transaction_error_is_stale(self, monkeypatch):
+        self.transactions = True
+
+        async def run_in_transaction(write):
+            raise OperationFailure("write conflict", 112, {"errorLabels": ["TransientTransactionError"]})
+
+        monkeypatch.setattr(server, "run_in_transaction", run_in_transaction)
+        user = self.user()
+        docs, *rest = server.build_workout_docs(user, [entry()], {})
+        with pytest.raises(StaleUserError):
+            asyncio.run(commit_workouts(user, docs, *rest))
+
+    def test_save_taken_over_before_commit_is_withdrawn(self):
+        # The hold ran out while the workouts were written and a worker claimed the event
+        insert_many = self.workouts.insert_many
+
+        async def slow_insert(docs, session=None):
+            await insert_many(docs)
+            self.events.docs[0]["attempts"] = 1
+
+        self.workouts.insert_many = slow_insert
+        user = self.user()
+        docs, *rest = server.build_workout_docs(user, [entry()], {})
+        with pytest.raises(StaleUserError):
+            asyncio.run(commit_workouts(user, docs, *rest))
+        assert self.workouts.docs == [] and self.user()["total_workouts"] == 0
@@ -0,0 +1,237 @@
+"""
+Test the array-backed zone engine in server.py
+Checks calculate_burn_points against the original per-sample implementation
+"""
+import random
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+import pytest
+
+import numpy as np
+
+from server import (
+    ZONES, SampleGap, ZoneClassifier, calculate_burn_points,
+    fixed_rate_arrays, get_zone, hr_sample_arrays, score_session_batch, session_totals,
+)
+
+
+def reference_burn_points(hr_samples: List[dict], max_hr: int) -> tuple:
+    """Original loop-based calculate_burn_points, kept verbatim for parity checks"""
+    zone_seconds = {i: 0 for i in range(6)}
+    total_hr = 0
+    peak_hr = 0
+
+    for i, sample in enumerate(hr_samples):
+        hr = sample.get("heart_rate", 0)
+        total_hr += hr
+        peak_hr = max(peak_hr, hr)
+        zone = get_zone(hr, max_hr)
+
+        duration = 1
+        if i < len(hr_samples) - 1:
+            try:
+                t1 = datetime.fromisoformat(sample["timestamp"].replace("Z", "+00:00"))
+                t2 = datetime.fromisoformat(hr_samples[i+1]["timestamp"].replace("Z", "+00:00"))
+                duration = max(1, int((t2 - t1).total_seconds()))
+            except:
+                duration = 1
+        zone_seconds[zone] += duration
+
+    total_points = 0
+    zone_summaries = []
+
+    for zone_id in range(1, 6):
+        zone_info = ZONES[zone_id]
+        minutes = zone_seconds[zone_id] // 60
+        points = minutes * zone_info["points"]
+        total_points += points
+
+        zone_summaries.append({
+            "zone": zone_id,
+            "name": zone_info["name"],
+            "duration_seconds": zone_seconds[zone_id],
+            "burn_points": points,
+            "color": zone_info["color"]
+        })
+
+    avg_hr = total_hr // len(hr_samples) if hr_samples else 0
+    return total_points, zone_summaries, avg_hr, peak_hr
+
+
+def make_session(seconds: int, seed: int = 0, start: datetime = None) -> List[dict]:
+    rng = random.Random(seed)
+    start = start or datetime(2024, 5, 1, 6, 30, tzinfo=timezone.utc)
+    t = start
+    samples = []
+    for _ in range(seconds):
+        samples.append({"timestamp": t.isoformat().replace("+00:00", "Z"), "heart_rate": rng.randint(60, 200)})
+        t += timedelta(milliseconds=rng.choice([1000, 1000, 1000, 500, 1500, 2300, 7000]))
+    return samples
+
+
+class TestBurnPointsParity:
+    """calculate_burn_points must match the original per-sample loop exactly"""
+
+    @pytest.mark.parametrize("seconds,max_hr", [(600, 190), (3600, 175), (7200, 200)])
+    def test_realistic_sessions(self, seconds, max_hr):
+        samples = make_session(seconds, seed=seconds)
+        assert calculate_burn_points(samples, max_hr) == reference_burn_points(samples, max_hr)
+
+    def test_empty_session(self):
+        assert calculate_burn_points([], 190) == reference_burn_points([], 190)
+
+    def test_single_sample(self):
+        samples = [{"timestamp": "2024-05-01T06:30:00Z", "heart_rate": 150}]
+        assert calculate_burn_points(samples, 190) == reference_burn_points(samples, 190)
+
+    def test_non_positive_max_hr(self):
+        samples = make_session(120)
+        assert calculate_burn_points(samples, 0) == reference_burn_points(samples, 0)
+
+    def test_zone_boundaries(self):
+        # Heart rates that land exactly on every percentage threshold of max_hr=200
+        rates = [99, 100, 119, 120, 139, 140, 167, 168, 183, 184, 200, 250]
+        start = datetime(2024, 5, 1, tzinfo=timezone.utc)
+        samples = [
+            {"timestamp": (start + timedelta(seconds=61 * i)).isoformat(), "heart_rate": hr}
+            for i, hr in enumerate(rates)
+        ]
+        assert calculate_burn_points(samples, 200) == reference_burn_points(samples, 200)
+
+    def test_irregular_timestamps(self):
+        samples = [
+            {"timestamp": "2024-05-01T06:30:00Z", "heart_rate": 150},
+            {"timestamp": "2024-05-01T06:30:00.999Z", "heart_rate": 151},
+            {"timestamp": "2024-05-01T06:29:50Z", "heart_rate": 170},   # out of order
+            {"timestamp": "not-a-timestamp", "heart_rate": 175},
+            {"heart_rate": 180},                                        # missing timestamp
+            {"timestamp": "2024-05-01T06:31:00", "heart_rate": 182},    # naive
+            {"timestamp": "2024-05-01T06:32:30", "heart_rate": 184},    # naive
+            {"timestamp": "2024-05-01T06:33:00+02:00", "heart_rate": 0},
+            {"timestamp": "2024-05-01T04:35:00.250000+00:00", "heart_rate": 140},
+            {"timestamp": "2024-05-01T04:36:02.100000+00:00"},          # missing heart rate
+            {"timestamp": "2024-05-01T04:40:00Z", "heart_rate": 160},
+        ]
+        assert calculate_burn_points(samples, 190) == reference_burn_points(samples, 190)
+
+    def test_returns_plain_python_ints(self):
+        total_points, zones, avg_hr, peak_hr = calculate_burn_points(make_session(300), 190)
+        assert type(total_points) is int and type(avg_hr) is int and type(peak_hr) is int
+        assert all(type(z["duration_seconds"]) is int for z in zones)
+
+
+class TestLiveSessionAccumulation:
+    """Appending batches to a live session scores the same as one full upload"""
+
+    def accumulate(self, samples: List[dict], batch_size: int, max_hr: int) -> dict:
+        session = {"max_hr": max_hr, "zone_seconds": [0] * 6, "sample_count": 0,
+                   "hr_sum": 0, "peak_hr": 0, "tail": None}
+        for i in range(0, len(samples), batch_size):
+            times_ms, hr = hr_sample_arrays(samples[i:i + batch_size])
+            zone_seconds, session["tail"] = score_session_batch(session["tail"], times_ms, hr, ZoneClassifier(max_hr))
+            session["zone_seconds"] = [a + int(b) for a, b in zip(session["zone_seconds"], zone_seconds)]
+            session["sample_count"] += len(hr)
+            session["hr_sum"] += int(hr.sum())
+            session["peak_hr"] = max(session["peak_hr"], int(hr.max()))
+        return session
+
+    @pytest.mark.parametrize("batch_size", [1, 7, 60, 5000])
+    def test_batches_match_full_upload(self, batch_size):
+        samples = make_session(1800, seed=3)
+        session = self.accumulate(samples, batch_size, 185)
+        assert session_totals(session) == calculate_burn_points(samples, 185)
+
+    def test_empty_session(self):
+        session = self.accumulate([], 10, 185)
+        assert session_totals(session) == calculate_burn_points([], 185)
+
+
+class TestFixedRateSamples:
+    """Compact start_time/interval_ms/heart_rates payloads score like the equivalent sample list"""
+
+    def expand(self, start_time: str, interval_ms: int, heart_rates: List[int], gaps: List[SampleGap]) -> List[dict]:
+        gap_ms = {gap.index: gap.duration_ms for gap in gaps}
+        t = datetime.fromisoformat(start_time.replace("Z", "+00:00"))
+        samples = []
+        for i, hr in enumerate(heart_rates):
+            samples.append({"timestamp": t.isoformat(), "heart_rate": hr})
+            t += timedelta(milliseconds=gap_ms.get(i, interval_ms))
+        return samples
+
+    @pytest.mark.parametrize("interval_ms", [1000, 500, 1500, 5000])
+    def test_matches_sample_list(self, interval_ms):
+        rng = random.Random(interval_ms)
+        heart_rates = [rng.randint(60, 200) for _ in range(2400)]
+        gaps = [SampleGap(index=100, duration_ms=45000), SampleGap(index=2000, duration_ms=0)]
+        times_ms, hr = fixed_rate_arrays("2024-05-01T06:30:00Z", interval_ms, heart_rates, gaps)
+
+        samples = self.expand("2024-05-01T06:30:00Z", interval_ms, heart_rates, gaps)
+        sample_times, sample_hr = hr_sample_arrays(samples)
+        assert sample_times.tolist() == times_ms.tolist()
+        assert sample_hr.tolist() == hr.tolist()
+
+    def test_empty_and_single(self):
+        for heart_rates in ([], [150]):
+            times_ms, hr = fixed_rate_arrays("2024-05-01T06:30:00", 1000, heart_rates, [])
+            samples = self.expand("2024-05-01T06:30:00Z", 1000, heart_rates, [])
+            assert [t.tolist() for t in hr_sample_arrays(samples)] == [times_ms.tolist(), hr.tolist()]
+
+    @pytest.mark.parametrize("heart_rates,gaps", [
+        ([150, 256], []),
+        ([150, -1], []),
+        ([150, 151], [SampleGap(index=1, duration_ms=1000)]),
+        ([150, 151], [SampleGap(index=0, duration_ms=2**31)]),
+    ])
+    def test_rejects_unpackable_payloads(self, heart_rates, gaps):
+        with pytest.raises(ValueError):
+            fixed_rate_arrays("2024-05-01T06:30:00Z", 1000, heart_rates, gaps)
+
+
+class TestZoneClassifier:
+    """Per-user compiled zone lookup tables"""
+
+    @pytest.mark.parametrize("max_hr", [0, 120, 171, 190, 203, 300])
+    def test_default_table_matches_get_zone(self, max_hr):
+        classifier = ZoneClassifier(max_hr)
+        rates = np.arange(-5, 256)
+        assert classifier.zones(rates).tolist() == [get_zone(int(hr), max_hr) for hr in rates]
+
+    def test_table_size_is_fixed(self):
+        classifier = ZoneClassifier(10**9)
+        assert len(classifier.table) == 256
+        assert classifier.zones(np.array([255, 400])).tolist() == [0, 0]
+
+    def test_float_rates_use_thresholds(self):
+        classifier = ZoneClassifier(200)
+        rates = np.array([99.9, 100.0, 183.99, 184.0])
+        assert classifier.zones(rates).tolist() == [get_zone(hr, 200) for hr in rates]
+
+    def test_custom_thresholds(self):
+        user = {"max_hr": 200, "resting_hr": 60}
+        settings = {"zone_1_max": 65, "zone_2_max": 75, "zone_3_max": 85, "zone_4_max": 95}
+        classifier = ZoneClassifier.from_settings(user, settings)
+        assert [classifier.zone(hr) for hr in (99, 100, 129, 130, 149, 150, 169, 170, 189, 190)] == \
+            [0, 1, 1, 2, 2, 3, 3, 4, 4, 5]
+
+    def test_malformed_settings_fall_back_to_defaults(self):
+        user = {"max_hr": 200, "resting_hr": 60}
+        for settings in ({"zone_1_max": "abc"}, ["not", "a", "dict"]):
+            classifier = ZoneClassifier.from_settings(user, settings)
+            assert classifier.zones(np.arange(256)).tolist() == ZoneClassifier(200, 60).zones(np.arange(256)).tolist()
+
+    def test_karvonen_uses_heart_rate_reserve(self):
+        user = {"max_hr": 200, "resting_hr": 60}
+        classifier = ZoneClassifier.from_settings(user, {"use_karvonen": True})
+        # Zone 3 starts at 60 + 0.70 * 140 = 158 bpm, zone 5 at 60 + 0.92 * 140 = 188.8 bpm
+        assert classifier.zone(157) == 2 and classifier.zone(158) == 3
+        assert classifier.zone(188) == 4 and classifier.zone(189) == 5
+
+    def test_default_settings_score_like_plain_max_hr(self):
+        samples = make_session(900, seed=11)
+        classifier = ZoneClassifier.from_settings({"max_hr": 185, "resting_hr": 55}, None)
+        assert calculate_burn_points(samples, 185, classifier) == reference_burn_points(samples, 185)
+
+    def test_bpm_range(self):
+        low, high = ZoneClassifier(200).bpm_range(4)
+        assert (low, high) == (168, 183)